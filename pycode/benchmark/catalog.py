@@ -0,0 +1,94 @@
+import datetime as dt
+import random
+import statistics
+import time
+
+from pycode.benchmark.directory_shapes import category_names, get_directory_size
+from pycode.objects.clipart_image import get_bulk_insert_statement, pick_random_fresh_image, ClipartImage
+from pycode.objects.directory_summary import DirectorySampler
+
+
+def get_latency(seconds):
+    milliseconds = sorted(x * 1000 for x in seconds)
+    return {"samples": len(milliseconds), "mean_ms": round(statistics.mean(milliseconds), 3),
+            "p50_ms": round(milliseconds[len(milliseconds) // 2], 3),
+            "p95_ms": round(milliseconds[int(len(milliseconds) * 0.95)], 3), "max_ms": round(milliseconds[-1], 3)}
+
+
+# Grows a synthetic catalog a directory at a time, with the same skewed directory sizes as the synthetic corpus. About
+# a third of the images are already posted and a few failed to save, so the random pick has something to skip over.
+class SyntheticCatalog:
+    def __init__(self, db_conn, seed=0, cd_count=28, insert_batch_size=500):
+        self.db_conn = db_conn
+        self.rng = random.Random(seed)
+        self.cd_count = cd_count
+        self.insert_batch_size = insert_batch_size
+        self.size = 0
+        # (origin_cd, subdirectories) -> number of images in the directory
+        self.directory_sizes = {}
+
+    def generate_images(self, count):
+        posted_on = dt.datetime(2023, 1, 1)
+        while count > 0:
+            origin_cd = self.rng.randint(1, self.cd_count)
+            subdirectories = "{0}\\SET{1:05d}".format(self.rng.choice(category_names), len(self.directory_sizes))
+            directory_size = min(get_directory_size(self.rng), count)
+            self.directory_sizes[(origin_cd, subdirectories)] = directory_size
+            for position in range(directory_size):
+                roll = self.rng.random()
+                yield ClipartImage(filename="CL{0:05d}.png".format(position), origin_cd=origin_cd,
+                                   subdirectories=subdirectories, original_file_extension="WMF",
+                                   failed_to_save=roll < 0.02, posted_on=posted_on if roll > 0.67 else None,
+                                   position=position)
+            count -= directory_size
+
+    # inserts images until the catalog has target_size of them. Returns the insert rate.
+    def grow(self, target_size):
+        count = target_size - self.size
+        started_at = time.perf_counter()
+        with self.db_conn.get_batch_writer(lambda x: get_bulk_insert_statement(x, dialect=self.db_conn.dialect),
+                                           self.insert_batch_size) as image_writer:
+            for image in self.generate_images(count):
+                image_writer.add(image)
+        seconds = time.perf_counter() - started_at
+        self.size = target_size
+        return {"rows": count, "seconds": round(seconds, 4),
+                "rows_per_second": round(count / seconds, 1) if seconds > 0 else None}
+
+    # times the GUI's random pick, excluding the subdirectories of 10 random directories like it excludes the last 10
+    # posted from
+    def benchmark_random_pick(self, samples):
+        directories = list(self.directory_sizes.keys())
+        seconds = []
+        for _ in range(samples):
+            skip_subdirectories = [x[1] for x in self.rng.sample(directories, min(10, len(directories)))]
+            started_at = time.perf_counter()
+            pick_random_fresh_image(self.db_conn, skip_subdirectories)
+            seconds.append(time.perf_counter() - started_at)
+        return get_latency(seconds)
+
+    # times the GUI's directory-first pick. Nothing in the synthetic catalog was posted recently, so no directory is
+    # cooling down.
+    def benchmark_directory_pick(self, samples, weight_exponent=0.5):
+        sampler = DirectorySampler(self.db_conn, weight_exponent, rng=self.rng)
+        seconds = []
+        for _ in range(samples):
+            started_at = time.perf_counter()
+            sampler.pick()
+            seconds.append(time.perf_counter() - started_at)
+        return get_latency(seconds)
+
+    # times the related-images lookup from a random position, grouped by the size of the directory it's in
+    def benchmark_nearby(self, samples, buckets=(25, 100, 400)):
+        seconds_by_bucket = {}
+        directories = list(self.directory_sizes.items())
+        for _ in range(samples):
+            (origin_cd, subdirectories), directory_size = self.rng.choice(directories)
+            bucket = next((x for x in buckets if directory_size <= x), None)
+            bucket_name = "<={0}".format(bucket) if bucket is not None else ">{0}".format(buckets[-1])
+            image = ClipartImage(filename="CL00000.png", origin_cd=origin_cd, subdirectories=subdirectories,
+                                 original_file_extension="WMF", position=self.rng.randrange(directory_size))
+            started_at = time.perf_counter()
+            image.get_nearby_records(self.db_conn)
+            seconds_by_bucket.setdefault(bucket_name, []).append(time.perf_counter() - started_at)
+        return {x: get_latency(y) for x, y in seconds_by_bucket.items()}
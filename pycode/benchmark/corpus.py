@@ -0,0 +1,111 @@
+import math
+import os
+import random
+import struct
+
+from PIL import Image, ImageDraw
+
+from pycode.benchmark.directory_shapes import category_names, get_directory_size
+
+# the mix of source formats on the real CDs, roughly: mostly WMF, then TIFF, with a few of everything else
+format_weights = [(".WMF", 55), (".TIF", 25), (".PNG", 8), (".JPG", 7), (".GIF", 5)]
+
+
+# random line art: a few filled and outlined shapes on a transparent or white background
+def draw_clipart(rng, width, height, transparent):
+    image = Image.new("RGBA", (width, height), (255, 255, 255, 0 if transparent else 255))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(3, 12)):
+        color = tuple(rng.randint(0, 255) for _ in range(3)) + (255,)
+        x0, y0 = rng.randint(0, width - 2), rng.randint(0, height - 2)
+        x1, y1 = rng.randint(x0 + 1, width - 1), rng.randint(y0 + 1, height - 1)
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color, outline=(0, 0, 0, 255), width=2)
+        else:
+            draw.polygon(get_polygon(rng, width, height), fill=color, outline=(0, 0, 0, 255))
+    return image
+
+
+def get_polygon(rng, width, height):
+    center_x, center_y = rng.randint(0, width - 1), rng.randint(0, height - 1)
+    radius = rng.randint(10, max(11, min(width, height) // 3))
+    point_count = rng.randint(3, 8)
+    return [(int(center_x + radius * math.cos(2 * math.pi * x / point_count)),
+             int(center_y + radius * math.sin(2 * math.pi * x / point_count))) for x in range(point_count)]
+
+
+# Writes a minimal placeable Windows Metafile: a header, then a filled ellipse or polygon per shape, each with its own
+# brush. Pillow can't write WMFs, but the format is simple enough to produce by hand, which keeps the corpus free of
+# any toolchain requirement. Whether they can be *read* depends on the toolchain (Pillow only renders WMFs on Windows;
+# ImageMagick needs libwmf), which is exactly what the conversion benchmarks measure.
+def write_wmf(rng, path, width, height):
+    records = [
+        struct.pack("<IHhh", 5, 0x020B, 0, 0),  # SETWINDOWORG
+        struct.pack("<IHhh", 5, 0x020C, height, width),  # SETWINDOWEXT
+    ]
+    for _ in range(rng.randint(3, 12)):
+        color = rng.randint(0, 255) | (rng.randint(0, 255) << 8) | (rng.randint(0, 255) << 16)
+        records.append(struct.pack("<IHHIH", 7, 0x02FC, 0, color, 0))  # CREATEBRUSHINDIRECT, solid
+        records.append(struct.pack("<IHH", 4, 0x012D, 0))  # SELECTOBJECT
+        if rng.random() < 0.5:
+            x0, y0 = rng.randint(0, width - 2), rng.randint(0, height - 2)
+            x1, y1 = rng.randint(x0 + 1, width - 1), rng.randint(y0 + 1, height - 1)
+            records.append(struct.pack("<IHhhhh", 7, 0x0418, y1, x1, y0, x0))  # ELLIPSE
+        else:
+            points = get_polygon(rng, width, height)
+            records.append(struct.pack("<IHh", 4 + 2 * len(points), 0x0324, len(points)) +
+                           b"".join(struct.pack("<hh", x, y) for x, y in points))  # POLYGON
+        records.append(struct.pack("<IHH", 4, 0x01F0, 0))  # DELETEOBJECT
+    records.append(struct.pack("<IH", 3, 0x0000))  # EOF
+    body = b"".join(records)
+
+    header_words = 9
+    file_words = header_words + len(body) // 2
+    max_record_words = max(struct.unpack("<I", x[:4])[0] for x in records)
+    metafile_header = struct.pack("<HHHIHIH", 1, header_words, 0x0300, file_words, 1, max_record_words, 0)
+
+    placeable = struct.pack("<IHhhhhHI", 0x9AC6CDD7, 0, 0, 0, width, height, 96, 0)
+    checksum = 0
+    for word in struct.unpack("<10H", placeable[:20]):
+        checksum ^= word
+    with open(path, "wb") as wmf_file:
+        wmf_file.write(placeable + struct.pack("<H", checksum) + metafile_header + body)
+
+
+def write_image(rng, path, extension):
+    width, height = rng.randint(200, 640), rng.randint(200, 640)
+    if extension == ".WMF":
+        write_wmf(rng, path, width, height)
+        return
+    image = draw_clipart(rng, width, height, transparent=extension in (".PNG", ".GIF"))
+    if extension == ".JPG":
+        image.convert("RGB").save(path, "JPEG", quality=85)
+    elif extension == ".GIF":
+        image.convert("P", palette=Image.ADAPTIVE).save(path, "GIF")
+    elif extension == ".TIF":
+        image.convert("RGB").save(path, "TIFF", compression="tiff_lzw")
+    else:
+        image.save(path, "PNG")
+
+
+# Generates a synthetic corpus shaped like the mounted CDs under output_dir: one directory per CD, each with category
+# and subcategory directories of skewed sizes. The same seed always produces the same corpus. Returns the
+# (cd number, directory) pairs, like convert.drive_to_cd_number_pairs, and the number of files written.
+def generate_corpus(output_dir, file_count, seed=0, cd_count=2):
+    rng = random.Random(seed)
+    extensions = [x[0] for x in format_weights]
+    weights = [x[1] for x in format_weights]
+    sources = [(cd_number, os.path.join(output_dir, "cd_{0}".format(cd_number))) for cd_number in range(1, cd_count + 1)]
+
+    written = 0
+    directory_index = 0
+    while written < file_count:
+        cd_number, cd_dir = sources[directory_index % cd_count]
+        directory = os.path.join(cd_dir, rng.choice(category_names), "SET{0:03d}".format(directory_index))
+        os.makedirs(directory, exist_ok=True)
+        for file_index in range(min(get_directory_size(rng), file_count - written)):
+            extension = rng.choices(extensions, weights)[0]
+            write_image(rng, os.path.join(directory, "CL{0:05d}{1}".format(file_index, extension)), extension)
+            written += 1
+        directory_index += 1
+    return sources, written
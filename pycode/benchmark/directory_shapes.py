@@ -0,0 +1,8 @@
+# shared by the synthetic corpus and the synthetic catalog, so both have the shape of the real CDs
+category_names = ["ANIMALS", "BORDERS", "BUSINESS", "CARTOONS", "FOOD", "HOLIDAYS", "MAPS", "MUSIC", "PEOPLE",
+                  "PLANTS", "RELIGION", "SCHOOL", "SPORTS", "SYMBOLS", "TRAVEL", "VEHICLES"]
+
+
+# number of files in a directory. Like the real CDs, most directories hold a few dozen files and a handful hold hundreds.
+def get_directory_size(rng, max_size=600):
+    return min(max_size, int(8 * rng.paretovariate(1.2)))
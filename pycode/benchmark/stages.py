@@ -0,0 +1,121 @@
+import io
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from pycode.objects.file_inventory import scan_source
+
+# ImageMagick is optional here - without it, files only it can read are just counted as errors
+try:
+    from wand.image import Image as wima
+except ImportError:
+    wima = None
+
+
+def get_rate(count, seconds, errors=0):
+    return {"files": count, "errors": errors, "seconds": round(seconds, 4),
+            "files_per_second": round(count / seconds, 1) if seconds > 0 else None}
+
+
+# lists the corpus the way each walker does: os.walk, os.scandir one source after another (the inventory's walker), and
+# os.scandir with a thread per source (how FileInventory.refresh runs it)
+def benchmark_walk(sources):
+    results = {}
+
+    started_at = time.perf_counter()
+    count = sum(len(files) for (cd_number, directory) in sources for root, dirs, files in os.walk(directory))
+    results["os_walk"] = get_rate(count, time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    count = sum(len(scan_source(cd_number, directory)) for (cd_number, directory) in sources)
+    results["scandir"] = get_rate(count, time.perf_counter() - started_at)
+
+    counts = []
+    threads = [threading.Thread(target=lambda x: counts.append(len(scan_source(*x))), args=(x,)) for x in sources]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results["scandir_concurrent"] = get_rate(sum(counts), time.perf_counter() - started_at)
+    return results
+
+
+def decode_with_pillow(path):
+    with Image.open(path) as image:
+        image.load()
+        return image.copy()
+
+
+def decode_with_wand(path):
+    with wima(filename=path) as image:
+        return Image.open(io.BytesIO(image.make_blob("png"))).copy()
+
+
+# returns the decoded image and which backend managed it, trying Pillow first like convert.py does by default
+def decode(path):
+    try:
+        return decode_with_pillow(path), "pillow"
+    except Exception:
+        if wima is None:
+            raise
+    return decode_with_wand(path), "wand"
+
+
+# decode and encode rates per source extension and decoding backend. Encoding is timed on its own, as a PNG save of the
+# already decoded image into memory, so disk writes don't blur it.
+def benchmark_decode_encode(paths):
+    decode_stats = {}
+    encode_stats = {}
+    for path in paths:
+        extension = os.path.splitext(path)[1].lower()
+        started_at = time.perf_counter()
+        try:
+            image, backend = decode(path)
+        except Exception:
+            stats = decode_stats.setdefault(extension, {}).setdefault("failed", [0, 0.0])
+            stats[0] += 1
+            stats[1] += time.perf_counter() - started_at
+            continue
+        stats = decode_stats.setdefault(extension, {}).setdefault(backend, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        image.save(io.BytesIO(), "PNG")
+        stats = encode_stats.setdefault(extension, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started_at
+
+    return ({extension: {backend: get_rate(*x) for backend, x in by_backend.items()}
+             for extension, by_backend in decode_stats.items()},
+            {extension: get_rate(*x) for extension, x in encode_stats.items()})
+
+
+# the whole per-file conversion the converter's workers run (decode, save, thumbnail, perceptual hash), in one process.
+# Returns None if the conversion engine can't be imported here, i.e. without Wand.
+def benchmark_convert(paths, thumbnail_size=(400, 400)):
+    try:
+        from pycode.objects.conversion_engine import convert_file
+    except ImportError:
+        return None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for index, path in enumerate(paths):
+            extension = os.path.splitext(path)[1].lower()
+            should_convert = extension in (".wmf", ".tif", ".tiff")
+            output_format = "png" if should_convert else extension.lstrip(".")
+            output_location = os.path.join(output_dir, "{0}.{1}".format(index, output_format))
+            started_at = time.perf_counter()
+            attempts, perceptual_hash = convert_file(path, output_location, output_format,
+                                                     os.path.join(output_dir, "{0}_thumb.png".format(index)),
+                                                     thumbnail_size)
+            stats = results.setdefault(extension, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += time.perf_counter() - started_at
+            stats[2] += 1 if attempts[-1][2] is not None else 0
+    return {extension: get_rate(*x) for extension, x in results.items()}
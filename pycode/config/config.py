@@ -1,12 +1,31 @@
 import json
+import threading
 from pathlib import Path
 
+# config.json is only read and parsed once per process, however many Config objects get made
+loaded_configs = {}
+load_lock = threading.Lock()
+
+
+def load_config_file(config_path):
+    with load_lock:
+        if config_path not in loaded_configs:
+            with open(config_path, "r") as config_file:
+                loaded_configs[config_path] = json.load(config_file)
+        return loaded_configs[config_path]
+
 
 class Config:
     def __init__(self):
         self.config_file = "config.json"
-        with open("{0}\\{1}".format(Path(__file__).parent.absolute(), self.config_file), "r") as config_file:
-            self.config = json.load(config_file)
+        self.config = load_config_file(Path(__file__).parent.absolute() / self.config_file)
+
+    # "mysql" or "sqlite", see database_connection.get_database_connection
+    def get_database_backend(self):
+        return self.config['database']['backend']
+
+    def get_sqlite_path(self):
+        return self.config['database']['sqlite_path']
 
     def get_mysql_config(self):
         return self.config['mysql']
@@ -17,12 +36,90 @@ class Config:
     def get_mysql_database(self):
         return self.config['mysql']['database']
 
+    def get_mysql_pool_size(self):
+        return self.config['mysql']['pool_size']
+
     def get_image_base_dir(self):
         return self.config['image_base_dir']
 
+    def get_conversion_worker_count(self):
+        return self.config['conversion']['worker_count']
+
+    def get_conversion_max_queued_jobs(self):
+        return self.config['conversion']['max_queued_jobs']
+
+    def get_conversion_insert_batch_size(self):
+        return self.config['conversion']['insert_batch_size']
+
+    def get_conversion_journal_dir(self):
+        return self.config['conversion']['journal_dir']
+
+    # extension -> list of backends to try, in order, e.g. {".wmf": ["wand", "pillow"]}. Extensions not listed here are
+    # routed by the success rates seen so far.
+    def get_conversion_backend_order(self):
+        return self.config['conversion']['backend_order']
+
+    def get_conversion_router_min_samples(self):
+        return self.config['conversion']['router_min_samples']
+
+    def get_conversion_wand_batch_size(self):
+        return self.config['conversion']['wand_batch_size']
+
+    def get_prefetch_depth(self):
+        return self.config['prefetch']['depth']
+
+    def get_prefetch_max_bytes(self):
+        return self.config['prefetch']['max_megabytes'] * 1024 * 1024
+
+    def get_display_max_size(self):
+        return self.config['prefetch']['max_width'], self.config['prefetch']['max_height']
+
+    def get_thumbnail_cache_dir(self):
+        return self.config['thumbnails']['cache_dir']
+
+    def get_thumbnail_size(self):
+        return self.config['thumbnails']['width'], self.config['thumbnails']['height']
+
+    def get_thumbnail_memory_bytes(self):
+        return self.config['thumbnails']['memory_megabytes'] * 1024 * 1024
+
+    # how the GUI picks images to post, see DirectorySampler in objects/directory_summary.py
+    def get_sampler_weight_exponent(self):
+        return self.config['sampler']['weight_exponent']
+
+    def get_sampler_cooldown_hours(self):
+        return self.config['sampler']['cooldown_hours']
+
+    # the triage mode grid, see objects/triage_grid.py
+    def get_triage_grid_shape(self):
+        return self.config['triage']['rows'], self.config['triage']['columns']
+
+    def get_triage_tile_size(self):
+        return self.config['triage']['tile_width'], self.config['triage']['tile_height']
+
+    # the related images screen, see objects/contact_sheet.py
+    def get_contact_sheet_tile_size(self):
+        return self.config['contact_sheet']['tile_width'], self.config['contact_sheet']['tile_height']
+
+    def get_contact_sheet_columns(self):
+        return self.config['contact_sheet']['columns']
+
+    # see objects/metrics.py
+    def get_metrics_enabled(self):
+        return self.config['metrics']['enabled']
+
+    def get_metrics_output_dir(self):
+        return self.config['metrics']['output_dir']
+
+    def get_post_worker_config(self):
+        return self.config['post_worker']
+
     def get_tumblr_urls(self):
         return self.config['tumblr_urls']
 
+    def get_token_refresh_margin(self):
+        return self.config['tumblr_token_refresh_margin_seconds']
+
     def get_blogname(self):
         return self.config['blogname']
 
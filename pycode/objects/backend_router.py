@@ -0,0 +1,77 @@
+import logging
+
+backends = ("pillow", "wand")
+
+
+# attempt count, success count and total seconds spent, for one backend on one extension
+class BackendStats:
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.seconds = 0.0
+
+    def record(self, seconds, succeeded):
+        self.attempts += 1
+        self.successes += 1 if succeeded else 0
+        self.seconds += seconds
+
+    # smoothed so a backend with only a couple of attempts isn't judged on them alone
+    @property
+    def success_rate(self):
+        return (self.successes + 1) / (self.attempts + 2)
+
+    @property
+    def mean_seconds(self):
+        return self.seconds / self.attempts if self.attempts > 0 else 0.0
+
+
+# Decides which conversion backend each file is tried with first. Trying Pillow on a format it can't read, then falling
+# back to ImageMagick, costs a failed decode per file - on a WMF-heavy CD that's most of the run - so once a backend has
+# min_samples attempts on an extension, files with that extension go straight to whichever backend has the best success
+# rate, with the faster one winning ties. Extensions listed in configured_order skip the learning and always use the
+# given order.
+#
+# Stats are kept twice: the ones routing is based on last the whole run, and the ones for log_report are reset after
+# every report so each CD gets its own numbers.
+class BackendRouter:
+    def __init__(self, configured_order=None, min_samples=20):
+        self.configured_order = dict([(x.lower(), tuple(y)) for x, y in (configured_order or {}).items()])
+        self.min_samples = min_samples
+        self.stats = {}
+        self.report_stats = {}
+
+    @staticmethod
+    def get_stats(stats_by_extension, extension, backend):
+        return stats_by_extension.setdefault(extension, {}).setdefault(backend, BackendStats())
+
+    def get_backend_order(self, extension):
+        extension = extension.lower()
+        if extension in self.configured_order:
+            return self.configured_order[extension]
+
+        extension_stats = self.stats.get(extension, {})
+        if all(extension_stats.get(x) is None or extension_stats[x].attempts < self.min_samples for x in backends):
+            return backends
+        # a backend that hasn't been tried enough yet sorts as if it had a 50% success rate
+        return tuple(sorted(backends, key=lambda x: self.get_rank(extension_stats.get(x))))
+
+    def get_rank(self, stats):
+        if stats is None or stats.attempts < self.min_samples:
+            return -0.5, 0.0
+        return -stats.success_rate, stats.mean_seconds
+
+    # records the (backend, seconds, error) attempts a worker made on a file with the given extension
+    def record(self, extension, attempts):
+        extension = extension.lower()
+        for backend, seconds, error in attempts:
+            self.get_stats(self.stats, extension, backend).record(seconds, error is None)
+            self.get_stats(self.report_stats, extension, backend).record(seconds, error is None)
+
+    def log_report(self, title):
+        logging.info("Conversion backends for {0}:".format(title))
+        for extension, extension_stats in sorted(self.report_stats.items()):
+            for backend, stats in sorted(extension_stats.items()):
+                logging.info("\t{0} {1}: {2}/{3} succeeded, {4:.3f}s average".format(
+                    extension, backend, stats.successes, stats.attempts, stats.mean_seconds))
+            logging.info("\t{0} now tried with {1}".format(extension, ", ".join(self.get_backend_order(extension))))
+        self.report_stats = {}
@@ -0,0 +1,38 @@
+from pycode.objects import metrics
+
+
+# Buffers records and writes them flush_size at a time, using build_statement to turn a list of records into a single
+# (statement, values) pair - e.g. clipart_image.get_bulk_insert_statement. Use it as a context manager (or call
+# flush() yourself) so the final partial batch isn't lost. If on_flush is given, it's called after every batch has been
+# committed. name labels the writer's metrics.
+class BatchWriter:
+    def __init__(self, db_conn, build_statement, flush_size=1000, on_flush=None, name=None):
+        self.db_conn = db_conn
+        self.name = name or "unnamed"
+        self.build_statement = build_statement
+        self.flush_size = flush_size
+        self.on_flush = on_flush
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with metrics.timer("batch_flush_seconds", writer=self.name):
+            with self.db_conn.transaction():
+                self.db_conn.execute_sql_statement(*self.build_statement(self.pending))
+        metrics.increment("batch_rows_total", len(self.pending), writer=self.name)
+        self.pending = []
+        if self.on_flush is not None:
+            self.on_flush()
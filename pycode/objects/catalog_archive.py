@@ -0,0 +1,313 @@
+import base64
+import csv
+import datetime as dt
+import gzip
+import json
+import logging
+import os
+
+from pycode.objects.clipart_image import table_name as image_table_name
+from pycode.objects.token import table_name as token_table_name
+
+# Snapshots of the catalog tables as compressed files, for backups, moving a catalog between machines and reading it
+# into analysis tools. Tables are read through stream_sql_query and written a chunk at a time, and read back the same
+# way, so memory use stays the same however big the catalog is.
+#
+# Parquet and Arrow IPC files need pyarrow, which is only imported when one of them is read or written. Without it,
+# snapshots are written as gzipped CSV, with NULLs written as \N.
+#
+# Every export directory has a manifest listing the snapshots in it in the order they were taken. An incremental
+# snapshot only holds the rows added (by id) or posted (by posted_on) since the snapshot before it; importing replays
+# the newest full snapshot of a table and every incremental one after it. Skipping an image, marking it corrupted or
+# unposting it doesn't change either, so those only make it into the next full snapshot.
+
+formats = ("parquet", "arrow", "csv")
+file_extensions = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv.gz"}
+manifest_name = "manifest.json"
+csv_null = "\\N"
+
+# the columns of each table that go in a snapshot, with their types. Tables are exported and imported in this order.
+archived_columns = {
+    image_table_name: [("id", "int"), ("filename", "str"), ("origin_cd", "int"), ("subdirectories", "str"),
+                       ("original_file_extension", "str"), ("failed_to_save", "bool"), ("posted_on", "datetime"),
+                       ("position", "int"), ("source_hash", "str"), ("perceptual_hash", "uint64")],
+    # the tokens are the blog's OAuth credentials, so keep snapshots of them somewhere private
+    token_table_name: [("id", "int"), ("token", "bytes"), ("expires_on", "datetime")],
+}
+# which tables have a posted_on to pick up changed rows by in incremental snapshots
+posted_on_tables = [image_table_name]
+
+
+def is_pyarrow_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def get_default_format():
+    return "parquet" if is_pyarrow_available() else "csv"
+
+
+# rows in id order, or for an incremental snapshot only the ones with an id after after_id or posted at or after
+# posted_since. The OR can't use a single index, but it's one pass over the table either way.
+def get_snapshot_query(table, columns, after_id=None, posted_since=None):
+    where_clauses = []
+    values = []
+    if after_id is not None:
+        where_clauses.append("id > %s")
+        values.append(after_id)
+    if posted_since is not None:
+        where_clauses.append("posted_on >= %s")
+        values.append(posted_since)
+    where = f" WHERE {' OR '.join(where_clauses)}" if len(where_clauses) > 0 else ""
+    snapshot_query = f"SELECT {', '.join(columns)} FROM {table}{where} ORDER BY id;"
+    return snapshot_query, tuple(values)
+
+
+# a single multi-row INSERT for a batch of rows given as tuples in column order. With a dialect, rows whose id is
+# already in the table overwrite it instead, so replaying an incremental snapshot over rows it changed works.
+def get_bulk_copy_statement(table, columns, rows, dialect=None):
+    row_placeholder = "({0})".format(", ".join(['%s'] * len(columns)))
+    insert_statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([row_placeholder] * len(rows))}"
+    # the row that failed to go in is VALUES(x) to MySQL and excluded.x to SQLite, as in get_bulk_insert_statement
+    if dialect is not None:
+        new_value = "excluded.{0}" if dialect == "sqlite" else "VALUES({0})"
+        updates = ", ".join([f"{x} = {new_value.format(x)}" for x in columns if x != "id"])
+        insert_statement += f" ON CONFLICT (id) DO UPDATE SET {updates}" if dialect == "sqlite" \
+            else f" ON DUPLICATE KEY UPDATE {updates}"
+    return insert_statement + ";", [x for row in rows for x in row]
+
+
+# evens out what the backends hand back for the same column - MySQL gives booleans as 0 and 1 and blobs as
+# bytearrays, SQLite gives blobs back as text if they went in as text
+def normalize_value(value, column_type):
+    if value is None:
+        return None
+    if column_type == "bool":
+        return bool(value)
+    if column_type == "bytes":
+        return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+    return value
+
+
+def format_csv_value(value, column_type):
+    if value is None:
+        return csv_null
+    if column_type == "bool":
+        return "1" if value else "0"
+    if column_type == "datetime":
+        return value.isoformat(" ")
+    if column_type == "bytes":
+        return base64.b64encode(value).decode("ascii")
+    return str(value)
+
+
+def parse_csv_value(value, column_type):
+    if value == csv_null:
+        return None
+    if column_type in ("int", "uint64"):
+        return int(value)
+    if column_type == "bool":
+        return value == "1"
+    if column_type == "datetime":
+        return dt.datetime.fromisoformat(value)
+    if column_type == "bytes":
+        return base64.b64decode(value)
+    return value
+
+
+def get_arrow_schema(columns):
+    import pyarrow as pa
+
+    arrow_types = {"int": pa.int64(), "uint64": pa.uint64(), "str": pa.string(), "bool": pa.bool_(),
+                   "datetime": pa.timestamp("us"), "bytes": pa.binary()}
+    return pa.schema([(name, arrow_types[column_type]) for name, column_type in columns])
+
+
+# writes rows to a snapshot file a chunk at a time. Use it as a context manager so the file is finished properly.
+class SnapshotWriter:
+    def __init__(self, path, columns, file_format, compression="zstd"):
+        self.path = path
+        self.columns = columns
+        self.file_format = file_format
+        self.row_count = 0
+        if file_format == "csv":
+            self.file = gzip.open(path, "wt", newline="", encoding="utf-8")
+            self.csv_writer = csv.writer(self.file)
+            self.csv_writer.writerow([x[0] for x in columns])
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self.schema = get_arrow_schema(columns)
+            if file_format == "parquet":
+                self.arrow_writer = pq.ParquetWriter(path, self.schema, compression=compression)
+            else:
+                self.file = pa.OSFile(path, "wb")
+                self.arrow_writer = pa.ipc.new_file(self.file, self.schema,
+                                                    options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_rows(self, rows):
+        if len(rows) == 0:
+            return
+        if self.file_format == "csv":
+            self.csv_writer.writerows([[format_csv_value(normalize_value(x, column_type), column_type)
+                                        for x, (name, column_type) in zip(row, self.columns)] for row in rows])
+        else:
+            import pyarrow as pa
+
+            # one column at a time, the way Arrow stores them
+            arrays = [pa.array([normalize_value(row[index], column_type) for row in rows],
+                               type=self.schema.field(index).type)
+                      for index, (name, column_type) in enumerate(self.columns)]
+            self.arrow_writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.row_count += len(rows)
+
+    def close(self):
+        if self.file_format != "csv":
+            self.arrow_writer.close()
+        if self.file_format != "parquet":
+            self.file.close()
+
+
+# yields the rows of a snapshot file as tuples in column order, reading batch_size rows at a time
+def read_snapshot(path, columns, file_format, batch_size=10000):
+    names = [x[0] for x in columns]
+    if file_format == "csv":
+        with gzip.open(path, "rt", newline="", encoding="utf-8") as snapshot_file:
+            reader = csv.reader(snapshot_file)
+            header = next(reader)
+            if header != names:
+                raise ValueError(f"{path} has columns {header}; expected {names}")
+            for row in reader:
+                yield tuple(parse_csv_value(x, y[1]) for x, y in zip(row, columns))
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if file_format == "parquet":
+        batches = pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=names)
+        for batch in batches:
+            yield from zip(*[x.to_pylist() for x in batch.columns])
+    else:
+        # memory mapped, so only the batch being read is ever paged in
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for index in range(reader.num_record_batches):
+                # written with the same schema as columns, so they're already in order
+                batch = reader.get_batch(index)
+                yield from zip(*[x.to_pylist() for x in batch.columns])
+
+
+def load_manifest(directory):
+    manifest_path = os.path.join(directory, manifest_name)
+    if not os.path.exists(manifest_path):
+        return {"snapshots": []}
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+# written to a temporary name and moved into place, so a failed export never leaves half a manifest behind
+def save_manifest(directory, manifest):
+    manifest_path = os.path.join(directory, manifest_name)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+# exports one table into a snapshot file in directory and records it in the manifest. An incremental export starts
+# from where the table's last snapshot in the manifest left off; if there isn't one, it's a full export.
+def export_table(db_conn, table, directory, file_format, incremental=False, chunk_size=10000):
+    columns = archived_columns[table]
+    manifest = load_manifest(directory)
+    previous = next((x for x in reversed(manifest["snapshots"]) if x["table"] == table), None)
+    mode = "incremental" if incremental and previous is not None else "full"
+    after_id = previous["max_id"] if mode == "incremental" else None
+    posted_since = dt.datetime.fromisoformat(previous["started_on"]) \
+        if mode == "incremental" and table in posted_on_tables else None
+
+    # taken before the query runs, so anything posted while it runs is picked up again by the next incremental
+    # snapshot rather than missed
+    started_on = dt.datetime.now()
+    filename = f"{table}-{started_on:%Y%m%d-%H%M%S-%f}-{mode}{file_extensions[file_format]}"
+    path = os.path.join(directory, filename)
+    logging.info("Exporting {0} to {1}...".format(table, filename))
+
+    snapshot_query = get_snapshot_query(table, [x[0] for x in columns], after_id, posted_since)
+    last_id = None
+    try:
+        with SnapshotWriter(path + ".tmp", columns, file_format) as writer:
+            rows = []
+            for row in db_conn.stream_sql_query(*snapshot_query, chunk_size=chunk_size):
+                rows.append(row)
+                last_id = row[0]
+                if len(rows) >= chunk_size:
+                    writer.write_rows(rows)
+                    rows = []
+            writer.write_rows(rows)
+    except BaseException:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+    os.replace(path + ".tmp", path)
+    # rows come out in id order, so the last one has the highest id
+    max_id = last_id if last_id is not None and (after_id is None or last_id > after_id) else after_id
+
+    snapshot = {"table": table, "file": filename, "format": file_format, "mode": mode, "rows": writer.row_count,
+                "max_id": max_id, "started_on": started_on.isoformat(" ")}
+    manifest["snapshots"].append(snapshot)
+    save_manifest(directory, manifest)
+    logging.info("Exported {0} rows of {1}".format(writer.row_count, table))
+    return snapshot
+
+
+# the snapshots to replay to restore a table: its newest full snapshot and every incremental one after it
+def get_restore_chain(manifest, table):
+    snapshots = [x for x in manifest["snapshots"] if x["table"] == table]
+    full_indexes = [index for index, x in enumerate(snapshots) if x["mode"] == "full"]
+    if len(full_indexes) == 0:
+        return []
+    return snapshots[full_indexes[-1]:]
+
+
+def get_row_count(db_conn, table):
+    return db_conn.execute_sql_query(f"SELECT COUNT(*) FROM {table};")[0][0]
+
+
+# loads a table from the snapshots in directory, in a single transaction, in multi-row inserts of batch_size rows. The
+# table has to be empty unless replace is set, in which case it's cleared first.
+def import_table(db_conn, table, directory, batch_size=1000, replace=False):
+    columns = archived_columns[table]
+    names = [x[0] for x in columns]
+    chain = get_restore_chain(load_manifest(directory), table)
+    if len(chain) == 0:
+        raise ValueError(f"No full snapshot of {table} in {directory}")
+    existing_count = get_row_count(db_conn, table)
+    if existing_count > 0 and not replace:
+        raise ValueError(f"The {table} table already has {existing_count} rows; use --replace to overwrite")
+
+    with db_conn.transaction():
+        if existing_count > 0:
+            db_conn.execute_sql_statement(f"DELETE FROM {table};")
+        for snapshot in chain:
+            logging.info("Importing {0}...".format(snapshot["file"]))
+            # the full snapshot goes into an empty table; incremental ones overwrite the rows they changed
+            dialect = db_conn.dialect if snapshot["mode"] == "incremental" else None
+            with db_conn.get_batch_writer(lambda rows: get_bulk_copy_statement(table, names, rows, dialect),
+                                          batch_size, name=f"import_{table}") as writer:
+                for row in read_snapshot(os.path.join(directory, snapshot["file"]), columns, snapshot["format"]):
+                    writer.add(row)
+
+    if len(chain) == 1 and get_row_count(db_conn, table) != chain[0]["rows"]:
+        raise ValueError(f"The snapshot of {table} has {chain[0]['rows']} rows, but the table now has "
+                         f"{get_row_count(db_conn, table)}")
+    logging.info("Imported {0} from {1} snapshots".format(table, len(chain)))
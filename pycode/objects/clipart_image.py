@@ -1,16 +1,89 @@
 import datetime as dt
+import logging
 import os.path
+import random
 
 # various statements and queries associated with the Image Record class but kept outside of it so we can use them
 # without instantiating a record first.
 table_name = "clipart"
-create_image_table_statement = "CREATE TABLE IF NOT EXISTS {0} (id INT AUTO_INCREMENT PRIMARY KEY," \
-                               "filename VARCHAR(255) NOT NULL," \
-                               "origin_cd INT NOT NULL, " \
-                               "subdirectories VARCHAR(100), " \
-                               "original_file_extension VARCHAR(5), " \
-                               "failed_to_save BOOLEAN, " \
-                               "posted_on DATETIME);".format(table_name)
+# every image format convert.py saves, by the extension of the converted file
+mimetypes_by_extension = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".gif": "image/gif"}
+# skipped images are marked by giving them this posted_on, so they sort before every real post
+skipped_posted_on = dt.datetime(1970, 1, 1)
+# the columns get_bulk_insert_statement writes, i.e. every column but id
+image_columns = ['filename', 'origin_cd', 'subdirectories', 'original_file_extension', 'failed_to_save', 'posted_on',
+                 'position', 'source_hash', 'perceptual_hash']
+# statements that create the table, per SQL dialect (see DatabaseConnection.dialect). SQLite has no unsigned 64-bit
+# type, so perceptual_hash is declared as SqliteConnection's UINT64, which it converts back from the signed value it's
+# stored as.
+create_image_table_statements = {
+    "mysql": ["CREATE TABLE IF NOT EXISTS {0} (id INT AUTO_INCREMENT PRIMARY KEY,"
+              "filename VARCHAR(255) NOT NULL,"
+              "origin_cd INT NOT NULL, "
+              "subdirectories VARCHAR(100), "
+              "original_file_extension VARCHAR(5), "
+              "failed_to_save BOOLEAN, "
+              "posted_on DATETIME, "
+              "position INT, "
+              "source_hash CHAR(64), "
+              "perceptual_hash BIGINT UNSIGNED, "
+              "UNIQUE KEY file_data_key (filename, origin_cd, subdirectories), "
+              "KEY fresh_images_key (posted_on, failed_to_save), "
+              "KEY subdirectories_key (subdirectories), "
+              "KEY nearby_key (origin_cd, subdirectories, position), "
+              "KEY source_hash_key (source_hash));".format(table_name)],
+    "sqlite": [f"CREATE TABLE IF NOT EXISTS {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+               "filename VARCHAR(255) NOT NULL, "
+               "origin_cd INT NOT NULL, "
+               "subdirectories VARCHAR(100), "
+               "original_file_extension VARCHAR(5), "
+               "failed_to_save BOOLEAN, "
+               "posted_on DATETIME, "
+               "position INT, "
+               "source_hash CHAR(64), "
+               "perceptual_hash UINT64);",
+               f"CREATE UNIQUE INDEX IF NOT EXISTS file_data_key ON {table_name} (filename, origin_cd, subdirectories);",
+               f"CREATE INDEX IF NOT EXISTS fresh_images_key ON {table_name} (posted_on, failed_to_save);",
+               f"CREATE INDEX IF NOT EXISTS subdirectories_key ON {table_name} (subdirectories);",
+               f"CREATE INDEX IF NOT EXISTS nearby_key ON {table_name} (origin_cd, subdirectories, position);",
+               f"CREATE INDEX IF NOT EXISTS source_hash_key ON {table_name} (source_hash);"],
+}
+
+
+# columns added after the table was first created, in the order they appear in the table (which is the order
+# ClipartImage takes them in), per dialect. Each entry is (column name, statements that add it);
+# DatabaseConnection.set_up_tables runs these before the index migrations below, since some of those indexes cover new
+# columns. SQLite catalogs have only ever been created with every column, so there's nothing to migrate there yet.
+image_column_migrations = {"mysql": [
+    ("position", [
+        f"ALTER TABLE {table_name} ADD COLUMN position INT;",
+        f"UPDATE {table_name} c JOIN (SELECT id, ROW_NUMBER() OVER "
+        f"(PARTITION BY origin_cd, subdirectories ORDER BY filename) - 1 AS new_position FROM {table_name}) numbered "
+        f"ON c.id = numbered.id SET c.position = numbered.new_position;"]),
+    # blake2b digest of the source file's bytes, filled in by convert.py as it works through the CDs
+    ("source_hash", [f"ALTER TABLE {table_name} ADD COLUMN source_hash CHAR(64);"]),
+    # 64-bit difference hash of the converted image, see perceptual_hash.py. Filled in for images converted before it
+    # existed by compute_perceptual_hashes.py.
+    ("perceptual_hash", [f"ALTER TABLE {table_name} ADD COLUMN perceptual_hash BIGINT UNSIGNED;"]),
+], "sqlite": []}
+
+# indexes added after the table was first created, per dialect. Each entry is (index name, statements that create it);
+# DatabaseConnection.set_up_tables runs the statements for any index the table doesn't have yet.
+# Records that were inserted twice before file_data_key existed are collapsed onto the oldest one first, otherwise the
+# unique key can't be built.
+image_index_migrations = {"mysql": [
+    ("file_data_key", [
+        f"DELETE newer FROM {table_name} newer JOIN {table_name} older ON newer.filename = older.filename "
+        f"AND newer.origin_cd = older.origin_cd AND newer.subdirectories <=> older.subdirectories "
+        f"AND newer.id > older.id;",
+        f"ALTER TABLE {table_name} ADD UNIQUE KEY file_data_key (filename, origin_cd, subdirectories);"]),
+    # (posted_on, failed_to_save) covers both the fresh image lookups and sorting by posted_on for recent posts. InnoDB
+    # appends the primary key to every secondary index, so rows within it are also in id order.
+    ("fresh_images_key", [f"ALTER TABLE {table_name} ADD KEY fresh_images_key (posted_on, failed_to_save);"]),
+    ("subdirectories_key", [f"ALTER TABLE {table_name} ADD KEY subdirectories_key (subdirectories);"]),
+    ("nearby_key", [f"ALTER TABLE {table_name} ADD KEY nearby_key (origin_cd, subdirectories, position);"]),
+    ("source_hash_key", [f"ALTER TABLE {table_name} ADD KEY source_hash_key (source_hash);"]),
+], "sqlite": []}
 
 
 # parameters in the methods below are to force user to be aware that values also have to be provided with these queries
@@ -29,25 +102,172 @@ def get_image_by_id_query(id):
     return image_by_id_query, (id,)
 
 
-# gets a random image from the database that has not been posted yet, and optionally allows the user to provide
+# gets the images within `radius` positions of the given one in the same directory, in directory order
+def get_nearby_images_query(origin_cd, subdirectories, position, radius):
+    nearby_images_query = f"SELECT * FROM {table_name} WHERE origin_cd = %s AND subdirectories = %s " \
+                          f"AND position BETWEEN %s AND %s AND position != %s ORDER BY position;"
+    return nearby_images_query, (origin_cd, subdirectories, position - radius, position + radius, position)
+
+
+# used to stream the (subdirectories, filename) keys of every record from a CD, along with whether it failed to save and
+# whether its source hash is known, in chunks, resuming after the last id seen in the previous chunk
+def get_image_keys_by_cd_query(origin_cd, after_id, limit):
+    image_keys_query = f"SELECT id, subdirectories, filename, failed_to_save, source_hash IS NOT NULL " \
+                       f"FROM {table_name} " \
+                       f"WHERE origin_cd = %s AND id > %s " \
+                       f"ORDER BY id LIMIT %s;"
+    return image_keys_query, (origin_cd, after_id, limit)
+
+
+# selects every successfully converted image, optionally just the ones from a single CD. Meant to be run through
+# db_conn.stream_sql_query, since without a CD it covers the whole catalog.
+def get_converted_images_query(origin_cd=None):
+    where_clauses = ["failed_to_save = 0"]
+    values = []
+    if origin_cd is not None:
+        where_clauses.append("origin_cd = %s")
+        values.append(origin_cd)
+    converted_images_query = f"SELECT * FROM {table_name} WHERE {' AND '.join(where_clauses)};"
+    return converted_images_query, tuple(values)
+
+
+# the output of every successful conversion whose source hash is known, for convert.py's ConversionCache. Meant to be
+# run through db_conn.stream_sql_query.
+converted_hashes_query = f"SELECT source_hash, subdirectories, filename, perceptual_hash FROM {table_name} " \
+                         f"WHERE source_hash IS NOT NULL AND failed_to_save = 0;"
+
+# every record converted from a source file that's byte-for-byte identical to another record's, one row per record as
+# (source hash, records with that hash, origin_cd, subdirectories, filename). Sets of identical records come out next to
+# each other, largest first, so they can be grouped while streaming. Meant to be run through db_conn.stream_sql_query.
+duplicate_images_query = f"SELECT c.source_hash, duplicates.copies, c.origin_cd, c.subdirectories, c.filename " \
+                         f"FROM {table_name} c JOIN (SELECT source_hash, COUNT(*) AS copies FROM {table_name} " \
+                         f"WHERE source_hash IS NOT NULL GROUP BY source_hash HAVING COUNT(*) > 1) duplicates " \
+                         f"ON c.source_hash = duplicates.source_hash " \
+                         f"ORDER BY duplicates.copies DESC, c.source_hash, c.origin_cd, c.id;"
+
+
+# numbers every file within each of a CD's directories by filename, starting at 0. convert.py reruns this at the end of
+# each CD, so positions stay stable no matter what order the filesystem lists files in.
+def get_renumber_positions_statement(origin_cd, dialect="mysql"):
+    numbered_query = f"SELECT id, ROW_NUMBER() OVER (PARTITION BY subdirectories ORDER BY filename) - 1 " \
+                     f"AS new_position FROM {table_name} WHERE origin_cd = %s"
+    if dialect == "sqlite":
+        renumber_statement = f"UPDATE {table_name} SET position = numbered.new_position " \
+                             f"FROM ({numbered_query}) AS numbered WHERE {table_name}.id = numbered.id;"
+    else:
+        renumber_statement = f"UPDATE {table_name} c JOIN ({numbered_query}) numbered ON c.id = numbered.id " \
+                             f"SET c.position = numbered.new_position;"
+    return renumber_statement, (origin_cd,)
+
+
+# builds a single multi-row INSERT for a list of ClipartImages, so a whole batch of records costs one round-trip.
+# Rows that collide with an existing record on file_data_key are upserted: the columns in update_columns are overwritten
+# with the new values, the ones in fill_columns only where the new value isn't NULL, and if there are neither the
+# existing record is left untouched.
+def get_bulk_insert_statement(images, update_columns=None, fill_columns=None, dialect="mysql"):
+    row_placeholder = "({0})".format(", ".join(['%s'] * len(image_columns)))
+    values = []
+    for image in images:
+        values.extend([image.filename, image.origin_cd, image.subdirectories, image.original_file_extension,
+                       image.failed_to_save, image.posted_on, image.position, image.source_hash,
+                       image.perceptual_hash])
+
+    # the row that failed to go in is VALUES(x) to MySQL and excluded.x to SQLite
+    new_value = "excluded.{0}" if dialect == "sqlite" else "VALUES({0})"
+    updates = [f"{x} = {new_value.format(x)}" for x in update_columns or []] + \
+              [f"{x} = COALESCE({new_value.format(x)}, {x})" for x in fill_columns or []]
+    if dialect == "sqlite":
+        on_conflict = f"ON CONFLICT (filename, origin_cd, subdirectories) DO UPDATE SET {', '.join(updates)}" \
+            if len(updates) > 0 else "ON CONFLICT DO NOTHING"
+    else:
+        on_conflict = f"ON DUPLICATE KEY UPDATE {', '.join(updates) if len(updates) > 0 else 'id = id'}"
+
+    insert_statement = f"INSERT INTO {table_name} ({', '.join(image_columns)}) VALUES " \
+                       f"{', '.join([row_placeholder] * len(images))} {on_conflict};"
+    return insert_statement, values
+
+
+# sets the perceptual hash of many records at once, from a list of (id, perceptual hash) pairs
+def get_bulk_update_perceptual_hash_statement(hashes):
+    update_statement = f"UPDATE {table_name} SET perceptual_hash = CASE id " \
+                       f"{' '.join(['WHEN %s THEN %s'] * len(hashes))} END " \
+                       f"WHERE id IN ({', '.join(['%s'] * len(hashes))});"
+    values = [x for pair in hashes for x in pair] + [x[0] for x in hashes]
+    return update_statement, values
+
+
+# marks many images as skipped at once, like ClipartImage.get_update_image_mark_skipped_statement
+def get_bulk_mark_skipped_statement(ids):
+    update_statement = f"UPDATE {table_name} SET posted_on = %s WHERE id IN ({', '.join(['%s'] * len(ids))});"
+    return update_statement, [skipped_posted_on] + list(ids)
+
+
+# marks many images as corrupted at once, like ClipartImage.get_update_image_mark_corrupted_statement
+def get_bulk_mark_corrupted_statement(ids):
+    update_statement = f"UPDATE {table_name} SET failed_to_save = TRUE WHERE id IN ({', '.join(['%s'] * len(ids))});"
+    return update_statement, tuple(ids)
+
+
+# converted images that don't have a perceptual hash yet, for compute_perceptual_hashes.py. Meant to be run through
+# db_conn.stream_sql_query.
+def get_images_missing_perceptual_hash_query(origin_cd=None):
+    where_clauses = ["failed_to_save = 0", "perceptual_hash IS NULL"]
+    values = []
+    if origin_cd is not None:
+        where_clauses.append("origin_cd = %s")
+        values.append(origin_cd)
+    missing_hash_query = f"SELECT id, subdirectories, filename FROM {table_name} WHERE {' AND '.join(where_clauses)};"
+    return missing_hash_query, tuple(values)
+
+
+perceptual_hashes_query = f"SELECT id, perceptual_hash FROM {table_name} " \
+                          f"WHERE perceptual_hash IS NOT NULL AND failed_to_save = 0;"
+
+
+def get_images_by_ids_query(ids):
+    images_query = f"SELECT * FROM {table_name} WHERE id IN ({', '.join(['%s'] * len(ids))});"
+    return images_query, tuple(ids)
+
+
+id_range_query = f"SELECT MIN(id), MAX(id) FROM {table_name};"
+
+
+# gets the first image at or after the given id that has not been posted yet, and optionally allows the user to provide
 # subdirectories to exclude - like, for instance, the last N subdirectories that posts came from, to avoid
-# repetitiveness
-# TODO maybe modify this to just directly query the last N posts rather than asking the user to provide them
-def get_random_fresh_image_query(skip_subdirectories=None):
+# repetitiveness. Probing from a random id walks fresh_images_key from that point rather than sorting the whole
+# unposted catalog like ORDER BY RAND() did.
+def get_random_fresh_image_query(start_id, skip_subdirectories=None):
     select_statement = f"SELECT * FROM {table_name} "
 
-    where_clauses = ["posted_on IS NULL", "failed_to_save != 1"]
+    where_clauses = ["posted_on IS NULL", "failed_to_save = 0", "id >= %s"]
+    values = [start_id]
     if skip_subdirectories is not None and len(skip_subdirectories) > 0:
-        where_clauses.append(
-            "subdirectories NOT IN ({0})".format(",".join(["'{0}'".format(x) for x in skip_subdirectories])))
+        where_clauses.append("subdirectories NOT IN ({0})".format(", ".join(["%s"] * len(skip_subdirectories))))
+        values.extend(skip_subdirectories)
+
+    select_statement += "WHERE {0} ORDER BY id LIMIT 1;".format(" AND ".join(where_clauses))
+    return select_statement, tuple(values)
+
+
+# picks a random fresh image record by probing from a random id in the table's id range, wrapping around to the start
+# if nothing qualifies after that point. Images that sit right after a long run of posted or excluded ids are a bit more
+# likely to come up, which is fine for picking something to post. Returns None if there are no fresh images left.
+# TODO maybe modify this to just directly query the last N posts rather than asking the user to provide them
+def pick_random_fresh_image(db_conn, skip_subdirectories=None):
+    min_id, max_id = db_conn.execute_sql_query(id_range_query)[0]
+    if min_id is None:
+        return None
 
-    select_statement += "WHERE {0} ORDER BY RAND() LIMIT 1;".format(" AND ".join(where_clauses))
-    return select_statement
+    start_id = random.randint(min_id, max_id)
+    records = db_conn.execute_sql_query(*get_random_fresh_image_query(start_id, skip_subdirectories))
+    if len(records) == 0 and start_id > min_id:
+        records = db_conn.execute_sql_query(*get_random_fresh_image_query(min_id, skip_subdirectories))
+    return records[0] if len(records) > 0 else None
 
 
 class ClipartImage:
     def __init__(self, id=None, filename=None, origin_cd=None, subdirectories=None, original_file_extension=None,
-                 failed_to_save=False, posted_on=None):
+                 failed_to_save=False, posted_on=None, position=None, source_hash=None, perceptual_hash=None):
         self.id = id
         self.filename = filename
         self.origin_cd = origin_cd
@@ -55,6 +275,9 @@ class ClipartImage:
         self.original_file_extension = original_file_extension
         self.failed_to_save = failed_to_save
         self.posted_on = posted_on
+        self.position = position
+        self.source_hash = source_hash
+        self.perceptual_hash = perceptual_hash
 
         # fields only used when actively posting to tumblr; do not need to persist this data in the db
         self.mimetype = self.convert_file_extension_to_mimetype()
@@ -70,7 +293,7 @@ class ClipartImage:
     def __repr__(self):
         return f"ClipartImage(id={self.id}, filename={self.filename}, origin_cd={self.origin_cd}, " \
                f"subdirectories={self.subdirectories}, original_file_extension={self.original_file_extension}, " \
-               f"failed_to_save={self.failed_to_save}, posted_on={self.posted_on})"
+               f"failed_to_save={self.failed_to_save}, posted_on={self.posted_on}, position={self.position})"
 
     def get_insert_statement(self):
         columns = ['filename', 'origin_cd', 'subdirectories', 'original_file_extension', 'failed_to_save']
@@ -87,39 +310,39 @@ class ClipartImage:
         return update_statement, (self.id,)
 
     def get_update_image_mark_posted_statement(self):
-        update_statement = f"UPDATE {table_name} SET posted_on = NOW() WHERE id = %s;"
+        update_statement = f"UPDATE {table_name} SET posted_on = %s WHERE id = %s;"
+        return update_statement, (dt.datetime.now(), self.id)
+
+    # queued posts hold their images by setting posted_on to when they're due to go out, so they aren't offered for
+    # another post in the meantime and count towards the recent subdirectories right away
+    def get_update_image_mark_scheduled_statement(self, target_time):
+        update_statement = f"UPDATE {table_name} SET posted_on = %s WHERE id = %s;"
+        return update_statement, (target_time, self.id)
+
+    # puts an image back up for posting, e.g. when the queued post holding it failed for good
+    def get_update_image_mark_unposted_statement(self):
+        update_statement = f"UPDATE {table_name} SET posted_on = NULL WHERE id = %s;"
         return update_statement, (self.id,)
 
     def get_update_image_mark_skipped_statement(self):
-        beginning_of_time = dt.datetime.utcfromtimestamp(0)
         update_statement = f"UPDATE {table_name} SET posted_on = %s WHERE id = %s;"
-        return update_statement, (beginning_of_time.isoformat(), self.id)
+        return update_statement, (skipped_posted_on, self.id)
 
     def convert_file_extension_to_mimetype(self):
-        # TODO implement for all file extensions
         name, extension = os.path.splitext(self.filename)
         extension = extension.lower()
-        if extension == ".jpg" or extension == ".png":
-            return "image/jpeg"
-        else:
+        if extension not in mimetypes_by_extension:
             raise ValueError(f"Unknown file extension '{extension}' for file {self.filename}")
+        return mimetypes_by_extension[extension]
 
     def get_converted_image_path(self, main_photo_dir):
         return os.path.join(main_photo_dir, self.subdirectories, self.filename)
 
-    def get_nearby_files(self, main_photo_dir):
-        image_path = self.get_converted_image_path(main_photo_dir)
-        directory, filename = os.path.split(image_path)
-        dir_content = os.listdir(directory)
-        file_index = None
-        for index, fq_filepath in enumerate(dir_content):
-            if fq_filepath == filename:
-                file_index = index
-                break
-
-        if file_index is None:
-            raise ValueError(f"Could not find file {filename} in directory {directory}")
-
-        lower_bound = max(0, file_index - 20)
-        upper_bound = min(len(dir_content), file_index + 21)
-        return dir_content[lower_bound:file_index] + dir_content[file_index + 1:upper_bound]
+    # returns the records of up to `radius` images on either side of this one in its directory. Positions are
+    # assigned by convert.py, so this is a range lookup on nearby_key rather than a listing of the directory.
+    def get_nearby_records(self, db_conn, radius=20):
+        if self.position is None:
+            logging.warning(f"Image {self.id} has no directory position yet; rerun convert.py for CD {self.origin_cd}")
+            return []
+        return db_conn.execute_sql_query(*get_nearby_images_query(self.origin_cd, self.subdirectories, self.position,
+                                                                  radius))
@@ -0,0 +1,90 @@
+from PIL import Image, ImageDraw, ImageFont
+
+
+class ContactSheetTile:
+    def __init__(self, key, thumbnail, caption, enabled=True):
+        self.key = key
+        # None if the image couldn't be loaded; the tile is drawn as a blank with its caption
+        self.thumbnail = thumbnail
+        self.caption = caption
+        self.enabled = enabled
+
+
+# A grid of downscaled thumbnails composited into one image, with a caption under each, so a whole set of candidates
+# can be shown as a single PhotoImage instead of a widget (and a decode) per file. Tiles are laid out left to right,
+# top to bottom in the order given. Disabled tiles are washed out, and get_index_at skips them by default, so they can't
+# be picked.
+#
+# Building the sheet only needs Pillow, so it can happen on a background thread; the Tk thread only has to wrap the
+# finished image in a PhotoImage.
+class ContactSheet:
+    def __init__(self, tiles, tile_size=(128, 128), columns=7, caption_height=18, padding=6, background="white"):
+        self.tiles = tiles
+        self.tile_size = tile_size
+        self.columns = max(1, min(columns, len(tiles)))
+        self.rows = (len(tiles) + self.columns - 1) // self.columns
+        self.caption_height = caption_height
+        self.padding = padding
+        self.background = background
+        # distance from the top left of one cell to the top left of the next
+        self.cell_width = self.tile_size[0] + self.padding
+        self.cell_height = self.tile_size[1] + self.caption_height + self.padding
+        self.image = None
+
+    def get_size(self):
+        return self.padding + self.columns * self.cell_width, self.padding + self.rows * self.cell_height
+
+    # the (left, top, right, bottom) box of a tile and its caption on the sheet
+    def get_cell_box(self, index):
+        left = self.padding + (index % self.columns) * self.cell_width
+        top = self.padding + (index // self.columns) * self.cell_height
+        return left, top, left + self.tile_size[0], top + self.tile_size[1] + self.caption_height
+
+    # the index of the tile at a point on the sheet, or None if the point is on the padding between tiles, past the last
+    # one, or on a disabled tile (unless include_disabled). Worked out from the grid rather than searched for.
+    def get_index_at(self, x, y, include_disabled=False):
+        column, column_offset = divmod(x - self.padding, self.cell_width)
+        row, row_offset = divmod(y - self.padding, self.cell_height)
+        if column < 0 or row < 0 or column >= self.columns or column_offset >= self.tile_size[0] \
+                or row_offset >= self.tile_size[1] + self.caption_height:
+            return None
+        index = int(row * self.columns + column)
+        if index >= len(self.tiles) or not (self.tiles[index].enabled or include_disabled):
+            return None
+        return index
+
+    def build(self):
+        self.image = Image.new("RGB", self.get_size(), self.background)
+        draw = ImageDraw.Draw(self.image)
+        font = ImageFont.load_default()
+        for index, tile in enumerate(self.tiles):
+            left, top, right, bottom = self.get_cell_box(index)
+            if tile.thumbnail is not None:
+                cell = self.get_tile_image(tile)
+                # centred in the space above the caption
+                self.image.paste(cell, (left + (self.tile_size[0] - cell.width) // 2,
+                                        top + (self.tile_size[1] - cell.height) // 2))
+            else:
+                draw.rectangle((left, top, right - 1, top + self.tile_size[1] - 1), outline="gray")
+            draw.text((left, top + self.tile_size[1] + 2), self.fit_caption(draw, tile.caption, font),
+                      fill="black" if tile.enabled else "gray", font=font)
+        return self.image
+
+    # the thumbnail shrunk to fit a tile and flattened onto the background, washed out if the tile is disabled
+    def get_tile_image(self, tile):
+        thumbnail = tile.thumbnail.copy()
+        thumbnail.thumbnail(self.tile_size)
+        thumbnail = thumbnail.convert("RGBA")
+        cell = Image.new("RGB", thumbnail.size, self.background)
+        cell.paste(thumbnail, mask=thumbnail)
+        if not tile.enabled:
+            cell = Image.blend(cell, Image.new("RGB", cell.size, self.background), 0.6)
+        return cell
+
+    # cuts the caption short with an ellipsis if it's wider than a tile
+    def fit_caption(self, draw, caption, font):
+        if draw.textlength(caption, font=font) <= self.tile_size[0]:
+            return caption
+        while len(caption) > 0 and draw.textlength(caption + "...", font=font) > self.tile_size[0]:
+            caption = caption[:-1]
+        return caption + "..."
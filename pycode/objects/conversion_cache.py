@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import os
+import shutil
+
+from pycode.objects import metrics
+from pycode.objects.clipart_image import converted_hashes_query
+
+
+# blake2b digest of a file's bytes, read chunk_size bytes at a time so large files never have to fit in memory. This is
+# the one full read of each source file convert.py does itself, so it's timed as the "read" stage.
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=32)
+    byte_count = 0
+    with metrics.timer("conversion_stage_seconds", stage="read"):
+        with open(path, "rb") as source_file:
+            while True:
+                chunk = source_file.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                byte_count += len(chunk)
+    metrics.increment("source_bytes_read_total", byte_count)
+    return digest.hexdigest()
+
+
+# hardlinks destination to source, falling back to a copy where links aren't possible (e.g. across drives). Anything
+# already at destination is replaced.
+def link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+# Index from the hash of a source file's bytes to the file it was converted into, so convert.py can satisfy source files
+# that are byte-for-byte copies of ones it's already converted - the same artwork often ships in several directories or
+# on several CDs - by linking to the existing output instead of decoding and encoding it again.
+#
+# Duplicates of a file that's still being converted are parked until its result comes back, since the output doesn't
+# exist yet. Everything here runs on the converter's main thread, so none of it needs locking.
+class ConversionCache:
+    def __init__(self, thumbnail_store):
+        self.thumbnail_store = thumbnail_store
+        # source hash -> (output location, thumbnail path, perceptual hash)
+        self.outputs_by_hash = {}
+        self.converting = {}
+
+    # loads the output of every successful conversion recorded in the catalog
+    def load(self, db_conn, output_base_dir):
+        for source_hash, subdirectories, filename, perceptual_hash in db_conn.stream_sql_query(converted_hashes_query):
+            self.outputs_by_hash[source_hash] = (os.path.join(output_base_dir, subdirectories or "", filename),
+                                                 self.thumbnail_store.get_thumbnail_path(subdirectories, filename),
+                                                 perceptual_hash)
+        logging.info("Loaded {0} converted source hashes".format(len(self.outputs_by_hash)))
+
+    # returns the existing (output location, thumbnail path, perceptual hash) for the same source bytes as the job, if
+    # there's one that can stand in for the job's output
+    def get_output(self, job):
+        existing_output = self.outputs_by_hash.get(job.source_hash)
+        if existing_output is None or existing_output[0] == job.output_location:
+            return None
+        if os.path.splitext(existing_output[0])[1].lower() != os.path.splitext(job.output_location)[1].lower():
+            return None
+        if not os.path.exists(existing_output[0]):
+            del self.outputs_by_hash[job.source_hash]
+            return None
+        return existing_output
+
+    def add_output(self, job, perceptual_hash):
+        self.outputs_by_hash[job.source_hash] = (job.output_location, job.thumbnail_path, perceptual_hash)
+
+    # gives the job its output (and thumbnail, if there is one) by linking to an existing one from get_output
+    @staticmethod
+    def link_output(job, existing_output):
+        existing_location, existing_thumbnail_path = existing_output[:2]
+        link_or_copy(existing_location, job.output_location)
+        if job.thumbnail_path is not None and existing_thumbnail_path is not None and \
+                os.path.exists(existing_thumbnail_path):
+            os.makedirs(os.path.dirname(job.thumbnail_path), exist_ok=True)
+            link_or_copy(existing_thumbnail_path, job.thumbnail_path)
+
+    def is_converting(self, source_hash):
+        return source_hash in self.converting
+
+    def start(self, job):
+        self.converting[job.source_hash] = []
+
+    def park(self, job):
+        self.converting[job.source_hash].append(job)
+
+    # called with the result of a job passed to start(); returns the jobs that were parked behind it
+    def finish(self, result):
+        parked_jobs = self.converting.pop(result.job.source_hash, [])
+        if not result.failed:
+            self.add_output(result.job, result.perceptual_hash)
+        return parked_jobs
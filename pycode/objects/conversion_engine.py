@@ -0,0 +1,284 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+from wand.image import Image as wima
+
+from pycode.objects import metrics
+from pycode.objects.backend_router import backends, BackendRouter
+from pycode.objects.perceptual_hash import compute_dhash, compute_file_dhash
+from pycode.objects.thumbnail_store import ThumbnailStore
+
+
+# Each backend saves the file and returns its perceptual hash, or raises if it can't read the file. The thumbnail and
+# the perceptual hash are made from the image that's already decoded when Pillow handles the file.
+# Pillow only decodes once the pixels are needed, so it's made to load them up front to time decoding apart from saving.
+def convert_with_pillow(input_location, output_location, output_format, thumbnail_store, thumbnail_path):
+    with Image.open(input_location) as im:
+        with metrics.timer("conversion_stage_seconds", stage="decode", backend="pillow"):
+            im.load()
+        with metrics.timer("conversion_stage_seconds", stage="encode", backend="pillow"):
+            im.save(output_location, output_format)
+        if thumbnail_store is not None:
+            save_thumbnail(thumbnail_store, im, output_location, thumbnail_path)
+        return get_perceptual_hash(im, output_location)
+
+
+def convert_with_wand(input_location, output_location, output_format, thumbnail_store, thumbnail_path):
+    with metrics.timer("conversion_stage_seconds", stage="decode", backend="wand"):
+        im = wima(filename=input_location)
+    with im:
+        with metrics.timer("conversion_stage_seconds", stage="encode", backend="wand"):
+            im.save(filename=output_location)
+    if thumbnail_store is not None:
+        save_thumbnail(thumbnail_store, None, output_location, thumbnail_path)
+    return get_perceptual_hash(None, output_location)
+
+
+converters_by_backend = {"pillow": convert_with_pillow, "wand": convert_with_wand}
+
+
+# runs in a worker process, so it has to live at module level to be picklable. Tries each backend in backend_order until
+# one succeeds and returns (attempts, perceptual_hash), where attempts is a list of (backend, seconds, error) for every
+# backend tried; error is None for the one that worked, if any did. Errors are returned as strings since not every
+# exception raised by Pillow or ImageMagick can be pickled back to the parent process.
+# If thumbnail_path is given, a preview thumbnail is written there too.
+def convert_file(input_location, output_location, output_format, thumbnail_path=None, thumbnail_size=None,
+                 backend_order=backends):
+    thumbnail_store = ThumbnailStore(None, thumbnail_size) if thumbnail_path is not None else None
+    attempts = []
+    for backend in backend_order:
+        started_at = time.perf_counter()
+        try:
+            perceptual_hash = converters_by_backend[backend](input_location, output_location, output_format,
+                                                             thumbnail_store, thumbnail_path)
+        except Exception as e:
+            attempts.append((backend, time.perf_counter() - started_at, str(e)))
+            continue
+        attempts.append((backend, time.perf_counter() - started_at, None))
+        return attempts, perceptual_hash
+    return attempts, None
+
+
+# converts a whole batch of files in one call, so a worker process can be handed many files per round-trip instead of
+# one - see ConversionEngine.wand_batch_size. Takes a list of convert_file's arguments and returns the list of its
+# results, along with the metrics the worker recorded for them (None with metrics disabled).
+def convert_files(file_arguments):
+    return [convert_file(*x) for x in file_arguments], metrics.drain()
+
+
+# like the thumbnail, a missing perceptual hash is filled in later (by compute_perceptual_hashes.py), so failing to
+# compute one never fails the conversion
+def get_perceptual_hash(image, output_location):
+    try:
+        with metrics.timer("conversion_stage_seconds", stage="perceptual_hash"):
+            if image is not None:
+                return compute_dhash(image)
+            return compute_file_dhash(output_location)
+    except Exception as e:
+        logging.warning("Could not compute perceptual hash for {0}: {1}".format(output_location, e))
+        return None
+
+
+# a missing thumbnail gets made later by the GUI or the backfill script, so failing to write one never fails the
+# conversion itself
+def save_thumbnail(thumbnail_store, image, output_location, thumbnail_path):
+    try:
+        with metrics.timer("conversion_stage_seconds", stage="thumbnail"):
+            if image is not None:
+                thumbnail_store.save_thumbnail(image, thumbnail_path)
+            else:
+                thumbnail_store.create_thumbnail(output_location, thumbnail_path)
+    except Exception as e:
+        logging.warning("Could not save thumbnail for {0}: {1}".format(output_location, e))
+
+
+class ConversionJob:
+    def __init__(self, input_location, output_location, output_filename, origin_cd, subdirectory, file_extension,
+                 should_convert, relative_path=None, thumbnail_path=None, source_hash=None):
+        self.input_location = input_location
+        # location of the source file relative to the mounted drive, as recorded in the conversion journal
+        self.relative_path = relative_path
+        self.output_location = output_location
+        self.output_filename = output_filename
+        self.origin_cd = origin_cd
+        self.subdirectory = subdirectory
+        self.file_extension = file_extension
+        self.should_convert = should_convert
+        self.thumbnail_path = thumbnail_path
+        # blake2b digest of the source file, see ConversionCache
+        self.source_hash = source_hash
+        # backends to try, in order; set by ConversionEngine from its BackendRouter
+        self.backend_order = backends
+
+    def __repr__(self):
+        return f"ConversionJob(input_location={self.input_location}, output_location={self.output_location})"
+
+    def get_output_format(self):
+        return "png" if self.should_convert else self.file_extension.lstrip(".")
+
+
+class ConversionResult:
+    def __init__(self, job, attempts, perceptual_hash=None):
+        self.job = job
+        # (backend, seconds, error) for every backend that was tried, in order
+        self.attempts = attempts
+        self.perceptual_hash = perceptual_hash
+
+    def get_error(self, backend):
+        for attempt_backend, seconds, error in self.attempts:
+            if attempt_backend == backend:
+                return error
+        return None
+
+    @property
+    def pillow_error(self):
+        return self.get_error("pillow")
+
+    @property
+    def wand_error(self):
+        return self.get_error("wand")
+
+    @property
+    def failed(self):
+        return len(self.attempts) == 0 or self.attempts[-1][2] is not None
+
+    # same shape as the entries of the conversion_errors report in convert.py
+    def get_error_entry(self):
+        return self.job.input_location, self.pillow_error, self.wand_error
+
+
+# Runs the Pillow/Wand decode-encode step for a stream of ConversionJobs in a pool of worker processes. Jobs are pulled
+# lazily from the iterable handed to run(), so at most max_queued_jobs are ever waiting on the pool at once and the
+# directory walk never gets far ahead of the workers. Results are handed back to the caller's callback in the parent
+# process, which keeps every database write on a single connection.
+#
+# The router picks which backend each job tries first, and learns from every result. Jobs that go to ImageMagick first
+# are handed to the workers wand_batch_size at a time, so each worker process - which keeps ImageMagick loaded for its
+# whole life - works through a batch per round-trip instead of paying the hand-off for every file.
+#
+# A worker process that dies takes the pool down with it; see _recover for how the engine finds the file responsible
+# and carries on.
+class ConversionEngine:
+    def __init__(self, worker_count=None, max_queued_jobs=None, thumbnail_size=None, router=None, wand_batch_size=1):
+        self.worker_count = worker_count
+        self.thumbnail_size = thumbnail_size
+        self.max_queued_jobs = max_queued_jobs if max_queued_jobs is not None else 4 * (worker_count or 4)
+        self.router = router if router is not None else BackendRouter()
+        self.wand_batch_size = wand_batch_size
+        self.executor = None
+        self.queued_job_count = 0
+
+    def __enter__(self):
+        self._start_executor()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+        self.executor = None
+
+    def _start_executor(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.worker_count, initializer=metrics.start_worker,
+                                            initargs=(metrics.is_enabled(),))
+
+    # a pool that's lost a worker refuses any more work, so it's thrown away and replaced
+    def _restart_executor(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self._start_executor()
+
+    def run(self, jobs, on_result):
+        in_flight = {}
+        wand_batch = []
+        for job in jobs:
+            while self.queued_job_count >= self.max_queued_jobs:
+                self._handle_completed(in_flight, on_result)
+            job.backend_order = self.router.get_backend_order(job.file_extension)
+            if job.backend_order[0] != "wand" or self.wand_batch_size <= 1:
+                self._submit(in_flight, [job], on_result)
+                continue
+            wand_batch.append(job)
+            if len(wand_batch) >= self.wand_batch_size:
+                self._submit(in_flight, wand_batch, on_result)
+                wand_batch = []
+
+        if len(wand_batch) > 0:
+            self._submit(in_flight, wand_batch, on_result)
+        while len(in_flight) > 0:
+            self._handle_completed(in_flight, on_result)
+
+    def _get_arguments(self, jobs):
+        return [(x.input_location, x.output_location, x.get_output_format(), x.thumbnail_path, self.thumbnail_size,
+                 x.backend_order) for x in jobs]
+
+    def _submit(self, in_flight, jobs, on_result):
+        try:
+            future = self.executor.submit(convert_files, self._get_arguments(jobs))
+        except BrokenProcessPool:
+            # a worker died since the last results were handled; deal with the jobs it took down first
+            self._recover(in_flight, on_result)
+            future = self.executor.submit(convert_files, self._get_arguments(jobs))
+        in_flight[future] = jobs
+        self.queued_job_count += len(jobs)
+
+    def _handle_completed(self, in_flight, on_result):
+        done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            if isinstance(future.exception(), BrokenProcessPool):
+                # handles every other future too, done or not
+                self._recover(in_flight, on_result)
+                return
+            jobs = in_flight.pop(future)
+            self.queued_job_count -= len(jobs)
+            self._handle_future(future, jobs, on_result)
+
+    def _handle_future(self, future, jobs, on_result):
+        try:
+            results, worker_metrics = future.result()
+        except Exception as e:
+            # the jobs couldn't be handed to a worker or their results couldn't be sent back; count it as a failure of
+            # every backend they would have tried. These don't say anything about the backends, so the router doesn't
+            # learn from them.
+            logging.debug("Worker failed while converting {0}: {1}".format([x.input_location for x in jobs], e))
+            for job in jobs:
+                on_result(self._get_failed_result(job, str(e)))
+            return
+
+        metrics.merge(worker_metrics)
+        for job, (attempts, perceptual_hash) in zip(jobs, results):
+            self.router.record(job.file_extension, attempts)
+            on_result(ConversionResult(job, attempts, perceptual_hash))
+
+    @staticmethod
+    def _get_failed_result(job, error):
+        return ConversionResult(job, [(x, 0.0, error) for x in job.backend_order])
+
+    # When a worker process dies (e.g. a decoder segfault), every future still waiting on the pool fails with
+    # BrokenProcessPool, whichever file caused it. The pool is restarted, and the jobs of every future that failed are
+    # run again one at a time, so only the file that really takes a worker down is counted as failed.
+    def _recover(self, in_flight, on_result):
+        # a broken pool fails the futures it hadn't finished straight away, so this doesn't wait on any conversions
+        wait(in_flight.keys())
+        suspects = []
+        for future, jobs in list(in_flight.items()):
+            del in_flight[future]
+            self.queued_job_count -= len(jobs)
+            if isinstance(future.exception(), BrokenProcessPool):
+                suspects.extend(jobs)
+            else:
+                # finished before the worker died, one way or the other
+                self._handle_future(future, jobs, on_result)
+
+        logging.warning("A conversion worker died; retrying {0} files one at a time to find the one that crashed it"
+                        .format(len(suspects)))
+        self._restart_executor()
+        for job in suspects:
+            future = self.executor.submit(convert_files, self._get_arguments([job]))
+            wait([future])
+            if isinstance(future.exception(), BrokenProcessPool):
+                logging.warning("{0} crashed a conversion worker".format(job.input_location))
+                on_result(self._get_failed_result(job, "conversion worker crashed: {0}".format(future.exception())))
+                self._restart_executor()
+                continue
+            self._handle_future(future, [job], on_result)
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+
+
+# Checkpoint journal for one CD's conversion run, stored as a json-lines file in the configured journal directory.
+# It records the source size and mtime of every file that was processed and every directory whose whole subtree has
+# been processed, so a rerun can skip finished subtrees without listing them and skip unchanged files without checking
+# the output location or the database. All paths are stored relative to the mounted drive, since drive letters can
+# change between runs.
+#
+# Entries are buffered and only written out by commit(), which the converter calls after the database writes for the
+# same files have been flushed. That way the journal never claims something is done that the database doesn't have.
+class ConversionJournal:
+    def __init__(self, journal_dir, origin_cd):
+        self.origin_cd = origin_cd
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        self.journal_path = os.path.join(journal_dir, "cd_{0}.jsonl".format(origin_cd))
+
+        # state loaded from previous runs
+        self.completed_dirs = set()
+        self.file_entries = {}
+
+        # state for the current run
+        self.pending_entries = []
+        self.queued_files = {}
+        self.open_dirs = {}
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line can be cut short if the previous run died mid-write
+                    logging.debug("Ignoring malformed journal line {0}".format(line))
+                    continue
+                if entry['type'] == 'dir':
+                    self.completed_dirs.add(entry['path'])
+                else:
+                    self.file_entries[entry['path']] = (entry['size'], entry['mtime'], entry['failed'])
+        logging.info("Loaded journal for CD {0}: {1} finished directories, {2} files".format(
+            self.origin_cd, len(self.completed_dirs), len(self.file_entries)))
+
+    def commit(self):
+        if len(self.pending_entries) == 0:
+            return
+        with open(self.journal_path, "a") as journal_file:
+            for entry in self.pending_entries:
+                journal_file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        self.pending_entries = []
+
+    def is_subtree_complete(self, directory):
+        return directory in self.completed_dirs
+
+    def is_file_unchanged(self, path, size, mtime):
+        entry = self.file_entries.get(path)
+        return entry is not None and entry[0] == size and entry[1] == mtime
+
+    def is_file_failed(self, path):
+        entry = self.file_entries.get(path)
+        return entry is not None and entry[2]
+
+    # paths are normalized and relative, so entries at the top of the drive have an empty dirname
+    @staticmethod
+    def get_parent(path):
+        return os.path.dirname(path) or os.curdir
+
+    # called by the walker when it starts on a directory, with the subdirectories it is going to descend into
+    def start_directory(self, directory, child_dirs):
+        self.open_dirs[directory] = {'pending_files': 0, 'listed': False, 'children': set(child_dirs)}
+
+    # called by the walker once every file in the directory has either been queued or handled on the spot
+    def finish_listing(self, directory):
+        self.open_dirs[directory]['listed'] = True
+        self._complete_if_done(directory)
+
+    def file_queued(self, path, size, mtime):
+        self.queued_files[path] = (size, mtime)
+        self.open_dirs[self.get_parent(path)]['pending_files'] += 1
+
+    def file_finished(self, path, failed):
+        size, mtime = self.queued_files.pop(path)
+        self.file_entries[path] = (size, mtime, failed)
+        self.pending_entries.append({'type': 'file', 'path': path, 'size': size, 'mtime': mtime, 'failed': failed})
+
+        directory = self.get_parent(path)
+        self.open_dirs[directory]['pending_files'] -= 1
+        self._complete_if_done(directory)
+
+    # a directory is finished once it's been fully listed, all of its own files are done and all of its subdirectories
+    # are finished. Finishing one can in turn finish its parent.
+    def _complete_if_done(self, directory):
+        state = self.open_dirs[directory]
+        if not state['listed'] or state['pending_files'] > 0 or len(state['children']) > 0:
+            return
+
+        del self.open_dirs[directory]
+        self.completed_dirs.add(directory)
+        self.pending_entries.append({'type': 'dir', 'path': directory})
+
+        parent = self.get_parent(directory)
+        if directory != parent and parent in self.open_dirs:
+            self.open_dirs[parent]['children'].discard(directory)
+            self._complete_if_done(parent)
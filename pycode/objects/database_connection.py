@@ -0,0 +1,104 @@
+import logging
+import re
+
+from pycode.objects import metrics
+from pycode.objects.batch_writer import BatchWriter
+from pycode.objects.clipart_image import create_image_table_statements, image_column_migrations, \
+    image_index_migrations, table_name as image_table_name
+from pycode.objects.directory_summary import create_directory_table_statements, directory_trigger_migrations, \
+    rebuild_directory_summary_statements
+from pycode.objects.file_inventory import create_inventory_table_statements
+from pycode.objects.queued_post import create_post_queue_table_statements
+from pycode.objects.token import create_token_table_statements
+
+backends = ("mysql", "sqlite")
+statement_table_pattern = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF(?:\s+NOT)?\s+EXISTS)?|ON)\s+(\w+)",
+                                     re.IGNORECASE)
+
+
+# what a statement does and to which table, e.g. "UPDATE clipart", for labelling its metrics without a label per
+# distinct statement
+def get_statement_label(statement):
+    verb = statement.split(None, 1)[0].upper()
+    match = statement_table_pattern.search(statement)
+    return f"{verb} {match.group(1)}" if match is not None else verb
+
+
+# opens the storage backend picked in the config json (or the given one), importing only that backend's driver
+def get_database_connection(config, backend=None):
+    backend = backend or config.get_database_backend()
+    if backend == "mysql":
+        from pycode.objects.mysql_connection import MysqlConnection
+        return MysqlConnection(config)
+    if backend == "sqlite":
+        from pycode.objects.sqlite_connection import SqliteConnection
+        return SqliteConnection(config)
+    raise ValueError(f"Unknown database backend '{backend}'; expected one of {', '.join(backends)}")
+
+
+# What every storage backend has in common. Subclasses set dialect to the key their statements are stored under in the
+# per-dialect tables of the object modules (create_image_table_statements etc.), and implement transaction(),
+# in_transaction, execute_sql_statement(), execute_many_sql_statements(), execute_sql_query(), stream_sql_query(),
+# column_exists(), index_exists(), trigger_exists() and close_connection(), all taking %s placeholders.
+class DatabaseConnection:
+    dialect = None
+
+    def get_batch_writer(self, build_statement, flush_size=1000, on_flush=None, name=None):
+        return BatchWriter(self, build_statement, flush_size, on_flush, name)
+
+    # times a statement or query, including the wait for a pooled connection. The label is only worked out with
+    # metrics enabled.
+    def time_statement(self, statement):
+        if not metrics.is_enabled():
+            return metrics.null_timer
+        return metrics.timer("db_statement_seconds", backend=self.dialect, statement=get_statement_label(statement))
+
+    # kind is "affected" for statements and "returned" for queries
+    def count_rows(self, statement, row_count, kind):
+        if metrics.is_enabled() and row_count > 0:
+            metrics.increment("db_rows_total", row_count, backend=self.dialect,
+                              statement=get_statement_label(statement), kind=kind)
+
+    # brings tables created by older versions of the project up to date with the columns they're now expected to have
+    def apply_column_migrations(self, table, migrations):
+        for column_name, statements in migrations:
+            if self.column_exists(table, column_name):
+                continue
+            logging.info("Adding column {0} to table {1}...".format(column_name, table))
+            for statement in statements:
+                self.execute_sql_statement(statement)
+
+    # brings tables created by older versions of the project up to date with the indexes they're now expected to have
+    def apply_index_migrations(self, table, migrations):
+        for index_name, statements in migrations:
+            if self.index_exists(table, index_name):
+                continue
+            logging.info("Adding index {0} to table {1}...".format(index_name, table))
+            for statement in statements:
+                self.execute_sql_statement(statement)
+
+    # creates the triggers tables are now expected to have. Triggers are created after the column and index
+    # migrations, so those don't fire them.
+    def apply_trigger_migrations(self, table, migrations):
+        for trigger_name, statements in migrations:
+            if self.trigger_exists(table, trigger_name):
+                continue
+            logging.info("Adding trigger {0} to table {1}...".format(trigger_name, table))
+            for statement in statements:
+                self.execute_sql_statement(statement)
+
+    # recounts every directory from scratch, in case the summary has drifted from the catalog
+    def rebuild_directory_summary(self):
+        with self.transaction():
+            for statement in rebuild_directory_summary_statements:
+                self.execute_sql_statement(statement)
+
+    def set_up_tables(self):
+        for statements in [create_token_table_statements, create_image_table_statements,
+                           create_directory_table_statements, create_post_queue_table_statements,
+                           create_inventory_table_statements]:
+            for statement in statements[self.dialect]:
+                self.execute_sql_statement(statement)
+        self.apply_column_migrations(image_table_name, image_column_migrations[self.dialect])
+        self.apply_index_migrations(image_table_name, image_index_migrations[self.dialect])
+        self.apply_trigger_migrations(image_table_name, directory_trigger_migrations[self.dialect])
@@ -0,0 +1,246 @@
+import datetime as dt
+import logging
+import random
+
+from pycode.objects.clipart_image import skipped_posted_on, table_name as image_table_name
+
+# A running summary of every directory in the catalog - how many of its images are fresh, posted (or scheduled),
+# skipped and failed, and when the latest of them was posted - so picking a directory to post from doesn't have to
+# count images. Triggers on the clipart table keep it up to date as rows are inserted, deleted and marked posted,
+# scheduled, skipped or corrupted, whichever code path does it.
+#
+# MySQL only lets accounts without SUPER create triggers when binary logging is off or log_bin_trust_function_creators
+# is on.
+table_name = "clipart_directories"
+summary_columns = ['origin_cd', 'subdirectories', 'fresh_count', 'posted_count', 'skipped_count', 'failed_count',
+                   'last_posted_on']
+create_directory_table_statements = {
+    "mysql": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+              "id INT AUTO_INCREMENT PRIMARY KEY, "
+              "origin_cd INT NOT NULL, "
+              "subdirectories VARCHAR(100) NOT NULL, "
+              "fresh_count INT NOT NULL DEFAULT 0, "
+              "posted_count INT NOT NULL DEFAULT 0, "
+              "skipped_count INT NOT NULL DEFAULT 0, "
+              "failed_count INT NOT NULL DEFAULT 0, "
+              "last_posted_on DATETIME, "
+              "UNIQUE KEY directory_key (origin_cd, subdirectories), "
+              "KEY fresh_count_key (fresh_count));"],
+    "sqlite": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+               "origin_cd INT NOT NULL, "
+               "subdirectories VARCHAR(100) NOT NULL, "
+               "fresh_count INT NOT NULL DEFAULT 0, "
+               "posted_count INT NOT NULL DEFAULT 0, "
+               "skipped_count INT NOT NULL DEFAULT 0, "
+               "failed_count INT NOT NULL DEFAULT 0, "
+               "last_posted_on DATETIME);",
+               f"CREATE UNIQUE INDEX IF NOT EXISTS directory_key ON {table_name} (origin_cd, subdirectories);",
+               f"CREATE INDEX IF NOT EXISTS fresh_count_key ON {table_name} (fresh_count);"],
+}
+
+# skipped images are marked by a posted_on of the epoch, see ClipartImage.get_update_image_mark_skipped_statement
+skipped_literal = "'{0}'".format(skipped_posted_on.isoformat(" "))
+
+
+# SQL conditions for which of the four states a clipart row (NEW or OLD inside a trigger, or a column reference
+# elsewhere) is in. A NULL failed_to_save counts as failed, since the fresh image lookups skip it too.
+def get_state_conditions(row=None):
+    prefix = f"{row}." if row is not None else ""
+    saved = f"COALESCE({prefix}failed_to_save, 1) = 0"
+    return {"fresh_count": f"{saved} AND {prefix}posted_on IS NULL",
+            "posted_count": f"{saved} AND {prefix}posted_on > {skipped_literal}",
+            "skipped_count": f"{saved} AND {prefix}posted_on = {skipped_literal}",
+            "failed_count": f"COALESCE({prefix}failed_to_save, 1) != 0"}
+
+
+# adds a clipart row to its directory's counts, creating the directory if it's new
+def get_count_row_statement(row, dialect):
+    conditions = get_state_conditions(row)
+    counts = [f"CASE WHEN {conditions[x]} THEN 1 ELSE 0 END" for x in summary_columns[2:6]]
+    last_posted_on = f"CASE WHEN {conditions['posted_count']} THEN {row}.posted_on END"
+    # the row that failed to go in is VALUES(x) to MySQL and excluded.x to SQLite, as in get_bulk_insert_statement
+    new_value = "excluded.{0}" if dialect == "sqlite" else "VALUES({0})"
+    greatest = "MAX" if dialect == "sqlite" else "GREATEST"
+    updates = [f"{x} = {x} + {new_value.format(x)}" for x in summary_columns[2:6]] + \
+              [f"last_posted_on = {greatest}(COALESCE(last_posted_on, {new_value.format('last_posted_on')}), "
+               f"COALESCE({new_value.format('last_posted_on')}, last_posted_on))"]
+    on_conflict = "ON CONFLICT (origin_cd, subdirectories) DO UPDATE SET" if dialect == "sqlite" \
+        else "ON DUPLICATE KEY UPDATE"
+    return f"INSERT INTO {table_name} ({', '.join(summary_columns)}) " \
+           f"VALUES ({row}.origin_cd, COALESCE({row}.subdirectories, ''), {', '.join(counts)}, {last_posted_on}) " \
+           f"{on_conflict} {', '.join(updates)};"
+
+
+# takes a clipart row back out of its directory's counts. If it was the directory's latest post, the next latest is
+# looked up on nearby_key.
+def get_uncount_row_statement(row):
+    conditions = get_state_conditions(row)
+    counts = [f"{x} = {x} - CASE WHEN {conditions[x]} THEN 1 ELSE 0 END" for x in summary_columns[2:6]]
+    latest_query = f"SELECT MAX(posted_on) FROM {image_table_name} WHERE origin_cd = {row}.origin_cd " \
+                   f"AND subdirectories = {row}.subdirectories AND {get_state_conditions()['posted_count']}"
+    return f"UPDATE {table_name} SET {', '.join(counts)}, " \
+           f"last_posted_on = CASE WHEN {conditions['posted_count']} THEN ({latest_query}) ELSE last_posted_on END " \
+           f"WHERE origin_cd = {row}.origin_cd AND subdirectories = COALESCE({row}.subdirectories, '');"
+
+
+# only updates that move a row to another state or directory touch the summary; the upserts convert.py does on every
+# rerun mostly don't
+def get_row_moved_condition(dialect):
+    is_same = "IS" if dialect == "sqlite" else "<=>"
+    return " OR ".join([f"NOT (OLD.{x} {is_same} NEW.{x})"
+                        for x in ["posted_on", "failed_to_save", "origin_cd", "subdirectories"]])
+
+
+# rebuilds the whole summary from the clipart table, for catalogs that predate it
+rebuild_directory_summary_statements = [
+    f"DELETE FROM {table_name};",
+    f"INSERT INTO {table_name} ({', '.join(summary_columns)}) "
+    f"SELECT origin_cd, COALESCE(subdirectories, ''), "
+    f"{', '.join([f'SUM(CASE WHEN {y} THEN 1 ELSE 0 END)' for x, y in get_state_conditions().items()])}, "
+    f"MAX(CASE WHEN {get_state_conditions()['posted_count']} THEN posted_on END) "
+    f"FROM {image_table_name} GROUP BY origin_cd, COALESCE(subdirectories, '');",
+]
+
+# the triggers that keep the summary up to date, as (trigger name, statements that create it) for
+# DatabaseConnection.apply_trigger_migrations. The summary is rebuilt after the last one is created, so a catalog that
+# had rows before the triggers existed starts out with the right counts.
+def get_directory_trigger_migrations(dialect):
+    count_new = get_count_row_statement("NEW", dialect)
+    uncount_old = get_uncount_row_statement("OLD")
+    moved = get_row_moved_condition(dialect)
+    # SQLite trigger bodies always go between BEGIN and END; MySQL only needs them for more than one statement, and
+    # has no WHEN clause
+    if dialect == "sqlite":
+        insert_body, delete_body = f"BEGIN {count_new} END;", f"BEGIN {uncount_old} END;"
+        update_trigger = f"AFTER UPDATE OF posted_on, failed_to_save, origin_cd, subdirectories " \
+                         f"ON {image_table_name} FOR EACH ROW WHEN {moved} BEGIN {uncount_old} {count_new} END;"
+    else:
+        insert_body, delete_body = count_new, uncount_old
+        update_trigger = f"AFTER UPDATE ON {image_table_name} FOR EACH ROW " \
+                         f"BEGIN IF {moved} THEN {uncount_old} {count_new} END IF; END;"
+    return [
+        ("clipart_directories_insert", [f"CREATE TRIGGER clipart_directories_insert AFTER INSERT ON {image_table_name} "
+                                        f"FOR EACH ROW {insert_body}"]),
+        ("clipart_directories_delete", [f"CREATE TRIGGER clipart_directories_delete AFTER DELETE ON {image_table_name} "
+                                        f"FOR EACH ROW {delete_body}"]),
+        ("clipart_directories_update", [f"CREATE TRIGGER clipart_directories_update {update_trigger}"] +
+         rebuild_directory_summary_statements),
+    ]
+
+
+directory_trigger_migrations = {"mysql": get_directory_trigger_migrations("mysql"),
+                                "sqlite": get_directory_trigger_migrations("sqlite")}
+
+# how many directories have fresh images, and the most any of them has. Both come off fresh_count_key.
+fresh_directory_bounds_query = f"SELECT COUNT(*), MAX(fresh_count) FROM {table_name} WHERE fresh_count > 0;"
+
+
+# gets the directory at the given offset among the ones with fresh images, with when it was last posted from. Offsets are
+# dense, unlike ids: an upsert that lands on an existing directory still uses up an AUTO_INCREMENT value on MySQL, and a
+# sequence number on SQLite. The offset is walked on fresh_count_key alone, and only the directory it lands on is read.
+def get_fresh_directory_at_query(offset):
+    directory_query = f"SELECT d.origin_cd, d.subdirectories, d.fresh_count, " \
+                      f"d.fresh_count + d.posted_count + d.skipped_count + d.failed_count, d.last_posted_on " \
+                      f"FROM {table_name} d JOIN (SELECT id FROM {table_name} WHERE fresh_count > 0 " \
+                      f"ORDER BY fresh_count, id LIMIT 1 OFFSET %s) picked ON d.id = picked.id;"
+    return directory_query, (offset,)
+
+
+# gets the first fresh image in a directory at or after the given position, a range lookup on nearby_key. Without a
+# position, gets any fresh image in it, which also catches images that haven't been numbered yet.
+def get_fresh_image_in_directory_query(origin_cd, subdirectories, start_position=None):
+    where_clauses = ["origin_cd = %s", "subdirectories = %s", "posted_on IS NULL", "failed_to_save = 0"]
+    values = [origin_cd, subdirectories]
+    if start_position is not None:
+        where_clauses.append("position >= %s")
+        values.append(start_position)
+    image_query = f"SELECT * FROM {image_table_name} WHERE {' AND '.join(where_clauses)} ORDER BY position LIMIT 1;"
+    return image_query, tuple(values)
+
+
+# every directory's counts, largest first
+directory_summary_query = f"SELECT {', '.join(summary_columns)} FROM {table_name} " \
+                          f"ORDER BY fresh_count + posted_count + skipped_count + failed_count DESC;"
+
+
+# Picks fresh images to post a directory at a time: first a directory, then an image in it, each with a lookup or two
+# on an index, so the cost doesn't grow with the catalog.
+#
+# A directory is picked with probability proportional to fresh_count ** weight_exponent. 1 is the same as picking from
+# every fresh image at once, so big directories come up most; 0 gives every directory the same chance; in between
+# favours big directories less than their size would. Directories posted from within the cooldown are passed over,
+# unless every directory with anything fresh left is cooling down.
+#
+# The weighting is done by rejection: a directory is drawn uniformly from the ones with fresh images, by a random offset
+# into them, and taken with probability (fresh_count / largest fresh_count) ** weight_exponent - or turned down outright
+# if it's cooling down - until one is taken. Each draw skips over up to every directory on an index, which is cheap for
+# the few thousand a catalog has.
+class DirectorySampler:
+    def __init__(self, db_conn, weight_exponent=0.5, cooldown=dt.timedelta(hours=48), max_draws=64, max_probes=8,
+                 rng=None):
+        self.db_conn = db_conn
+        self.weight_exponent = weight_exponent
+        self.cooldown = cooldown
+        self.max_draws = max_draws
+        self.max_probes = max_probes
+        self.rng = rng or random.Random()
+
+    # returns (origin_cd, subdirectories, fresh count, total count) for a directory to post from, or None if there are
+    # no fresh images left at all
+    def pick_directory(self):
+        directory_count, max_fresh_count = self.db_conn.execute_sql_query(fresh_directory_bounds_query)[0]
+        if directory_count == 0:
+            return None
+
+        posted_before = dt.datetime.now() - self.cooldown
+        fallback = None
+        cooling_down = None
+        for _ in range(self.max_draws):
+            directories = self.db_conn.execute_sql_query(*get_fresh_directory_at_query(
+                self.rng.randrange(directory_count)))
+            if len(directories) == 0:
+                # a directory ran out of fresh images since they were counted
+                continue
+            directory, last_posted_on = directories[0][:4], directories[0][4]
+            accepted = self.rng.random() < (directory[2] / max_fresh_count) ** self.weight_exponent
+            if last_posted_on is not None and last_posted_on >= posted_before:
+                # kept in case every directory with anything fresh left is cooling down, preferring one that would
+                # have been taken so the weighting still holds then
+                if cooling_down is None or accepted and not cooling_down[1]:
+                    cooling_down = (directory, accepted)
+                continue
+            if accepted:
+                return directory
+            fallback = directory
+        # every draw was turned down by chance; settle for one that was at least eligible
+        if fallback is not None:
+            return fallback
+        if cooling_down is not None:
+            logging.debug("Every directory drawn was cooling down; ignoring the cooldown")
+            return cooling_down[0]
+        return None
+
+    # a random fresh image from the directory, probing from a random position and wrapping around
+    def pick_image(self, directory):
+        origin_cd, subdirectories, fresh_count, total_count = directory
+        start_position = self.rng.randrange(max(total_count, 1))
+        records = self.db_conn.execute_sql_query(*get_fresh_image_in_directory_query(origin_cd, subdirectories,
+                                                                                     start_position))
+        if len(records) == 0:
+            records = self.db_conn.execute_sql_query(*get_fresh_image_in_directory_query(origin_cd, subdirectories))
+        return records[0] if len(records) > 0 else None
+
+    # returns a random fresh image record, or None if there are none left
+    def pick(self):
+        for _ in range(self.max_probes):
+            directory = self.pick_directory()
+            if directory is None:
+                return None
+            record = self.pick_image(directory)
+            if record is not None:
+                return record
+            # the directory's images have no subdirectories (so the lookup can't find them) or the summary is out of
+            # step with the catalog; set_up_database.py --rebuild-summary fixes the latter
+            logging.warning("Directory {0} on disc {1} has no fresh images to pick".format(directory[1], directory[0]))
+        return None
@@ -0,0 +1,207 @@
+import logging
+import os
+import queue
+import threading
+
+from pycode.objects import metrics
+
+# various statements and queries associated with the FileInventory class but kept outside of it so we can use them
+# without instantiating one first. Paths are stored relative to the mounted drive, since drive letters can change
+# between runs; files at the top of the drive have os.curdir as their directory.
+table_name = "file_inventory"
+# extensions are compared case-sensitively, since convert.py's handlers are
+create_inventory_table_statements = {
+    "mysql": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+              "id INT AUTO_INCREMENT PRIMARY KEY, "
+              "origin_cd INT NOT NULL, "
+              "directory VARCHAR(255) NOT NULL, "
+              "filename VARCHAR(255) NOT NULL, "
+              "extension VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL, "
+              "size BIGINT NOT NULL, "
+              "mtime BIGINT NOT NULL, "
+              "UNIQUE KEY inventory_file_key (origin_cd, directory, filename), "
+              "KEY extension_key (origin_cd, extension));"],
+    # SQLite compares text case-sensitively by default
+    "sqlite": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+               "origin_cd INT NOT NULL, "
+               "directory VARCHAR(255) NOT NULL, "
+               "filename VARCHAR(255) NOT NULL, "
+               "extension VARCHAR(255) NOT NULL, "
+               "size BIGINT NOT NULL, "
+               "mtime BIGINT NOT NULL);",
+               f"CREATE UNIQUE INDEX IF NOT EXISTS inventory_file_key "
+               f"ON {table_name} (origin_cd, directory, filename);",
+               f"CREATE INDEX IF NOT EXISTS extension_key ON {table_name} (origin_cd, extension);"],
+}
+# extension is whatever follows the last dot of a file name, so it gets as much room as the name itself. Inventories
+# created when it was VARCHAR(20) are widened by MysqlConnection.set_up_tables; SQLite doesn't enforce VARCHAR widths.
+extension_width = 255
+widen_extension_statement = f"ALTER TABLE {table_name} MODIFY extension VARCHAR({extension_width}) " \
+                            f"CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL;"
+scanned_cds_query = f"SELECT DISTINCT origin_cd FROM {table_name};"
+
+
+def get_delete_inventory_statement(origin_cd):
+    delete_statement = f"DELETE FROM {table_name} WHERE origin_cd = %s;"
+    return delete_statement, (origin_cd,)
+
+
+def get_bulk_insert_statement(entries):
+    columns = ['origin_cd', 'directory', 'filename', 'extension', 'size', 'mtime']
+    row_placeholder = "({0})".format(", ".join(['%s'] * len(columns)))
+    values = []
+    for entry in entries:
+        values.extend([entry.origin_cd, entry.directory, entry.filename, entry.extension, entry.size, entry.mtime])
+    insert_statement = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES " \
+                       f"{', '.join([row_placeholder] * len(entries))};"
+    return insert_statement, values
+
+
+def get_inventory_by_cd_query(origin_cd, after_id, limit):
+    inventory_query = f"SELECT origin_cd, directory, filename, extension, size, mtime, id FROM {table_name} " \
+                      f"WHERE origin_cd = %s AND id > %s ORDER BY id LIMIT %s;"
+    return inventory_query, (origin_cd, after_id, limit)
+
+
+def get_extension_histogram_query(origin_cds=None):
+    histogram_query = f"SELECT extension, COUNT(*) FROM {table_name} "
+    values = ()
+    if origin_cds is not None and len(origin_cds) > 0:
+        histogram_query += f"WHERE origin_cd IN ({', '.join(['%s'] * len(origin_cds))}) "
+        values = tuple(origin_cds)
+    histogram_query += "GROUP BY extension ORDER BY COUNT(*) DESC;"
+    return histogram_query, values
+
+
+class InventoryFile:
+    def __init__(self, origin_cd, directory, filename, extension, size, mtime, id=None):
+        self.id = id
+        self.origin_cd = origin_cd
+        self.directory = directory
+        self.filename = filename
+        self.extension = extension
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return f"InventoryFile(origin_cd={self.origin_cd}, directory={self.directory}, filename={self.filename}, " \
+               f"size={self.size}, mtime={self.mtime})"
+
+    @property
+    def relative_path(self):
+        return os.path.normpath(os.path.join(self.directory, self.filename))
+
+
+# lists every file under mounted_drive with os.scandir, which gets the size and mtime from the directory listing itself
+# on Windows instead of needing a separate stat call per file
+def scan_source(origin_cd, mounted_drive):
+    entries = []
+    pending_dirs = [os.curdir]
+    while len(pending_dirs) > 0:
+        directory = pending_dirs.pop()
+        with os.scandir(os.path.join(mounted_drive, directory)) as listing:
+            for dir_entry in listing:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(os.path.normpath(os.path.join(directory, dir_entry.name)))
+                elif dir_entry.is_file(follow_symlinks=False):
+                    entry_stat = dir_entry.stat(follow_symlinks=False)
+                    entries.append(InventoryFile(origin_cd, directory, dir_entry.name,
+                                                 os.path.splitext(dir_entry.name)[1], entry_stat.st_size,
+                                                 int(entry_stat.st_mtime)))
+    return entries
+
+
+# groups a CD's inventory by directory and walks it top-down like os.walk, yielding (directory, child directories,
+# files) with relative paths. As with os.walk, removing entries from the child directories list skips those subtrees.
+# Directories are only known from the files in them, so ones with no files anywhere beneath them don't show up.
+def walk_inventory(entries):
+    files_by_dir = {os.curdir: []}
+    child_dirs = {}
+    for entry in entries:
+        files_by_dir.setdefault(entry.directory, []).append(entry)
+        directory = entry.directory
+        while directory != os.curdir:
+            parent = os.path.dirname(directory) or os.curdir
+            siblings = child_dirs.setdefault(parent, set())
+            if directory in siblings:
+                break
+            siblings.add(directory)
+            directory = parent
+
+    pending_dirs = [os.curdir]
+    while len(pending_dirs) > 0:
+        directory = pending_dirs.pop()
+        dirs = sorted(child_dirs.get(directory, []))
+        files = sorted(files_by_dir.get(directory, []), key=lambda x: x.filename)
+        yield directory, dirs, files
+        pending_dirs.extend(reversed(dirs))
+
+
+# A listing of every file on the mounted CDs, kept in the database so the drives only have to be read once. All the
+# configured drives are scanned at the same time, one thread each, so slow optical or ISO reads overlap instead of
+# happening one drive after another. Only this thread writes to the database, and each CD's listing is swapped in as a
+# single transaction, so a scan that dies halfway leaves the previous listing in place.
+class FileInventory:
+    def __init__(self, db_conn, insert_batch_size=1000):
+        self.db_conn = db_conn
+        self.insert_batch_size = insert_batch_size
+
+    def get_scanned_cds(self):
+        return set([x[0] for x in self.db_conn.execute_sql_query(scanned_cds_query)])
+
+    # scans the given (cd number, mounted drive) pairs concurrently and replaces their stored listings. Returns the cd
+    # numbers whose scan failed, e.g. because the drive isn't mounted.
+    def refresh(self, sources):
+        results = queue.Queue()
+
+        def scan(origin_cd, mounted_drive):
+            try:
+                with metrics.timer("conversion_stage_seconds", stage="scan"):
+                    entries = scan_source(origin_cd, mounted_drive)
+                metrics.increment("files_scanned_total", len(entries))
+                results.put((origin_cd, entries, None))
+            except Exception as e:
+                results.put((origin_cd, None, e))
+
+        for (origin_cd, mounted_drive) in sources:
+            logging.info("Scanning CD {0} at {1}...".format(origin_cd, mounted_drive))
+            threading.Thread(target=scan, args=(origin_cd, mounted_drive), name=f"scan-cd-{origin_cd}",
+                             daemon=True).start()
+
+        failed_cds = []
+        for _ in range(len(sources)):
+            origin_cd, entries, error = results.get()
+            if error is not None:
+                logging.error("Could not scan CD {0}: {1}".format(origin_cd, error))
+                failed_cds.append(origin_cd)
+                continue
+            self.store(origin_cd, entries)
+            logging.info("Scanned CD {0}: {1} files".format(origin_cd, len(entries)))
+        return failed_cds
+
+    def store(self, origin_cd, entries):
+        with self.db_conn.transaction():
+            self.db_conn.execute_sql_statement(*get_delete_inventory_statement(origin_cd))
+            with self.db_conn.get_batch_writer(get_bulk_insert_statement, self.insert_batch_size,
+                                               name="file_inventory") as writer:
+                for entry in entries:
+                    writer.add(entry)
+
+    # loads a CD's listing a chunk at a time
+    def load(self, origin_cd):
+        entries = []
+        last_id = 0
+        while True:
+            records = self.db_conn.execute_sql_query(*get_inventory_by_cd_query(origin_cd, last_id,
+                                                                                self.insert_batch_size))
+            entries.extend([InventoryFile(*x) for x in records])
+            if len(records) < self.insert_batch_size:
+                return entries
+            last_id = records[-1][6]
+
+    def walk(self, origin_cd):
+        return walk_inventory(self.load(origin_cd))
+
+    def get_extension_histogram(self, origin_cds=None):
+        return self.db_conn.execute_sql_query(*get_extension_histogram_query(origin_cds))
@@ -0,0 +1,125 @@
+import logging
+import threading
+from collections import deque
+
+from PIL import Image
+
+from pycode.objects.clipart_image import ClipartImage
+
+
+# opens an image and shrinks it to fit inside max_size, fully decoding it so no file handle or lazy decoding is left
+# for whichever thread ends up displaying it
+def load_preview_image(image_path, max_size):
+    with Image.open(image_path) as im:
+        # lets JPEG decoders skip straight to a reduced scale instead of decoding every pixel and then throwing them out
+        im.draft(None, max_size)
+        im.thumbnail(max_size)
+        return im.copy()
+
+
+class PrefetchedImage:
+    def __init__(self, image, preview):
+        self.image = image
+        self.preview = preview
+        self.nbytes = preview.width * preview.height * len(preview.getbands())
+
+
+# Keeps the next few random fresh images already picked by a DirectorySampler, decoded and downscaled on a background
+# thread, so the GUI only has to build the PhotoImage on the main thread when it moves to the next image. The sampler's
+# db_conn is shared with the GUI; the pooled connection hands each thread its own connection.
+#
+# Prefetching stops once either `depth` images are waiting or their decoded pixels add up to max_bytes. Images waiting
+# from a directory that's just been posted from are thrown out by discard_directories, since that directory is now
+# cooling down.
+class ImagePrefetcher:
+    def __init__(self, config, sampler, depth=5, max_bytes=256 * 1024 * 1024, max_size=(1400, 800)):
+        self.config = config
+        self.sampler = sampler
+        self.image_base_dir = config.get_image_base_dir()
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+
+        self.ready = deque()
+        self.ready_bytes = 0
+        self.generation = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="image-prefetcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    # throws out the waiting images from the given (origin_cd, subdirectories) directories, along with whatever is
+    # being picked right now, since it may have been picked before they started cooling down
+    def discard_directories(self, directories):
+        directories = set(directories)
+        with self.condition:
+            self.generation += 1
+            kept = [x for x in self.ready if (x.image.origin_cd, x.image.subdirectories) not in directories]
+            self.ready = deque(kept)
+            self.ready_bytes = sum(x.nbytes for x in kept)
+            self.condition.notify_all()
+
+    # throws out waiting images that have been dealt with some other way, e.g. skipped in triage mode
+    def discard_images(self, ids):
+        ids = set(ids)
+        with self.condition:
+            kept = [x for x in self.ready if x.image.id not in ids]
+            self.ready = deque(kept)
+            self.ready_bytes = sum(x.nbytes for x in kept)
+            self.condition.notify_all()
+
+    # returns the next PrefetchedImage, or None if the background thread hasn't got one ready yet
+    def get(self):
+        with self.condition:
+            if len(self.ready) == 0:
+                return None
+            prefetched = self.ready.popleft()
+            self.ready_bytes -= prefetched.nbytes
+            self.condition.notify_all()
+            return prefetched
+
+    def is_full(self):
+        return len(self.ready) >= self.depth or self.ready_bytes >= self.max_bytes
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_full() and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                generation = self.generation
+                queued_ids = set([x.image.id for x in self.ready])
+
+            try:
+                record = self.sampler.pick()
+            except Exception as e:
+                logging.error("Prefetcher could not pick an image: {0}".format(e))
+                record = None
+            if record is None:
+                # nothing left to post (or the database is unreachable); check back occasionally
+                with self.condition:
+                    self.condition.wait(timeout=30)
+                continue
+
+            try:
+                image = ClipartImage(*record)
+                if image.id in queued_ids:
+                    continue
+                preview = load_preview_image(image.get_converted_image_path(self.image_base_dir), self.max_size)
+            except Exception as e:
+                logging.error("Could not prefetch image {0}: {1}".format(record[0], e))
+                continue
+
+            with self.condition:
+                if generation == self.generation:
+                    prefetched = PrefetchedImage(image, preview)
+                    self.ready.append(prefetched)
+                    self.ready_bytes += prefetched.nbytes
@@ -0,0 +1,294 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# Named counters and histograms (timers are histograms of seconds) for finding out where a run spends its time. Nothing
+# is recorded until enable() is called - every call below checks a single flag first and returns, so instrumented code
+# costs next to nothing with metrics turned off, which is the default (see metrics.enabled in the config json).
+#
+# Metrics can carry labels, passed as keyword arguments, e.g. timer("conversion_stage_seconds", stage="decode"). Each
+# distinct set of labels is tracked separately. Keep label values to a small fixed set; a label that's different on
+# every call (a filename, a whole SQL statement) grows the registry without bound.
+#
+# Worker processes record into their own registry; drain() hands what they've recorded back to the parent, which
+# folds it into its own with merge(). See ConversionEngine.
+
+# upper bounds of the histogram buckets for durations, in seconds
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# and for sizes, in bytes
+size_buckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+# prepended to every metric name in the Prometheus output
+prometheus_namespace = "masterclips_"
+
+
+def get_label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(label_key, extra=None):
+    pairs = list(label_key) + ([extra] if extra is not None else [])
+    if len(pairs) == 0:
+        return ""
+    escaped = ['{0}="{1}"'.format(x, str(y).replace("\\", "\\\\").replace('"', '\\"')) for x, y in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        # one count per bucket, plus one for everything above the last bound
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        self.bucket_counts = [x + y for x, y in zip(self.bucket_counts, other.bucket_counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    # (upper bound, how many observations were at or below it) per bucket, ending with +Inf
+    def get_cumulative_counts(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.bucket_counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def to_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count > 0 else None,
+                "min": self.min, "max": self.max,
+                "buckets": dict([(str(x), y) for x, y in self.get_cumulative_counts()])}
+
+
+class Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.registry.observe(self.name, time.perf_counter() - self.started_at, self.labels)
+
+
+# handed out instead of a Timer while metrics are disabled
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # name -> {label key -> value}
+        self.counters = {}
+        # name -> {label key -> Histogram}
+        self.histograms = {}
+
+    def increment(self, name, amount, labels):
+        key = get_label_key(labels)
+        with self.lock:
+            by_labels = self.counters.setdefault(name, {})
+            by_labels[key] = by_labels.get(key, 0) + amount
+
+    def observe(self, name, value, labels, buckets=latency_buckets):
+        key = get_label_key(labels)
+        with self.lock:
+            by_labels = self.histograms.setdefault(name, {})
+            if key not in by_labels:
+                by_labels[key] = Histogram(buckets)
+            by_labels[key].observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    # everything recorded so far, as a picklable snapshot, and starts over from empty
+    def drain(self):
+        with self.lock:
+            snapshot = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, histograms = snapshot
+        with self.lock:
+            for name, by_labels in counters.items():
+                own = self.counters.setdefault(name, {})
+                for key, value in by_labels.items():
+                    own[key] = own.get(key, 0) + value
+            for name, by_labels in histograms.items():
+                own = self.histograms.setdefault(name, {})
+                for key, histogram in by_labels.items():
+                    if key not in own:
+                        own[key] = Histogram(histogram.buckets)
+                    own[key].merge(histogram)
+
+    # counters and histogram summaries by name, then by their labels written out as name=value pairs
+    def get_summary(self):
+        with self.lock:
+            return {"counters": dict([(name, dict([(",".join(f"{x}={y}" for x, y in key), value)
+                                                   for key, value in sorted(by_labels.items())]))
+                                      for name, by_labels in sorted(self.counters.items())]),
+                    "histograms": dict([(name, dict([(",".join(f"{x}={y}" for x, y in key), histogram.to_dict())
+                                                     for key, histogram in sorted(by_labels.items())]))
+                                        for name, by_labels in sorted(self.histograms.items())])}
+
+    # the Prometheus text exposition format, e.g. for node_exporter's textfile collector
+    def get_prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name, by_labels in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prometheus_namespace}{name} counter")
+                for key, value in sorted(by_labels.items()):
+                    lines.append(f"{prometheus_namespace}{name}{format_labels(key)} {value}")
+            for name, by_labels in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {prometheus_namespace}{name} histogram")
+                for key, histogram in sorted(by_labels.items()):
+                    for bound, count in histogram.get_cumulative_counts():
+                        lines.append(f"{prometheus_namespace}{name}_bucket{format_labels(key, ('le', bound))} {count}")
+                    lines.append(f"{prometheus_namespace}{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{prometheus_namespace}{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+# where write_reports() puts its files, set by start_reporting()
+report_settings = {"output_dir": None, "name": None}
+
+
+def is_enabled():
+    return registry.enabled
+
+
+def enable():
+    registry.enabled = True
+
+
+# the ProcessPoolExecutor initializer for worker processes. A forked worker starts with a copy of the parent's
+# registry, which has to be emptied or the parent would get those numbers back a second time.
+def start_worker(enabled):
+    registry.clear()
+    registry.enabled = enabled
+
+
+def increment(name, amount=1, **labels):
+    if registry.enabled:
+        registry.increment(name, amount, labels)
+
+
+def observe(name, value, buckets=latency_buckets, **labels):
+    if registry.enabled:
+        registry.observe(name, value, labels, buckets)
+
+
+# times the with block it's used on
+def timer(name, **labels):
+    if not registry.enabled:
+        return null_timer
+    return Timer(registry, name, labels)
+
+
+# yields the items of an iterable, timing how long each one took to produce
+def time_iteration(iterable, name, **labels):
+    if not registry.enabled:
+        return iterable
+    return timed_iteration(iterable, name, labels)
+
+
+def timed_iteration(iterable, name, labels):
+    iterator = iter(iterable)
+    while True:
+        started_at = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        registry.observe(name, time.perf_counter() - started_at, labels)
+        yield item
+
+
+# decorator that times every call to the function
+def time_calls(name, **labels):
+    def decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            if not registry.enabled:
+                return function(*args, **kwargs)
+            with Timer(registry, name, labels):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+# None when metrics are disabled, so workers don't send empty snapshots back
+def drain():
+    return registry.drain() if registry.enabled else None
+
+
+def merge(snapshot):
+    if snapshot is not None:
+        registry.merge(snapshot)
+
+
+# turns metrics on if the config json asks for them, and writes the reports as <report_name>.json and
+# <report_name>.prom in metrics.output_dir when the process exits (and whenever write_reports is called before then)
+def start_reporting(config, report_name):
+    if not config.get_metrics_enabled():
+        return
+    enable()
+    report_settings["output_dir"] = config.get_metrics_output_dir()
+    report_settings["name"] = report_name
+    atexit.register(write_reports)
+
+
+# each file is written to a temporary name and then moved into place, so nothing reading them ever sees half a file
+def write_reports():
+    if not registry.enabled or report_settings["output_dir"] is None:
+        return
+    os.makedirs(report_settings["output_dir"], exist_ok=True)
+    base_path = os.path.join(report_settings["output_dir"], report_settings["name"])
+    summary = registry.get_summary()
+    summary["written_on"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    for path, content in [(base_path + ".json", json.dumps(summary, indent=2)),
+                          (base_path + ".prom", registry.get_prometheus_text())]:
+        with open(path + ".tmp", "w") as report_file:
+            report_file.write(content)
+        os.replace(path + ".tmp", path)
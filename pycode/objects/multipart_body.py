@@ -0,0 +1,60 @@
+import os
+import uuid
+
+
+# A multipart/form-data request body that's streamed instead of built in memory. Files are only opened while their part
+# is being sent, read chunk_size bytes at a time and closed as soon as they're done (or if the upload is abandoned).
+# The total length is worked out up front from the part headers and file sizes, so requests can send a Content-Length
+# instead of falling back to chunked encoding. Iterating again starts over from the beginning, so the same body can be
+# resent when a post is retried.
+class MultipartBody:
+    def __init__(self, chunk_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.parts = []
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def add_field(self, name, value, content_type=None):
+        self.parts.append((self.get_part_header(name, None, content_type), value.encode("utf-8"), None))
+
+    def add_file(self, name, file_path, content_type, extra_headers=None):
+        self.parts.append((self.get_part_header(name, name, content_type, extra_headers), None, file_path))
+
+    def get_part_header(self, name, filename, content_type, extra_headers=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        lines = [f"--{self.boundary}", f"Content-Disposition: {disposition}"]
+        if content_type is not None:
+            lines.append(f"Content-Type: {content_type}")
+        for header, value in (extra_headers or {}).items():
+            lines.append(f"{header}: {value}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+    def get_closing_boundary(self):
+        return f"--{self.boundary}--\r\n".encode("utf-8")
+
+    def __len__(self):
+        length = len(self.get_closing_boundary())
+        for header, value, file_path in self.parts:
+            length += len(header) + 2
+            length += len(value) if file_path is None else os.path.getsize(file_path)
+        return length
+
+    def __iter__(self):
+        for header, value, file_path in self.parts:
+            yield header
+            if file_path is None:
+                yield value
+            else:
+                with open(file_path, "rb") as part_file:
+                    while True:
+                        chunk = part_file.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+            yield b"\r\n"
+        yield self.get_closing_boundary()
@@ -1,24 +1,44 @@
+import logging
+import queue
+import threading
 import keyring
 import mysql.connector
 
-from pycode.objects.clipart_image import create_image_table_statement
-from pycode.objects.token import create_token_table_statement
+from contextlib import contextmanager
 
+from pycode.objects.database_connection import DatabaseConnection
+from pycode.objects.file_inventory import extension_width, widen_extension_statement, \
+    table_name as inventory_table_name
+from pycode.objects.token import legacy_tokens_query, Token
+
+
+# Pool of mysql.connector connections that's safe to share between threads. Each checkout pings the connection and
+# reconnects if the server dropped it - the posting GUI can sit idle past wait_timeout - and at most pool_size
+# connections are ever open; a thread asking for one beyond that waits for another thread to give one back.
+#
+# Within a transaction() block, every statement the thread runs goes through the same connection, so the block commits
+# or rolls back as a unit. Outside of one, statements are committed one by one.
+class MysqlConnection(DatabaseConnection):
+    dialect = "mysql"
 
-class MysqlConnection:
     def __init__(self, config):
         config = config
         self.user = keyring.get_password("mysql", "username")
         self.password = keyring.get_password("mysql", "password")
         self.host = config.get_mysql_host()
         self.database = config.get_mysql_database()
+        self.pool_size = config.get_mysql_pool_size()
+
+        self.idle_connections = queue.LifoQueue()
+        self.available = threading.BoundedSemaphore(self.pool_size)
+        self.thread_state = threading.local()
 
         # check if the target database exists; if not, create it
         try:
-            self.conn = self.get_connection()
+            self.idle_connections.put(self.get_connection())
         except mysql.connector.DatabaseError:
             self.create_database()
-            self.conn = self.get_connection()
+            self.idle_connections.put(self.get_connection())
 
     def __del__(self):
         self.close_connection()
@@ -32,32 +52,178 @@ class MysqlConnection:
         cursor = db_conn.cursor()
         cursor.execute("CREATE DATABASE IF NOT EXISTS {0};".format(self.database))
         cursor.close()
+        db_conn.close()
 
+    # consume_results lets a streaming query be abandoned partway through without leaving unread rows on the
+    # connection for whoever checks it out next
     def get_connection(self):
-        return mysql.connector.connect(host=self.host, user=self.user, password=self.password, database=self.database)
+        return mysql.connector.connect(host=self.host, user=self.user, password=self.password, database=self.database,
+                                       consume_results=True)
 
+    # closes every connection that isn't checked out; ones that are get closed when they're handed back
     def close_connection(self):
-        self.conn.close()
+        while True:
+            try:
+                self.idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    # checks a connection out of the pool for the duration of the with block. If this thread is inside a transaction,
+    # its connection is reused instead.
+    @contextmanager
+    def connection(self):
+        transaction_conn = getattr(self.thread_state, "transaction_conn", None)
+        if transaction_conn is not None:
+            yield transaction_conn
+            return
+
+        self.available.acquire()
+        try:
+            try:
+                conn = self.idle_connections.get_nowait()
+                conn.ping(reconnect=True, attempts=3, delay=1)
+            except queue.Empty:
+                conn = self.get_connection()
+        except Exception:
+            self.available.release()
+            raise
+
+        try:
+            yield conn
+        except Exception:
+            # don't hand a connection in an unknown state to the next caller
+            conn.close()
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.idle_connections.put(conn)
+            self.available.release()
+
+    @contextmanager
+    def cursor(self, buffered=None):
+        with self.connection() as conn:
+            cursor = conn.cursor(buffered=buffered)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    @property
+    def in_transaction(self):
+        return getattr(self.thread_state, "transaction_conn", None) is not None
+
+    # groups every statement this thread executes inside the with block into one transaction, which is committed when
+    # the block exits or rolled back if it raises
+    @contextmanager
+    def transaction(self):
+        if self.in_transaction:
+            yield
+            return
 
+        with self.connection() as conn:
+            # mysql.connector leaves autocommit off, so everything up to the next commit/rollback is one transaction
+            self.thread_state.transaction_conn = conn
+            try:
+                yield
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.thread_state.transaction_conn = None
+
+    # returns the number of rows the statement affected
     def execute_sql_statement(self, statement, values=None):
-        cursor = self.conn.cursor()
-        if values is not None:
-            cursor.execute(statement, values)
-        else:
-            cursor.execute(statement)
-        self.conn.commit()
-        cursor.close()
+        with self.time_statement(statement), self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if values is not None:
+                    cursor.execute(statement, values)
+                else:
+                    cursor.execute(statement)
+                if not self.in_transaction:
+                    conn.commit()
+                self.count_rows(statement, cursor.rowcount, "affected")
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    # runs the same statement once per entry of values_list in a single transaction
+    def execute_many_sql_statements(self, statement, values_list):
+        with self.time_statement(statement), self.transaction():
+            with self.cursor() as cursor:
+                cursor.executemany(statement, values_list)
+                self.count_rows(statement, cursor.rowcount, "affected")
 
     def execute_sql_query(self, query, values=None):
-        cursor = self.conn.cursor()
-        if values is not None:
-            cursor.execute(query, values)
-        else:
-            cursor.execute(query)
-        results = cursor.fetchall()
-        cursor.close()
+        with self.time_statement(query), self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if values is not None:
+                    cursor.execute(query, values)
+                else:
+                    cursor.execute(query)
+                results = cursor.fetchall()
+                if not self.in_transaction:
+                    # ends the implicit read transaction, otherwise later queries on this pooled connection would keep
+                    # seeing the snapshot of the data from this one
+                    conn.commit()
+            finally:
+                cursor.close()
+        self.count_rows(query, len(results), "returned")
         return results
 
+    # yields the results of a query one row at a time without loading them all into memory, by reading from an
+    # unbuffered cursor chunk_size rows at a time. The connection stays checked out until the generator is exhausted
+    # or closed, so don't run other queries on this connection (i.e. inside a transaction) while iterating.
+    def stream_sql_query(self, query, values=None, chunk_size=1000):
+        with self.cursor(buffered=False) as cursor:
+            # only the query itself is timed; how long the rows take to go through is up to the caller
+            with self.time_statement(query):
+                if values is not None:
+                    cursor.execute(query, values)
+                else:
+                    cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    return
+                self.count_rows(query, len(rows), "returned")
+                for row in rows:
+                    yield row
+
+    def index_exists(self, table, index_name):
+        results = self.execute_sql_query("SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = %s "
+                                         "AND table_name = %s AND index_name = %s;", (self.database, table, index_name))
+        return results[0][0] > 0
+
+    def column_exists(self, table, column_name):
+        results = self.execute_sql_query("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s "
+                                         "AND table_name = %s AND column_name = %s;", (self.database, table, column_name))
+        return results[0][0] > 0
+
+    def trigger_exists(self, table, trigger_name):
+        results = self.execute_sql_query("SELECT COUNT(*) FROM information_schema.triggers WHERE trigger_schema = %s "
+                                         "AND event_object_table = %s AND trigger_name = %s;",
+                                         (self.database, table, trigger_name))
+        return results[0][0] > 0
+
+    def get_column_width(self, table, column_name):
+        results = self.execute_sql_query("SELECT character_maximum_length FROM information_schema.columns "
+                                         "WHERE table_schema = %s AND table_name = %s AND column_name = %s;",
+                                         (self.database, table, column_name))
+        return results[0][0]
+
+    # rewrites tokens saved before they were stored as json
+    def convert_legacy_tokens(self):
+        for record in self.execute_sql_query(legacy_tokens_query):
+            logging.info("Converting token {0} to json...".format(record[0]))
+            self.execute_sql_statement(*Token.from_legacy_record(record).get_update_token_statement())
+
     def set_up_tables(self):
-        self.execute_sql_statement(create_token_table_statement)
-        self.execute_sql_statement(create_image_table_statement)
+        super().set_up_tables()
+        self.convert_legacy_tokens()
+        if self.get_column_width(inventory_table_name, "extension") < extension_width:
+            logging.info("Widening column extension of table {0}...".format(inventory_table_name))
+            self.execute_sql_statement(widen_extension_statement)
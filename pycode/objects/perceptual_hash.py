@@ -0,0 +1,31 @@
+from PIL import Image
+
+hash_size = 8
+
+
+# 64-bit difference hash (dHash) of an image: shrink it to a 9x8 greyscale grid and record, for each row, whether each
+# pixel is brighter than the one to its right. Resized, recompressed or slightly touched-up copies of a piece of art end
+# up a few bits apart, so the Hamming distance between two hashes is a cheap measure of how alike the images look.
+# Transparent areas are flattened onto white first, since the converted WMFs are mostly line art on a transparent
+# background.
+def compute_dhash(image):
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+
+    dhash = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            dhash = (dhash << 1) | (1 if left > right else 0)
+    return dhash
+
+
+def compute_file_dhash(path):
+    with Image.open(path) as image:
+        # JPEGs can be decoded at a fraction of their size, which is plenty for a 9x8 grid
+        image.draft("RGB", (64, 64))
+        return compute_dhash(image)
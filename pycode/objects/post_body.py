@@ -0,0 +1,14 @@
+import json
+
+from pycode.objects.multipart_body import MultipartBody
+
+
+# builds the streamed multipart request body for a post: the json blob first, then each image read straight from disk.
+# Kept apart from TumblrPost, which needs tkinter, so queued posts can be sent by headless scripts.
+def build_post_body(images, post_blob, image_base_location):
+    body = MultipartBody()
+    body.add_field('json', json.dumps(post_blob, separators=(',', ':')), 'application/json')
+    for image in images:
+        body.add_file(f"image_{image.id}", image.get_converted_image_path(image_base_location), image.mimetype,
+                      {'Expires': '0'})
+    return body
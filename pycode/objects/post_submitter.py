@@ -0,0 +1,72 @@
+import logging
+import queue
+import threading
+
+
+class PostJob:
+    def __init__(self, post, post_blob, on_progress=None, on_done=None):
+        self.post = post
+        self.post_blob = post_blob
+        self.on_progress = on_progress
+        self.on_done = on_done
+        # set if the post went out but its images couldn't be marked as posted afterwards
+        self.mark_posted_error = None
+
+
+# Sends posts on a background thread, one at a time from a queue, so the upload never blocks whoever submitted them.
+# Failed attempts are retried with TumblrConnection.send_post_with_retries, and once a post goes through every image in
+# it is marked as posted.
+#
+# Callbacks are handed to `dispatch` rather than called directly, so the GUI can run them on the Tk thread (see
+# PostingApp.run_on_ui_thread). on_progress gets a status message and on_done gets the final response (or None), along
+# with the error from marking the images posted if that failed after the post went out.
+class PostSubmitter:
+    def __init__(self, tumblr_conn, db_conn, dispatch=None, max_attempts=5, base_delay=2, max_delay=300):
+        self.tumblr_conn = tumblr_conn
+        self.db_conn = db_conn
+        self.dispatch = dispatch if dispatch is not None else lambda callback, *args: callback(*args)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="post-submitter", daemon=True)
+        self.thread.start()
+
+    # must be called from the Tk thread, since it reads the post's tkinter variables
+    def submit(self, post, on_progress=None, on_done=None):
+        job = PostJob(post, post.get_post_blob(), on_progress, on_done)
+        self.jobs.put(job)
+        return job
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                response = self.send(job)
+            except Exception as e:
+                logging.exception("Unexpected error while submitting post: {0}".format(e))
+                response = None
+            if job.on_done is not None:
+                self.dispatch(job.on_done, response, job.mark_posted_error)
+
+    def send(self, job):
+        def report_progress(message):
+            if job.on_progress is not None:
+                self.dispatch(job.on_progress, message)
+
+        response = self.tumblr_conn.send_post_with_retries(job.post, job.post_blob, self.max_attempts,
+                                                           self.base_delay, self.max_delay, report_progress)
+        if response is not None and response.status_code == 201:
+            try:
+                self.mark_posted(job.post)
+            except Exception as e:
+                # the post is on the blog either way, so the response still goes back; sending it again would only
+                # make a duplicate
+                logging.exception("Post was sent, but its images could not be marked as posted: {0}".format(e))
+                job.mark_posted_error = str(e)
+        return response
+
+    def mark_posted(self, post):
+        with self.db_conn.transaction():
+            for image in post.images:
+                self.db_conn.execute_sql_statement(*image.get_update_image_mark_posted_statement())
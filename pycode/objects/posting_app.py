@@ -1,25 +1,46 @@
+import datetime as dt
 import logging
-import os
+import queue
 import tkinter as tk
 import tkinter.font as tkFont
 import webbrowser
 
+import threading
+
+from collections import deque
 from tkinter import ttk
-from PIL import Image, ImageTk
-from pycode.objects.clipart_image import get_random_fresh_image_query, get_recently_posted_images_query, ClipartImage, \
-    get_image_by_file_data_query
-from pycode.objects.mysql_connection import MysqlConnection
-from pycode.objects.tumblr_connection import TumblrConnection
+from pycode.objects import metrics
+from pycode.objects.clipart_image import get_images_by_ids_query, ClipartImage
+from pycode.objects.post_submitter import PostSubmitter
+from pycode.objects.queued_post import QueuedPost, queued_post_count_query
+from pycode.objects.triage_grid import build_triage_grid, decision_keys, default_decision
 from pycode.objects.tumblr_post import TumblrPost
 
+# PIL, mysql.connector, keyring and requests_oauthlib are slow to import, so the modules that pull them in are only
+# imported once they're needed - the ones behind the database and Tumblr connections on a background thread while the
+# window comes up, and ImageTk right where images are displayed.
+
 
 class PostingApp(tk.Frame):
-    def __init__(self, root, config):
+    def __init__(self, root, config, startup_profile=None):
         logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
         self.image_labeling_batch_size = 4
+        # how many of the closest matches from the whole catalog the related images screen suggests
+        self.similar_image_count = 20
+        # the contact sheet scrolls if it's taller than this
+        self.contact_sheet_max_height = 900
         self.config = config
-        self.db_conn = MysqlConnection(self.config)
-        self.tumblr_conn = TumblrConnection(self.config, self.db_conn)
+        self.startup_profile = startup_profile
+        self.display_max_size = self.config.get_display_max_size()
+
+        # set up by connect_services on a background thread
+        self.db_conn = None
+        self.tumblr_conn = None
+        self.sampler = None
+        self.prefetcher = None
+        self.thumbnails = None
+        self.similarity_index = None
+        self.post_submitter = None
 
         # these variables capture some values that we want to persist between methods and/or so they don't get garbage
         # collected. See below for examples of why this is needed
@@ -27,28 +48,121 @@ class PostingApp(tk.Frame):
         # https://stackoverflow.com/questions/74857162/avoiding-garbage-collection-for-tkinter-photoimage-python
         self.auth_redirect_url = tk.StringVar()
         self.current_image = None
-        self.related_image_variables = []
+        self.related_image_records = {}
+        # image id -> the canvas rectangle marking it as selected on the contact sheet
+        self.related_selection = {}
+        self.contact_sheet = None
+        self.contact_sheet_tk_pic = None
+        self.related_hover_text = None
+        self.related_selection_text = None
+        # triage mode. Images kept there wait here to be posted, ahead of anything the prefetcher has.
+        self.kept_images = deque()
+        self.triage_grid = None
+        self.next_triage_grid = None
+        # bumped whenever triage mode starts or ends, so grids built for an earlier session are thrown away
+        self.triage_generation = 0
+        self.triage_cursor = 0
+        self.triage_counts = {}
+        self.triage_tk_pic = None
+        self.triage_status = tk.StringVar()
         self.other_images_to_add = tk.StringVar()
         self.post = None
+        self.post_status = tk.StringVar()
+        self.post_target_time = tk.StringVar()
 
         # GUI application setup
         self.gui_root = root
         tk.Frame.__init__(self, self.gui_root)
         self.configure_gui()
 
-        # determine if we need to tumblr auth or if we can just start the app
-        authenticated = self.tumblr_conn.auth_if_token_present()
+        # background threads can't touch tkinter, so they queue callbacks here for the Tk thread to run
+        self.ui_callbacks = queue.Queue()
+        self.gui_root.after(100, self.process_ui_callbacks)
+
+        # connecting to the database and reading the keyring secrets happens while the window paints
+        self.mark_startup("window created")
+        self.display_loading()
+        threading.Thread(target=self.connect_services, name="startup", daemon=True).start()
+
+    def mark_startup(self, milestone):
+        if self.startup_profile is not None:
+            self.startup_profile.mark(milestone)
+
+    def display_loading(self):
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        ttk.Label(content_frame, text="Connecting...").grid(column=0, row=0)
+
+    # runs on a background thread at startup
+    def connect_services(self):
+        try:
+            from pycode.objects.database_connection import get_database_connection
+            from pycode.objects.directory_summary import DirectorySampler
+            from pycode.objects.image_prefetcher import ImagePrefetcher
+            from pycode.objects.similarity_index import SimilarityIndex
+            from pycode.objects.thumbnail_store import ThumbnailStore, ThumbnailCache
+            from pycode.objects.tumblr_connection import TumblrConnection
+            self.mark_startup("modules imported")
+
+            self.db_conn = get_database_connection(self.config)
+            self.tumblr_conn = TumblrConnection(self.config, self.db_conn)
+            self.mark_startup("connected")
+            self.sampler = DirectorySampler(self.db_conn, self.config.get_sampler_weight_exponent(),
+                                            dt.timedelta(hours=self.config.get_sampler_cooldown_hours()))
+            self.prefetcher = ImagePrefetcher(self.config, self.sampler, self.config.get_prefetch_depth(),
+                                              self.config.get_prefetch_max_bytes(), self.display_max_size)
+            self.thumbnails = ThumbnailCache(ThumbnailStore(self.config.get_thumbnail_cache_dir(),
+                                                            self.config.get_thumbnail_size()),
+                                             self.config.get_image_base_dir(),
+                                             self.config.get_thumbnail_memory_bytes())
+            self.post_submitter = PostSubmitter(self.tumblr_conn, self.db_conn, dispatch=self.run_on_ui_thread)
+            self.prefetcher.start()
+            # not needed until the related images screen, so it doesn't hold up the first image
+            self.similarity_index = SimilarityIndex(self.db_conn)
+            self.similarity_index.load_in_background()
+
+            # determine if we need to tumblr auth or if we can just start the app
+            authenticated = self.tumblr_conn.auth_if_token_present()
+            self.mark_startup("token loaded")
+        except Exception as e:
+            logging.exception("Startup failed")
+            self.run_on_ui_thread(self.display_startup_error, e)
+            return
+        self.run_on_ui_thread(self.finish_startup, authenticated)
+
+    def finish_startup(self, authenticated):
         if authenticated is False:
             self.authenticate()
         else:
             self.display_random_image()
 
+    def display_startup_error(self, error):
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        ttk.Label(content_frame, text=f"Could not start up: {error}").grid(column=0, row=0)
+        ttk.Button(content_frame, text="Exit", command=self.gui_root.destroy).grid(column=0, row=1)
+
     def configure_gui(self):
         self.gui_root.title("Posting App")
         self.gui_root.minsize(1500, 1000)
         default_font = tkFont.nametofont("TkDefaultFont")
         default_font.configure(size=14)
 
+    def run_on_ui_thread(self, callback, *args):
+        self.ui_callbacks.put((callback, args))
+
+    def process_ui_callbacks(self):
+        while True:
+            try:
+                callback, args = self.ui_callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        self.gui_root.after(100, self.process_ui_callbacks)
+
+    @metrics.time_calls("gui_screen_seconds", screen="authenticate")
     def authenticate(self):
         auth_url = self.tumblr_conn.get_auth_url()
 
@@ -75,33 +189,41 @@ class PostingApp(tk.Frame):
         for widget in self.gui_root.winfo_children():
             widget.destroy()
 
+    @metrics.time_calls("gui_screen_seconds", screen="random_image")
     def display_random_image(self):
+        from PIL import ImageTk
+        from pycode.objects.image_prefetcher import load_preview_image
+
         self.clear_current_display()
         # frame with all content is fit inside of root window
         content_frame = ttk.Frame(self.gui_root, padding=25)
         content_frame.grid()
 
-        # get a random image from the database
-        latest_image_records = self.db_conn.execute_sql_query(*get_recently_posted_images_query(10))
-        if latest_image_records is not None and len(latest_image_records) > 0:
-            latest_subdirectories = list(set([x[3] for x in latest_image_records]))
-            random_image_query = get_random_fresh_image_query(latest_subdirectories)
+        # images kept in triage mode come first. Otherwise take the next image the prefetcher has ready; if it hasn't
+        # caught up yet, pick and load one right here
+        prefetched = self.prefetcher.get() if len(self.kept_images) == 0 else None
+        if len(self.kept_images) > 0:
+            self.current_image = self.kept_images.popleft()
+            preview = load_preview_image(self.current_image.get_converted_image_path(self.config.get_image_base_dir()),
+                                         self.display_max_size)
+        elif prefetched is not None:
+            self.current_image = prefetched.image
+            preview = prefetched.preview
         else:
-            random_image_query = get_random_fresh_image_query()
-        random_image_record = self.db_conn.execute_sql_query(random_image_query)
-
-        if random_image_record is None:
-            logging.error("No images to post! Either something went wrong or you finally posted them all. "
-                          "Double check and rerun the program.")
-            exit(53)
-
-        # create object from random image record
-        self.current_image = ClipartImage(*random_image_record[0])
+            random_image_record = self.sampler.pick()
+            if random_image_record is None:
+                logging.error("No images to post! Either something went wrong or you finally posted them all. "
+                              "Double check and rerun the program.")
+                exit(53)
+
+            # create object from random image record
+            self.current_image = ClipartImage(*random_image_record)
+            preview = load_preview_image(self.current_image.get_converted_image_path(self.config.get_image_base_dir()),
+                                         self.display_max_size)
         self.current_image.alt_text = tk.StringVar()
-        current_image_path = self.current_image.get_converted_image_path(self.config.get_image_base_dir())
 
         # have to set as class variable so garbage collector doesn't dump the image data before it can be displayed
-        self.current_image.current_tk_pic = ImageTk.PhotoImage(Image.open(current_image_path))
+        self.current_image.current_tk_pic = ImageTk.PhotoImage(preview)
 
         ttk.Label(content_frame, image=self.current_image.current_tk_pic).grid(column=0, row=0, columnspan=3)
         ttk.Label(content_frame, text=f"id{self.current_image.id}, filename {self.current_image.filename}") \
@@ -113,64 +235,390 @@ class PostingApp(tk.Frame):
         ttk.Button(content_frame, text="Yes", command=self.choose_related).grid(column=0, row=4)
         ttk.Button(content_frame, text="Skip for now", command=self.display_random_image).grid(column=1, row=4)
         ttk.Button(content_frame, text="Skip Forever", command=self.mark_skipped).grid(column=2, row=4)
+        ttk.Button(content_frame, text="Triage Mode", command=self.start_triage).grid(column=0, row=5)
         ttk.Button(content_frame, text="Quit Program", command=self.gui_root.destroy).grid(column=2, row=5)
+        if len(self.kept_images) > 0:
+            ttk.Label(content_frame, text=f"{len(self.kept_images)} more kept from triage").grid(column=1, row=5)
+
+        if self.startup_profile is not None and not self.startup_profile.finished:
+            # let Tk actually draw the image before calling it shown
+            self.gui_root.update_idletasks()
+            self.mark_startup("first image shown")
+            self.startup_profile.report()
+
+    # directories that were just posted from are on cooldown in the sampler (see DirectorySampler), so to avoid
+    # repetitiveness the prefetcher drops whatever it already picked from them. Skipping doesn't start a cooldown.
+    def discard_posted_directories(self):
+        self.prefetcher.discard_directories([(x.origin_cd, x.subdirectories) for x in self.post.images])
 
     def mark_skipped(self):
         self.db_conn.execute_sql_statement(*self.current_image.get_update_image_mark_skipped_statement())
         self.display_random_image()
 
+    # Triage mode goes through fresh images a grid at a time instead of one per screen. Each tile is marked with a
+    # single key (see triage_grid.decision_keys), and a whole grid's decisions are written in one transaction when
+    # moving on to the next, which has been built in the background meanwhile.
+    def start_triage(self):
+        self.triage_generation += 1
+        self.triage_grid = None
+        self.next_triage_grid = None
+        self.triage_counts = dict([(x, 0) for x in decision_keys.values()])
+        self.display_triage_loading()
+        self.prepare_next_triage_grid([x.id for x in self.kept_images])
+
+    def display_triage_loading(self):
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        ttk.Label(content_frame, text="Loading the next grid...").grid(column=0, row=0)
+        ttk.Button(content_frame, text="Stop triage", command=self.stop_triage).grid(column=0, row=1)
+
+    def prepare_next_triage_grid(self, exclude_ids):
+        threading.Thread(target=self.build_triage_grid, args=(self.triage_generation, exclude_ids), name="triage-grid",
+                         daemon=True).start()
+
+    # runs on a background thread
+    def build_triage_grid(self, generation, exclude_ids):
+        rows, columns = self.config.get_triage_grid_shape()
+        try:
+            with metrics.timer("triage_grid_seconds"):
+                grid = build_triage_grid(self.sampler, self.thumbnails, rows * columns,
+                                         self.config.get_triage_tile_size(), columns, exclude_ids)
+        except Exception as e:
+            logging.exception("Could not build the triage grid")
+            self.run_on_ui_thread(self.receive_triage_grid, generation, None, e)
+            return
+        self.run_on_ui_thread(self.receive_triage_grid, generation, grid, None)
+
+    def receive_triage_grid(self, generation, grid, error):
+        if generation != self.triage_generation:
+            return
+        if error is not None:
+            self.display_triage_message(f"Could not load the next grid: {error}")
+            return
+        self.next_triage_grid = grid
+        # nothing on screen yet, i.e. the loading screen is up
+        if self.triage_grid is None:
+            self.display_next_triage_grid()
+
+    def display_next_triage_grid(self):
+        self.triage_grid, self.next_triage_grid = self.next_triage_grid, None
+        if len(self.triage_grid.images) == 0:
+            self.display_triage_message("No fresh images left to triage.")
+            return
+        # start on the grid after this one right away, leaving out everything already on screen or kept
+        self.prepare_next_triage_grid([x.id for x in self.triage_grid.images] + [x.id for x in self.kept_images])
+        self.display_triage_grid()
+
+    def display_triage_message(self, message):
+        self.triage_grid = None
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        ttk.Label(content_frame, text=message).grid(column=0, row=0)
+        ttk.Button(content_frame, text="Stop triage", command=self.stop_triage).grid(column=0, row=1)
+
+    @metrics.time_calls("gui_screen_seconds", screen="triage")
+    def display_triage_grid(self):
+        from PIL import ImageTk
+
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+
+        sheet = self.triage_grid.sheet
+        self.triage_tk_pic = ImageTk.PhotoImage(sheet.image)
+        width, height = sheet.get_size()
+        canvas = tk.Canvas(content_frame, width=width, height=height, highlightthickness=0)
+        canvas.create_image(0, 0, image=self.triage_tk_pic, anchor=tk.NW)
+        canvas.grid(column=0, row=0, columnspan=2)
+        # decisions and the cursor are drawn over the sheet, tagged so they can be redrawn without touching the image
+        self.triage_cursor = 0
+        self.draw_triage_cursor(canvas)
+
+        self.update_triage_status()
+        ttk.Label(content_frame, textvariable=self.triage_status).grid(column=0, row=1, columnspan=2)
+        ttk.Label(content_frame, text="k keep, s skip forever, c corrupted, l later (the default); arrow keys or click "
+                                      "to move; Enter for the next grid, Escape to stop").grid(column=0, row=2,
+                                                                                               columnspan=2)
+        ttk.Button(content_frame, text="Next grid", command=self.commit_triage_grid).grid(column=1, row=3)
+        ttk.Button(content_frame, text="Stop triage", command=self.stop_triage).grid(column=0, row=3)
+
+        canvas.bind("<Key>", lambda e: self.handle_triage_key(canvas, e))
+        canvas.bind("<Button-1>", lambda e: self.move_triage_cursor(canvas, sheet.get_index_at(e.x, e.y)))
+        canvas.focus_set()
+
+    def handle_triage_key(self, canvas, event):
+        columns = self.triage_grid.sheet.columns
+        moves = {"Left": -1, "Right": 1, "Up": -columns, "Down": columns}
+        if event.keysym in moves:
+            self.move_triage_cursor(canvas, self.triage_cursor + moves[event.keysym])
+        elif event.keysym == "Return":
+            self.commit_triage_grid()
+        elif event.keysym == "Escape":
+            self.stop_triage()
+        elif event.char.lower() in decision_keys:
+            self.triage_grid.decide(self.triage_cursor, decision_keys[event.char.lower()])
+            self.draw_triage_decision(canvas, self.triage_cursor)
+            self.update_triage_status()
+            # on to the next tile, so a whole grid can be gone through with one key per image
+            self.move_triage_cursor(canvas, self.triage_cursor + 1)
+
+    def move_triage_cursor(self, canvas, index):
+        if index is None or index < 0 or index >= len(self.triage_grid.images):
+            return
+        self.triage_cursor = index
+        self.draw_triage_cursor(canvas)
+
+    def draw_triage_cursor(self, canvas):
+        left, top, right, bottom = self.triage_grid.sheet.get_cell_box(self.triage_cursor)
+        canvas.delete("cursor")
+        canvas.create_rectangle(left - 4, top - 4, right + 3, bottom + 3, outline="#1e6fd9", width=2, dash=(4, 2),
+                                tags="cursor")
+
+    def draw_triage_decision(self, canvas, index):
+        tag = f"decision{index}"
+        canvas.delete(tag)
+        decision = self.triage_grid.get_decision(index)
+        if decision == default_decision:
+            return
+        colour = {"keep": "#2e9e44", "skip": "#cc3333", "corrupted": "#8e44ad"}[decision]
+        left, top, right, bottom = self.triage_grid.sheet.get_cell_box(index)
+        canvas.create_rectangle(left, top, right - 1, bottom - 1, outline=colour, width=4, tags=tag)
+        canvas.create_text(left + 6, top + 4, text=decision.upper(), anchor=tk.NW, fill=colour,
+                           font=("TkDefaultFont", 12, "bold"), tags=tag)
+        # the cursor stays on top
+        canvas.tag_raise("cursor")
+
+    def update_triage_status(self):
+        pending = len(self.triage_grid.decisions) if self.triage_grid is not None else 0
+        counts = ", ".join([f"{y} {x}" for x, y in self.triage_counts.items() if x != default_decision])
+        self.triage_status.set(f"{pending} decided on this grid. This session: {counts}. "
+                               f"{len(self.kept_images)} kept images waiting to be posted.")
+
+    # writes the grid's decisions and moves on to the next one
+    def commit_triage_grid(self):
+        if self.triage_grid is None:
+            return
+        self.write_triage_decisions(self.triage_grid)
+        self.triage_grid = None
+        if self.next_triage_grid is not None:
+            self.display_next_triage_grid()
+        else:
+            self.display_triage_loading()
+
+    def write_triage_decisions(self, grid):
+        grid.commit(self.db_conn)
+        decided_ids = []
+        for decision in decision_keys.values():
+            images = grid.get_images(decision)
+            self.triage_counts[decision] += len(images)
+            metrics.increment("triage_decisions_total", len(images), decision=decision)
+            decided_ids.extend([x.id for x in images])
+        self.kept_images.extend(grid.get_images("keep"))
+        # the prefetcher might have picked some of the same images for the one image at a time screen
+        self.prefetcher.discard_images(decided_ids)
+
+    def stop_triage(self):
+        if self.triage_grid is not None:
+            self.write_triage_decisions(self.triage_grid)
+        self.triage_generation += 1
+        self.triage_grid = None
+        self.next_triage_grid = None
+        self.display_random_image()
+
+    @metrics.time_calls("gui_screen_seconds", screen="related")
     def choose_related(self):
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        ttk.Label(content_frame, image=self.current_image.current_tk_pic).grid(column=0, row=0)
+        ttk.Label(content_frame, text="Finding related images...").grid(column=0, row=1)
+
+        self.related_image_records = {}
+        self.related_selection = {}
+        self.contact_sheet = None
+        # finding the candidates and decoding their thumbnails happens off the Tk thread; display_related picks it up
+        threading.Thread(target=self.build_contact_sheet, args=(self.current_image,), name="contact-sheet",
+                         daemon=True).start()
+
+    # runs on a background thread. Candidates are shown as one contact sheet built from their thumbnails, so only the
+    # images actually on screen get decoded, and only at thumbnail size.
+    def build_contact_sheet(self, image):
+        from pycode.objects.contact_sheet import ContactSheet, ContactSheetTile
+
+        try:
+            with metrics.timer("contact_sheet_seconds"):
+                candidates = []
+                tiles = []
+                for record, distance, can_add in self.get_related_candidates(image):
+                    try:
+                        candidate_image = ClipartImage(*record)
+                    except Exception as e:
+                        # e.g. a saved .htm file in the same directory; it's not an image, so it's left off the sheet
+                        logging.warning("Skipping related record {0}: {1}".format(record[0], e))
+                        continue
+                    candidates.append((record, distance, can_add))
+                    tiles.append(ContactSheetTile(record[0], self.get_thumbnail(candidate_image), record[1], can_add))
+                sheet = ContactSheet(tiles, self.config.get_contact_sheet_tile_size(),
+                                     self.config.get_contact_sheet_columns())
+                sheet.build()
+                current_thumbnail = self.get_thumbnail(image)
+        except Exception as e:
+            logging.exception("Could not build the contact sheet")
+            self.run_on_ui_thread(self.display_related_error, e)
+            return
+        self.run_on_ui_thread(self.display_related, candidates, sheet, current_thumbnail)
+
+    # the thumbnail of an image, or None if it can't be loaded or made
+    def get_thumbnail(self, image):
+        try:
+            return self.thumbnails.get(image)
+        except Exception as e:
+            logging.warning(f"Could not load a thumbnail for image {image.id}: {e}")
+            return None
+
+    def display_related(self, candidates, sheet, current_thumbnail):
+        from PIL import ImageTk
+
         self.clear_current_display()
         content_frame = ttk.Frame(self.gui_root, padding=25)
         content_frame.grid()
 
-        related_images = self.current_image.get_nearby_files(self.config.get_image_base_dir())
-        self.related_image_variables = [tk.StringVar() for x in related_images]
-        column_count = 0
-        for index, filename in enumerate(related_images):
-            # 20 per column
-            column_count = 1 + (index // 20)
-            row_count = index - ((column_count - 1) * 20)
-            ttk.Checkbutton(content_frame, text=filename, variable=self.related_image_variables[index],
-                            onvalue=filename, offvalue="") \
-                .grid(column=column_count, row=row_count)
-            self.related_image_variables[index].set("")
-
-        ttk.Label(content_frame, image=self.current_image.current_tk_pic).grid(column=0, row=0, rowspan=19)
-        ttk.Label(content_frame, text=f"id{self.current_image.id}, filename {self.current_image.filename}").grid(
-            column=0, row=20)
+        # kept by id so start_post doesn't have to look each chosen image up again
+        self.related_image_records = dict([(x[0][0], x[0]) for x in candidates])
+        self.related_selection = {}
+        self.contact_sheet = sheet
+        # the alt text screen shows the image as a thumbnail too, so start_post keeps using this one
+        if current_thumbnail is not None:
+            self.current_image.current_tk_pic = ImageTk.PhotoImage(current_thumbnail)
+
+        ttk.Label(content_frame, image=self.current_image.current_tk_pic).grid(column=0, row=0, sticky=tk.N)
+        ttk.Label(content_frame, text=f"id{self.current_image.id}, filename {self.current_image.filename}",
+                  wraplength=self.config.get_thumbnail_size()[0]).grid(column=0, row=1)
+        # describes whichever tile the pointer is over, since captions on the sheet are cut short
+        self.related_hover_text = tk.StringVar()
+        ttk.Label(content_frame, textvariable=self.related_hover_text,
+                  wraplength=self.config.get_thumbnail_size()[0]).grid(column=0, row=2)
+        self.related_selection_text = tk.StringVar(value="Click images to add them to the post")
+        ttk.Label(content_frame, textvariable=self.related_selection_text).grid(column=0, row=3)
 
         # TODO implement some way of checking that these are valid filenames before using
         '''ttk.Label(content_frame,
                   text="Or, you can specify any other image in this directory by typing their IDs below:").grid(column=0, row=21, columnspan=column_count)
         ttk.Entry(content_frame, textvariable=self.other_images_to_add).grid(column=0, row=22, columnspan=column_count)'''
 
-        ttk.Button(content_frame, text="Done", command=self.start_post).grid(column=column_count, row=23)
-
-        # pull up the directory where the image is located in a separate window - seeing the image previews there is
-        # more efficient than loading in and displaying hundreds of images in the GUI, especially since most will be
-        # discarded. And it's easier to drop into a reverse image search from there.
-        os.startfile(os.path.join(self.config.get_image_base_dir(), self.current_image.subdirectories))
-
+        ttk.Button(content_frame, text="Done", command=self.start_post).grid(column=0, row=4)
+
+        if len(candidates) == 0:
+            ttk.Label(content_frame, text="No related images found.").grid(column=1, row=0, sticky=tk.N)
+            return
+
+        # one PhotoImage for the whole sheet, with selections drawn over it as canvas rectangles, so clicking doesn't
+        # have to rebuild the image
+        self.contact_sheet_tk_pic = ImageTk.PhotoImage(sheet.image)
+        width, height = sheet.get_size()
+        canvas = tk.Canvas(content_frame, width=width, height=min(height, self.contact_sheet_max_height),
+                           scrollregion=(0, 0, width, height), highlightthickness=0)
+        canvas.create_image(0, 0, image=self.contact_sheet_tk_pic, anchor=tk.NW)
+        canvas.grid(column=1, row=0, rowspan=5)
+        if height > self.contact_sheet_max_height:
+            scrollbar = ttk.Scrollbar(content_frame, orient=tk.VERTICAL, command=canvas.yview)
+            canvas.configure(yscrollcommand=scrollbar.set)
+            scrollbar.grid(column=2, row=0, rowspan=5, sticky=tk.NS)
+            # <MouseWheel> on Windows and macOS, buttons 4 and 5 on X11
+            canvas.bind("<MouseWheel>", lambda e: canvas.yview_scroll(-1 if e.delta > 0 else 1, "units"))
+            canvas.bind("<Button-4>", lambda e: canvas.yview_scroll(-1, "units"))
+            canvas.bind("<Button-5>", lambda e: canvas.yview_scroll(1, "units"))
+        canvas.bind("<Button-1>", lambda e: self.toggle_related(canvas, e))
+        canvas.bind("<Motion>", lambda e: self.describe_related(canvas, e, candidates))
+
+    def display_related_error(self, error):
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        ttk.Label(content_frame, text=f"Could not load related images: {error}").grid(column=0, row=0)
+        ttk.Button(content_frame, text="Post this image alone", command=self.start_post).grid(column=0, row=1)
+
+    # event coordinates are relative to the visible part of the canvas; canvasx/canvasy account for the scrolling
+    def toggle_related(self, canvas, event):
+        index = self.contact_sheet.get_index_at(canvas.canvasx(event.x), canvas.canvasy(event.y))
+        if index is None:
+            return
+        image_id = self.contact_sheet.tiles[index].key
+        if image_id in self.related_selection:
+            canvas.delete(self.related_selection.pop(image_id))
+        else:
+            left, top, right, bottom = self.contact_sheet.get_cell_box(index)
+            self.related_selection[image_id] = canvas.create_rectangle(left - 3, top - 3, right + 2, bottom + 2,
+                                                                       outline="#1e6fd9", width=4)
+        self.related_selection_text.set(f"{len(self.related_selection)} selected")
+
+    def describe_related(self, canvas, event, candidates):
+        # disabled tiles can't be picked, but they should still say why
+        index = self.contact_sheet.get_index_at(canvas.canvasx(event.x), canvas.canvasy(event.y), include_disabled=True)
+        if index is None:
+            self.related_hover_text.set("")
+            return
+        record, distance, can_add = candidates[index]
+        label = record[1] if distance is None else f"{record[1]} (distance {distance})"
+        if not can_add:
+            label += f" - disc {record[2]}, {record[3]}; can't share a post"
+        self.related_hover_text.set(label)
+
+    # the images around this one in its directory plus the closest matches by perceptual hash from the whole catalog, as
+    # (record, distance, can_add) triples, most alike first. Only images from the same CD and directory can go in the
+    # same post (see TumblrPost.validate), so matches from anywhere else come back with can_add False.
+    def get_related_candidates(self, image):
+        from pycode.objects.similarity_index import hamming_distance
+
+        records = dict([(x[0], x) for x in image.get_nearby_records(self.db_conn)])
+        perceptual_hash = self.get_perceptual_hash(image)
+        similar = self.similarity_index.find_similar(perceptual_hash, self.similar_image_count, exclude_ids={image.id})
+        missing_ids = [x[1] for x in similar if x[1] not in records]
+        if len(missing_ids) > 0:
+            records.update([(x[0], x) for x in self.db_conn.execute_sql_query(*get_images_by_ids_query(missing_ids))])
+
+        candidates = []
+        for record in records.values():
+            # perceptual_hash is the last column
+            distance = hamming_distance(perceptual_hash, record[-1]) \
+                if perceptual_hash is not None and record[-1] is not None else None
+            can_add = record[2] == image.origin_cd and record[3] == image.subdirectories
+            candidates.append((record, distance, can_add))
+        # unhashed images go last, and otherwise images that can be added come before equally close ones that can't
+        candidates.sort(key=lambda x: (x[1] is None, x[1] or 0, not x[2], x[0][7] or 0))
+        return candidates
+
+    # images converted before perceptual hashes existed might not have one yet; the thumbnail gives the same hash
+    def get_perceptual_hash(self, image):
+        if image.perceptual_hash is not None:
+            return image.perceptual_hash
+        try:
+            from pycode.objects.perceptual_hash import compute_dhash
+            image.perceptual_hash = compute_dhash(self.thumbnails.get(image))
+        except Exception as e:
+            logging.warning(f"Could not compute perceptual hash for image {image.id}: {e}")
+        return image.perceptual_hash
+
+    @metrics.time_calls("gui_screen_seconds", screen="start_post")
     def start_post(self):
+        from PIL import ImageTk
+
         self.post = TumblrPost(self.current_image, self.config)
-        image_directory = os.path.join(self.config.get_image_base_dir(), self.current_image.subdirectories)
-        for s in self.related_image_variables:
-            if s.get() != "":
-                print(s.get())
-                db_record = self.db_conn.execute_sql_query(*get_image_by_file_data_query(
-                    s.get(), self.current_image.origin_cd, self.current_image.subdirectories))
-                if db_record is not None and len(db_record) == 1:
-                    self.post.add_image_from_record(db_record[0])
-                    self.post.images[-1].current_tk_pic = ImageTk.PhotoImage(
-                        Image.open(os.path.join(image_directory, s.get())))
-                    self.post.images[-1].alt_text = tk.StringVar()
-                else:
-                    logging.error(f"Could not find image {s.get()} in database, skipping!")
+        # the alt text screen shows several images side by side, so everything there is shown as a thumbnail
+        self.current_image.current_tk_pic = ImageTk.PhotoImage(self.thumbnails.get(self.current_image))
+        # in the order they were shown, not the order they were clicked
+        for image_id, db_record in self.related_image_records.items():
+            if image_id in self.related_selection:
+                self.post.add_image_from_record(db_record)
+                self.post.images[-1].current_tk_pic = ImageTk.PhotoImage(self.thumbnails.get(self.post.images[-1]))
+                self.post.images[-1].alt_text = tk.StringVar()
 
         # alt text is added to images in batches, since if there's like 20 selected they'll overwhelm the whole screen
         self.add_alt_text(0, self.image_labeling_batch_size)
 
+    @metrics.time_calls("gui_screen_seconds", screen="alt_text")
     def add_alt_text(self, lower_bound, upper_bound, is_final=False):
         self.clear_current_display()
         content_frame = ttk.Frame(self.gui_root, padding=25)
@@ -207,10 +655,12 @@ class PostingApp(tk.Frame):
             ttk.Button(content_frame, text="Label next batch", command=lambda: self.add_alt_text(
                 next_lower_bound, next_upper_bound)).grid(column=self.image_labeling_batch_size, row=3)
 
+    @metrics.time_calls("gui_screen_seconds", screen="post_data")
     def add_post_data(self):
         self.clear_current_display()
+        self.post_status.set("")
         for image in self.post.images:
-            print(f"image {image.filename} alt text now set to {image.alt_text.get()}")
+            logging.debug(f"image {image.filename} alt text now set to {image.alt_text.get()}")
         content_frame = ttk.Frame(self.gui_root, padding=25)
         content_frame.grid()
         ttk.Label(content_frame, text="Title:").grid(column=0, row=0)
@@ -219,15 +669,57 @@ class PostingApp(tk.Frame):
         ttk.Entry(content_frame, width=100, textvariable=self.post.tags).grid(column=1, row=1, columnspan=2)
         ttk.Label(content_frame, text="Caption:").grid(column=0, row=2)
         ttk.Entry(content_frame, width=100, textvariable=self.post.caption).grid(column=1, row=2, columnspan=2)
-        ttk.Button(content_frame, text="Review Post", command=self.post_image).grid(column=2, row=3)
+        ttk.Label(content_frame, text="Post after (YYYY-MM-DD HH:MM, blank for as soon as possible):").grid(
+            column=0, row=3)
+        ttk.Entry(content_frame, width=30, textvariable=self.post_target_time).grid(column=1, row=3, sticky=tk.W)
+        ttk.Label(content_frame, textvariable=self.post_status).grid(column=0, row=4, columnspan=3)
+        # queued posts are sent by run_post_worker.py, so queueing doesn't wait on the upload at all
+        ttk.Button(content_frame, text="Queue Post", command=self.queue_post).grid(column=2, row=5)
+        ttk.Button(content_frame, text="Post Now", command=self.post_image).grid(column=1, row=5)
+
+    @metrics.time_calls("gui_screen_seconds", screen="queue_post")
+    def queue_post(self):
+        target_time = self.post_target_time.get().strip()
+        if target_time == "":
+            target_time = dt.datetime.now()
+        else:
+            try:
+                target_time = dt.datetime.strptime(target_time, "%Y-%m-%d %H:%M")
+            except ValueError:
+                self.post_status.set(f"Couldn't read '{target_time}' as a date and time; use YYYY-MM-DD HH:MM")
+                return
+
+        queued_post = QueuedPost.from_tumblr_post(self.post, target_time)
+        with self.db_conn.transaction():
+            self.db_conn.execute_sql_statement(*queued_post.get_insert_statement())
+            for image in self.post.images:
+                self.db_conn.execute_sql_statement(*image.get_update_image_mark_scheduled_statement(target_time))
+        self.discard_posted_directories()
+        self.post_target_time.set("")
 
+        self.clear_current_display()
+        content_frame = ttk.Frame(self.gui_root, padding=25)
+        content_frame.grid()
+        queued_count = self.db_conn.execute_sql_query(queued_post_count_query)[0][0]
+        ttk.Label(content_frame, text=f"Post queued for {target_time:%Y-%m-%d %H:%M}! "
+                                      f"{queued_count} posts are waiting to be sent.").grid(column=0, row=0, columnspan=2)
+        ttk.Label(content_frame, text="What would you like to do next?").grid(column=0, row=1, columnspan=2)
+        ttk.Button(content_frame, text="Post another image", command=self.display_random_image).grid(column=1, row=2)
+        ttk.Button(content_frame, text="Exit", command=self.gui_root.destroy).grid(column=0, row=2)
+
+    @metrics.time_calls("gui_screen_seconds", screen="post_image")
     def post_image(self):
-        print(f"posting image {self.post.images[0].filename}")
+        logging.info(f"posting image {self.post.images[0].filename}")
         self.clear_current_display()
         content_frame = ttk.Frame(self.gui_root, padding=25)
         content_frame.grid()
-        ttk.Label(content_frame, text="Waiting for post to be submitted...").grid(column=0, row=0)
-        response = self.tumblr_conn.send_post(self.post)
+        self.post_status.set("Waiting for post to be submitted...")
+        ttk.Label(content_frame, textvariable=self.post_status).grid(column=0, row=0)
+        # the upload happens on the submitter's thread; these callbacks come back through run_on_ui_thread
+        self.post_submitter.submit(self.post, on_progress=self.post_status.set, on_done=self.show_post_result)
+
+    @metrics.time_calls("gui_screen_seconds", screen="post_result")
+    def show_post_result(self, response, mark_posted_error=None):
         self.clear_current_display()
         content_frame = ttk.Frame(self.gui_root, padding=25)
         content_frame.grid()
@@ -239,9 +731,18 @@ class PostingApp(tk.Frame):
             if response.status_code != 201:
                 ttk.Label(content_frame, text="Post failed!").grid(column=0, row=0, columnspan=2)
                 ttk.Label(content_frame, text=f"Response: {response}").grid(column=0, row=1, columnspan=2)
+            elif mark_posted_error is not None:
+                # posting these again would put a duplicate on the blog
+                ttk.Label(content_frame, text="Post sent, but its images could not be marked as posted!") \
+                    .grid(column=0, row=0, columnspan=2)
+                ttk.Label(content_frame, text=f"Mark images {[x.id for x in self.post.images]} as posted before "
+                                              f"posting again. Error: {mark_posted_error}") \
+                    .grid(column=0, row=1, columnspan=2)
+                self.discard_posted_directories()
             else:
                 ttk.Label(content_frame, text="Post successfully sent!").grid(column=0, row=0, columnspan=2)
+                self.discard_posted_directories()
 
         ttk.Label(content_frame, text="What would you like to do next?").grid(column=0, row=2, columnspan=2)
-        ttk.Button(content_frame, text="Post another image", command=self.start_post).grid(column=1, row=3)
+        ttk.Button(content_frame, text="Post another image", command=self.display_random_image).grid(column=1, row=3)
         ttk.Button(content_frame, text="Exit", command=self.gui_root.destroy).grid(column=0, row=3)
@@ -0,0 +1,129 @@
+import datetime as dt
+import json
+
+from pycode.objects.clipart_image import ClipartImage, get_images_by_ids_query
+from pycode.objects.post_body import build_post_body
+
+# various statements and queries associated with the QueuedPost class but kept outside of it so we can use them without
+# instantiating a QueuedPost first
+table_name = "post_queue"
+create_post_queue_table_statements = {
+    "mysql": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+              "id INT AUTO_INCREMENT PRIMARY KEY, "
+              "image_ids VARCHAR(1000) NOT NULL, "
+              "title VARCHAR(255), "
+              "tags TEXT, "
+              "caption TEXT, "
+              "post_blob MEDIUMTEXT NOT NULL, "
+              "target_time DATETIME NOT NULL, "
+              "status VARCHAR(10) NOT NULL DEFAULT 'queued', "
+              "attempts INT NOT NULL DEFAULT 0, "
+              "last_error TEXT, "
+              "posted_on DATETIME, "
+              "KEY due_posts_key (status, target_time));"],
+    "sqlite": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+               "image_ids VARCHAR(1000) NOT NULL, "
+               "title VARCHAR(255), "
+               "tags TEXT, "
+               "caption TEXT, "
+               "post_blob TEXT NOT NULL, "
+               "target_time DATETIME NOT NULL, "
+               "status VARCHAR(10) NOT NULL DEFAULT 'queued', "
+               "attempts INT NOT NULL DEFAULT 0, "
+               "last_error TEXT, "
+               "posted_on DATETIME);",
+               f"CREATE INDEX IF NOT EXISTS due_posts_key ON {table_name} (status, target_time);"],
+}
+
+# posts left mid-send by a worker that died are put back in the queue when the next worker starts
+requeue_interrupted_posts_statement = f"UPDATE {table_name} SET status = 'queued' WHERE status = 'posting';"
+queued_post_count_query = f"SELECT COUNT(*) FROM {table_name} WHERE status = 'queued';"
+
+
+def get_next_due_post_query(now):
+    next_due_post_query = f"SELECT * FROM {table_name} WHERE status = 'queued' AND target_time <= %s " \
+                          f"ORDER BY target_time, id LIMIT 1;"
+    return next_due_post_query, (now,)
+
+
+class QueuedPost:
+    def __init__(self, image_ids=None, title=None, tags=None, caption=None, post_blob=None, target_time=None,
+                 db_record=None):
+        self.id = None
+        self.image_ids = image_ids
+        self.title = title
+        self.tags = tags
+        self.caption = caption
+        self.post_blob = post_blob
+        self.target_time = target_time
+        self.status = 'queued'
+        self.attempts = 0
+        self.last_error = None
+        self.posted_on = None
+        if db_record is not None:
+            self.id = db_record[0]
+            self.image_ids = [int(x) for x in db_record[1].split(',')]
+            self.title, self.tags, self.caption = db_record[2], db_record[3], db_record[4]
+            self.post_blob = json.loads(db_record[5])
+            self.target_time = db_record[6]
+            self.status, self.attempts, self.last_error, self.posted_on = db_record[7:11]
+
+        # loaded by the worker right before sending, see load_images
+        self.images = None
+        self.image_base_location = None
+
+    @classmethod
+    def from_tumblr_post(cls, tumblr_post, target_time=None):
+        return cls(image_ids=[x.id for x in tumblr_post.images], title=tumblr_post.title.get(),
+                   tags=tumblr_post.tags.get(), caption=tumblr_post.caption.get(),
+                   post_blob=tumblr_post.get_post_blob(), target_time=target_time or dt.datetime.now())
+
+    def __repr__(self):
+        return f"QueuedPost(id={self.id}, image_ids={self.image_ids}, target_time={self.target_time}, " \
+               f"status={self.status}, attempts={self.attempts})"
+
+    def get_insert_statement(self):
+        insert_statement = f"INSERT INTO {table_name} (image_ids, title, tags, caption, post_blob, target_time) " \
+                           f"VALUES (%s, %s, %s, %s, %s, %s);"
+        values = (",".join([str(x) for x in self.image_ids]), self.title, self.tags, self.caption,
+                  json.dumps(self.post_blob, separators=(',', ':')), self.target_time)
+        return insert_statement, values
+
+    # only succeeds (affects a row) if no other worker claimed the post first
+    def get_claim_statement(self):
+        claim_statement = f"UPDATE {table_name} SET status = 'posting', attempts = attempts + 1 " \
+                          f"WHERE id = %s AND status = 'queued';"
+        return claim_statement, (self.id,)
+
+    def get_mark_sent_statement(self):
+        update_statement = f"UPDATE {table_name} SET status = 'posted', posted_on = %s, last_error = NULL " \
+                           f"WHERE id = %s;"
+        return update_statement, (dt.datetime.now(), self.id)
+
+    # with a retry_at time the post goes back in the queue for then; without one it's given up on. Claiming a post counts
+    # an attempt, so count_attempt=False takes it back off again for failures that weren't the post's fault.
+    def get_mark_failed_statement(self, error, retry_at=None, count_attempt=True):
+        if retry_at is not None:
+            attempts_update = "" if count_attempt else "attempts = attempts - 1, "
+            update_statement = f"UPDATE {table_name} SET status = 'queued', target_time = %s, {attempts_update}" \
+                               f"last_error = %s WHERE id = %s;"
+            return update_statement, (retry_at, error, self.id)
+        update_statement = f"UPDATE {table_name} SET status = 'failed', last_error = %s WHERE id = %s;"
+        return update_statement, (error, self.id)
+
+    def get_images_query(self):
+        return get_images_by_ids_query(self.image_ids)
+
+    # loads the post's images, in the order they were queued in
+    def load_images(self, db_conn, image_base_location):
+        images_by_id = dict([(x[0], ClipartImage(*x)) for x in db_conn.execute_sql_query(*self.get_images_query())])
+        missing_ids = [x for x in self.image_ids if x not in images_by_id]
+        if len(missing_ids) > 0:
+            raise ValueError(f"Images {missing_ids} for queued post {self.id} are no longer in the database")
+        self.images = [images_by_id[x] for x in self.image_ids]
+        self.image_base_location = image_base_location
+
+    # matches TumblrPost.get_formatted, so TumblrConnection can send either
+    def get_formatted(self, post_blob=None):
+        return build_post_body(self.images, post_blob or self.post_blob, self.image_base_location)
@@ -0,0 +1,89 @@
+import heapq
+import logging
+import threading
+
+from pycode.objects.clipart_image import perceptual_hashes_query
+
+
+def hamming_distance(first_hash, second_hash):
+    return (first_hash ^ second_hash).bit_count()
+
+
+# BK-tree over 64-bit perceptual hashes, keyed by Hamming distance. Each node holds one hash, the ids of every image
+# with exactly that hash, and its children by their distance from it. Since Hamming distance is a metric, a search
+# only has to descend into the children whose distance from the node is within the search radius of the query's.
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, perceptual_hash, image_id):
+        self.size += 1
+        if self.root is None:
+            self.root = [perceptual_hash, [image_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(perceptual_hash, node[0])
+            if distance == 0:
+                node[1].append(image_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [perceptual_hash, [image_id], {}]
+                return
+            node = child
+
+    # returns up to k (distance, image id) pairs, closest first, no further than max_distance away. The search radius
+    # shrinks to the kth best distance found so far, so close matches prune most of the tree.
+    def find_nearest(self, perceptual_hash, k, max_distance=64, exclude_ids=()):
+        if self.root is None or k <= 0:
+            return []
+        # max-heap of the best k so far, stored negated
+        best = []
+        radius = max_distance
+        pending_nodes = [self.root]
+        while len(pending_nodes) > 0:
+            node = pending_nodes.pop()
+            distance = hamming_distance(perceptual_hash, node[0])
+            if distance <= radius:
+                for image_id in node[1]:
+                    if image_id in exclude_ids:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, image_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, image_id))
+                if len(best) == k:
+                    radius = min(radius, -best[0][0])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    pending_nodes.append(child)
+        return sorted([(-x[0], x[1]) for x in best])
+
+
+# In-memory similarity search over the perceptual hash of every converted image in the catalog. Loading the whole
+# catalog takes a few seconds, so it's done on a background thread and find_similar just returns nothing until it's
+# ready.
+class SimilarityIndex:
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.tree = BKTree()
+        self.ready = threading.Event()
+
+    def load(self):
+        tree = BKTree()
+        for image_id, perceptual_hash in self.db_conn.stream_sql_query(perceptual_hashes_query):
+            tree.add(perceptual_hash, image_id)
+        self.tree = tree
+        self.ready.set()
+        logging.info("Loaded {0} perceptual hashes into the similarity index".format(tree.size))
+
+    def load_in_background(self):
+        threading.Thread(target=self.load, name="similarity-index", daemon=True).start()
+
+    # returns up to k (distance, image id) pairs for the images that look most like the given hash, closest first
+    def find_similar(self, perceptual_hash, k=20, max_distance=16, exclude_ids=()):
+        if perceptual_hash is None or not self.ready.is_set():
+            return []
+        return self.tree.find_nearest(perceptual_hash, k, max_distance, exclude_ids)
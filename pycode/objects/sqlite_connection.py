@@ -0,0 +1,177 @@
+import datetime as dt
+import os
+import queue
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+from pycode.objects.database_connection import DatabaseConnection
+
+# SQLite integers are signed 64-bit, so unsigned 64-bit values (perceptual hashes) are stored wrapped around into the
+# negatives and unwrapped again on the way out by the UINT64 converter below
+max_integer = 2 ** 63 - 1
+
+# datetimes are stored as ISO 8601 text, which sorts and compares in time order. Only columns declared DATETIME come
+# back as datetimes; computed ones stay text.
+sqlite3.register_adapter(dt.datetime, lambda x: x.isoformat(" "))
+sqlite3.register_converter("DATETIME", lambda x: dt.datetime.fromisoformat(x.decode()))
+sqlite3.register_converter("UINT64", lambda x: int(x) % 2 ** 64)
+
+
+# the statements are written with mysql.connector's %s placeholders; sqlite3 takes ?
+def get_sqlite_statement(statement):
+    return statement.replace("%s", "?")
+
+
+def get_sqlite_values(values):
+    if values is None:
+        return ()
+    return [x - 2 ** 64 if type(x) is int and x > max_integer else x for x in values]
+
+
+# Single-file backend for running the catalog without a MySQL server, with the same interface as MysqlConnection. The
+# database is kept in WAL mode, so readers (the GUI, the prefetcher) never wait on the writer and vice versa; writers
+# queue behind each other for up to busy_timeout seconds.
+#
+# Connections are pooled and checked out per statement like MysqlConnection's. Within a transaction() block every
+# statement the thread runs goes through the same connection; outside of one, each statement commits on its own.
+class SqliteConnection(DatabaseConnection):
+    dialect = "sqlite"
+
+    def __init__(self, config, busy_timeout=30):
+        self.path = config.get_sqlite_path()
+        self.busy_timeout = busy_timeout
+        self.idle_connections = queue.LifoQueue()
+        self.thread_state = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.idle_connections.put(self.get_connection())
+
+    def __del__(self):
+        self.close_connection()
+
+    # isolation_level=None leaves sqlite3 in autocommit mode, so transactions only start where transaction() says
+    def get_connection(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        # with WAL, NORMAL only risks the last few commits on power loss, never corruption
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        return conn
+
+    # closes every connection that isn't checked out; ones that are get closed when they're handed back
+    def close_connection(self):
+        while True:
+            try:
+                self.idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    # checks a connection out of the pool for the duration of the with block. If this thread is inside a transaction,
+    # its connection is reused instead.
+    @contextmanager
+    def connection(self):
+        transaction_conn = getattr(self.thread_state, "transaction_conn", None)
+        if transaction_conn is not None:
+            yield transaction_conn
+            return
+
+        try:
+            conn = self.idle_connections.get_nowait()
+        except queue.Empty:
+            conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            self.idle_connections.put(conn)
+
+    @property
+    def in_transaction(self):
+        return getattr(self.thread_state, "transaction_conn", None) is not None
+
+    # groups every statement this thread executes inside the with block into one transaction, which is committed when
+    # the block exits or rolled back if it raises
+    @contextmanager
+    def transaction(self):
+        if self.in_transaction:
+            yield
+            return
+
+        with self.connection() as conn:
+            # IMMEDIATE takes the write lock up front, so a transaction that reads before it writes waits for other
+            # writers at the start instead of failing when it tries to upgrade its lock
+            conn.execute("BEGIN IMMEDIATE;")
+            self.thread_state.transaction_conn = conn
+            try:
+                yield
+                conn.commit()
+            except Exception:
+                # some errors make SQLite roll back by itself
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                self.thread_state.transaction_conn = None
+
+    # returns the number of rows the statement affected
+    def execute_sql_statement(self, statement, values=None):
+        with self.time_statement(statement), self.connection() as conn:
+            cursor = conn.execute(get_sqlite_statement(statement), get_sqlite_values(values))
+            try:
+                self.count_rows(statement, cursor.rowcount, "affected")
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    # runs the same statement once per entry of values_list in a single transaction
+    def execute_many_sql_statements(self, statement, values_list):
+        with self.time_statement(statement), self.transaction():
+            with self.connection() as conn:
+                cursor = conn.executemany(get_sqlite_statement(statement), [get_sqlite_values(x) for x in values_list])
+                self.count_rows(statement, cursor.rowcount, "affected")
+
+    def execute_sql_query(self, query, values=None):
+        with self.time_statement(query), self.connection() as conn:
+            cursor = conn.execute(get_sqlite_statement(query), get_sqlite_values(values))
+            try:
+                results = cursor.fetchall()
+            finally:
+                cursor.close()
+        self.count_rows(query, len(results), "returned")
+        return results
+
+    # yields the results of a query one row at a time without loading them all into memory. The connection stays
+    # checked out until the generator is exhausted or closed. Under WAL the query reads from a snapshot, so writes made
+    # while iterating (from this thread or any other) don't show up in it.
+    def stream_sql_query(self, query, values=None, chunk_size=1000):
+        with self.connection() as conn:
+            # only the query itself is timed; how long the rows take to go through is up to the caller
+            with self.time_statement(query):
+                cursor = conn.execute(get_sqlite_statement(query), get_sqlite_values(values))
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        return
+                    self.count_rows(query, len(rows), "returned")
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    def index_exists(self, table, index_name):
+        results = self.execute_sql_query("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s "
+                                         "AND name = %s;", (table, index_name))
+        return results[0][0] > 0
+
+    def column_exists(self, table, column_name):
+        results = self.execute_sql_query("SELECT COUNT(*) FROM pragma_table_info(%s) WHERE name = %s;",
+                                         (table, column_name))
+        return results[0][0] > 0
+
+    def trigger_exists(self, table, trigger_name):
+        results = self.execute_sql_query("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s "
+                                         "AND name = %s;", (table, trigger_name))
+        return results[0][0] > 0
@@ -0,0 +1,21 @@
+import logging
+import time
+
+
+# Records how long the GUI takes to get from launch to each startup milestone, ending with the first image on screen.
+# started_at should be taken before anything heavy is imported so the import time is counted too.
+class StartupProfile:
+    def __init__(self, started_at=None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.milestones = []
+        self.finished = False
+
+    def mark(self, milestone):
+        self.milestones.append((milestone, time.perf_counter() - self.started_at))
+
+    def report(self):
+        self.finished = True
+        previous = 0
+        for milestone, elapsed in self.milestones:
+            logging.info("Startup: {0:<20} {1:8.3f}s (+{2:.3f}s)".format(milestone, elapsed, elapsed - previous))
+            previous = elapsed
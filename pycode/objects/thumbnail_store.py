@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+# Fixed-size preview thumbnails, kept in a sidecar directory next to (not inside) the converted images. Thumbnails are
+# keyed by a digest of the image's catalog key (subdirectories + filename) rather than its id, because the converter
+# writes them before the record's id exists. Files are fanned out into subdirectories by the first two characters of
+# the digest so no single directory ends up holding the whole catalog.
+class ThumbnailStore:
+    def __init__(self, cache_dir, size=(400, 400)):
+        self.cache_dir = cache_dir
+        self.size = size
+
+    @staticmethod
+    def get_key(subdirectories, filename):
+        return hashlib.blake2b(os.path.join(subdirectories, filename).encode("utf-8"), digest_size=16).hexdigest()
+
+    def get_thumbnail_path(self, subdirectories, filename):
+        key = self.get_key(subdirectories, filename)
+        return os.path.join(self.cache_dir, key[:2], "{0}.png".format(key))
+
+    def has_thumbnail(self, subdirectories, filename):
+        return os.path.exists(self.get_thumbnail_path(subdirectories, filename))
+
+    # writes to a temporary file first so a crash mid-write never leaves a truncated thumbnail behind
+    def save_thumbnail(self, image, thumbnail_path):
+        directory = os.path.dirname(thumbnail_path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        thumbnail = image.copy()
+        thumbnail.thumbnail(self.size)
+        if thumbnail.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            thumbnail = thumbnail.convert("RGBA")
+        temp_path = "{0}.{1}.tmp".format(thumbnail_path, os.getpid())
+        thumbnail.save(temp_path, "png")
+        os.replace(temp_path, thumbnail_path)
+        return thumbnail
+
+    def create_thumbnail(self, image_path, thumbnail_path):
+        with Image.open(image_path) as im:
+            im.draft(None, self.size)
+            return self.save_thumbnail(im, thumbnail_path)
+
+    def load_thumbnail(self, subdirectories, filename):
+        thumbnail_path = self.get_thumbnail_path(subdirectories, filename)
+        with Image.open(thumbnail_path) as im:
+            im.load()
+            return im.copy()
+
+
+# In-memory LRU in front of a ThumbnailStore, capped by the decoded size of the thumbnails it holds. If a thumbnail
+# hasn't been generated yet, it's made on the spot from the full image and written to the store for next time.
+# Safe to share between threads; the GUI fills it from a background thread while building the contact sheet.
+class ThumbnailCache:
+    def __init__(self, store, image_base_dir, max_bytes=64 * 1024 * 1024):
+        self.store = store
+        self.image_base_dir = image_base_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, image):
+        key = (image.subdirectories, image.filename)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        # loaded without holding the lock, so a slow load doesn't hold up the thread using the ones already cached
+        try:
+            thumbnail = self.store.load_thumbnail(image.subdirectories, image.filename)
+        except (OSError, ValueError):
+            logging.debug("No thumbnail for {0}; making one from the full image".format(image.filename))
+            thumbnail = self.store.create_thumbnail(image.get_converted_image_path(self.image_base_dir),
+                                                    self.store.get_thumbnail_path(image.subdirectories,
+                                                                                  image.filename))
+
+        with self.lock:
+            if key in self.entries:
+                # another thread loaded it in the meantime
+                return self.entries[key]
+            self.entries[key] = thumbnail
+            self.current_bytes += self.get_size(thumbnail)
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= self.get_size(evicted)
+        return thumbnail
+
+    @staticmethod
+    def get_size(image):
+        return image.width * image.height * len(image.getbands())
@@ -1,18 +1,44 @@
 import datetime as dt
+import json
 import pickle
 
 # various statements and queries associated with the Token class but kept outside of it so we can use them without
-# instantiating a Token first
+# instantiating a Token first. expires_on is stored in UTC, so it's compared against the current UTC time, which is
+# passed in rather than asked of the database so the statements are the same for every backend.
 table_name = "tokens"
-create_token_table_statement = f"CREATE TABLE IF NOT EXISTS {table_name} (" \
-                               "id INT AUTO_INCREMENT PRIMARY KEY, " \
-                               "token BLOB NOT NULL, expires_on " \
-                               "DATETIME NOT NULL);"
-delete_expired_tokens_statement = f"DELETE FROM {table_name} WHERE expires_on < NOW();"
+create_token_table_statements = {
+    "mysql": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+              "id INT AUTO_INCREMENT PRIMARY KEY, "
+              "token BLOB NOT NULL, expires_on "
+              "DATETIME NOT NULL);"],
+    "sqlite": [f"CREATE TABLE IF NOT EXISTS {table_name} ("
+               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+               "token BLOB NOT NULL, expires_on "
+               "DATETIME NOT NULL);"],
+}
+# the columns a transfer between backends copies
+token_columns = ['id', 'token', 'expires_on']
 
 select_all_tokens_query = f"SELECT id, token, expires_on FROM {table_name} ORDER BY expires_on DESC;"
-get_latest_token_query = f"SELECT id, token, expires_on FROM {table_name} WHERE expires_on > NOW() " \
+# tokens used to be pickled; json serializations always start with a brace. Only MySQL catalogs ever had pickled tokens.
+legacy_tokens_query = f"SELECT id, token, expires_on FROM {table_name} WHERE LEFT(token, 1) != '{{';"
+
+
+def get_delete_expired_tokens_statement(utc_now):
+    delete_statement = f"DELETE FROM {table_name} WHERE expires_on < %s;"
+    return delete_statement, (utc_now,)
+
+
+def get_latest_token_query(utc_now):
+    latest_token_query = f"SELECT id, token, expires_on FROM {table_name} WHERE expires_on > %s " \
                          f"ORDER BY expires_on DESC LIMIT 1;"
+    return latest_token_query, (utc_now,)
+
+
+# a refreshed token replaces every token that expires before it, since refreshing invalidates the old refresh token
+def get_delete_superseded_tokens_statement(expires_on):
+    delete_statement = f"DELETE FROM {table_name} WHERE expires_on < %s;"
+    return delete_statement, (expires_on,)
 
 
 class Token:
@@ -21,17 +47,36 @@ class Token:
         self.token = token
         if db_record is not None:
             self.id = db_record[0]
-            self.token = pickle.loads(db_record[1])
+            self.token = json.loads(db_record[1])
 
     def __repr__(self):
         return f"Token(id={self.id}, expires_on={self.token['expires_at']})"
 
+    # only for converting rows written before tokens were stored as json; see MysqlConnection.convert_legacy_tokens.
+    # Never used on anything but our own database.
+    @classmethod
+    def from_legacy_record(cls, db_record):
+        return cls(id=db_record[0], token=pickle.loads(db_record[1]))
+
+    @property
+    def expires_at(self):
+        return self.token['expires_at']
+
+    def get_expiration_time(self):
+        return dt.datetime.utcfromtimestamp(self.expires_at)
+
+    def serialize(self):
+        return json.dumps(self.token, separators=(',', ':')).encode("utf-8")
+
     def get_insert_statement(self):
         insert_statement = f"INSERT INTO {table_name} (token, expires_on) VALUES (%s, %s);"
-        expiration_time = dt.datetime.utcfromtimestamp(self.token['expires_at'])
-        values = (pickle.dumps(self.token), expiration_time.isoformat())
+        values = (self.serialize(), self.get_expiration_time())
         return insert_statement, values
 
+    def get_update_token_statement(self):
+        update_statement = f"UPDATE {table_name} SET token = %s WHERE id = %s;"
+        return update_statement, (self.serialize(), self.id)
+
     def get_delete_statement(self):
         delete_statement = f"DELETE FROM {table_name} WHERE id = %s;"
         values = (self.id,)
@@ -0,0 +1,98 @@
+import datetime as dt
+import logging
+import threading
+import time
+
+from requests_oauthlib import OAuth2Session
+from pycode.objects.token import get_latest_token_query, get_delete_expired_tokens_statement, \
+    get_delete_superseded_tokens_statement, Token
+
+
+# In-process cache of the current Tumblr OAuth token. Instead of letting OAuth2Session refresh the token lazily halfway
+# through a post upload, a timer refreshes it refresh_margin seconds before it expires, and listeners (e.g. the
+# TumblrConnection's session) are handed the new token. Since the GUI and the post worker can both be running, the
+# database is checked for a newer token before refreshing, in case the other process already did.
+#
+# Every time a token is saved, expired and superseded token rows are deleted so the table only ever holds the latest.
+class TokenManager:
+    def __init__(self, db_conn, client_id, client_secret, token_url, refresh_margin=600):
+        self.db_conn = db_conn
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.token_obj = None
+        self.listeners = []
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # loads the latest unexpired token from the database; returns False if there isn't one
+    def load(self):
+        with self.lock:
+            utc_now = dt.datetime.utcnow()
+            self.db_conn.execute_sql_statement(*get_delete_expired_tokens_statement(utc_now))
+            latest_token_record = self.db_conn.execute_sql_query(*get_latest_token_query(utc_now))
+            if latest_token_record is None or len(latest_token_record) == 0:
+                return False
+            self.set_token(Token(db_record=latest_token_record[0]))
+            return True
+
+    # returns the current token, refreshing it first if it's about to expire and the timer somehow hasn't
+    def get_token(self):
+        with self.lock:
+            if self.token_obj is None:
+                return None
+            if self.token_obj.expires_at - time.time() < self.refresh_margin:
+                self.refresh()
+            return self.token_obj.token
+
+    # saves a newly fetched or refreshed token. Also used as OAuth2Session's token_updater.
+    def store(self, token):
+        with self.lock:
+            token_obj = Token(token=token)
+            with self.db_conn.transaction():
+                self.db_conn.execute_sql_statement(*token_obj.get_insert_statement())
+                self.db_conn.execute_sql_statement(
+                    *get_delete_superseded_tokens_statement(token_obj.get_expiration_time()))
+            self.set_token(token_obj)
+
+    def refresh(self):
+        with self.lock:
+            # another process sharing the database may have refreshed already
+            stored_token = self.token_obj
+            if self.load() and self.token_obj.expires_at - time.time() >= self.refresh_margin:
+                if stored_token is None or self.token_obj.expires_at > stored_token.expires_at:
+                    logging.info("Picked up a token refreshed by another process")
+                return
+
+            logging.info("Refreshing Tumblr token before it expires")
+            session = OAuth2Session(client_id=self.client_id, token=self.token_obj.token)
+            try:
+                token = session.refresh_token(self.token_url, client_id=self.client_id,
+                                              client_secret=self.client_secret)
+            except Exception as e:
+                logging.error("Could not refresh Tumblr token: {0}".format(e))
+                self.schedule_refresh(retry=True)
+                return
+            self.store(token)
+
+    def set_token(self, token_obj):
+        self.token_obj = token_obj
+        for listener in self.listeners:
+            listener(token_obj.token)
+        self.schedule_refresh()
+
+    def schedule_refresh(self, retry=False):
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = 60 if retry else max(0, self.token_obj.expires_at - time.time() - self.refresh_margin)
+        self.timer = threading.Timer(delay, self.refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
@@ -0,0 +1,90 @@
+import logging
+
+from pycode.objects.clipart_image import get_bulk_mark_corrupted_statement, get_bulk_mark_skipped_statement, \
+    ClipartImage
+
+# what each key does to the selected tile in triage mode. Keep sends the image on to be posted, skip and corrupted are
+# written to the catalog when the grid is committed, and later leaves it fresh to come up again some other time.
+decision_keys = {"k": "keep", "s": "skip", "c": "corrupted", "l": "later"}
+# tiles nobody decided on are left fresh, same as later
+default_decision = "later"
+
+
+# A page of fresh images for triage mode, shown as one contact sheet, and what's been decided about each. Decisions
+# only live here until commit writes the skipped and corrupted ones in a single transaction.
+class TriageGrid:
+    def __init__(self, images, sheet):
+        self.images = images
+        self.sheet = sheet
+        # tile index -> decision
+        self.decisions = {}
+
+    def decide(self, index, decision):
+        if decision == default_decision:
+            self.decisions.pop(index, None)
+        else:
+            self.decisions[index] = decision
+
+    def get_decision(self, index):
+        return self.decisions.get(index, default_decision)
+
+    def get_images(self, decision):
+        return [x for index, x in enumerate(self.images) if self.get_decision(index) == decision]
+
+    # one statement per kind of decision, however many tiles it covers
+    def get_decision_statements(self):
+        statements = []
+        skipped_ids = [x.id for x in self.get_images("skip")]
+        if len(skipped_ids) > 0:
+            statements.append(get_bulk_mark_skipped_statement(skipped_ids))
+        corrupted_ids = [x.id for x in self.get_images("corrupted")]
+        if len(corrupted_ids) > 0:
+            statements.append(get_bulk_mark_corrupted_statement(corrupted_ids))
+        return statements
+
+    def commit(self, db_conn):
+        statements = self.get_decision_statements()
+        if len(statements) == 0:
+            return
+        with db_conn.transaction():
+            for statement in statements:
+                db_conn.execute_sql_statement(*statement)
+
+
+# picks `size` distinct fresh images with the sampler, leaving out exclude_ids (the grid on screen, images kept for
+# posting), and builds their sheet from thumbnails. Meant to run on a background thread. The grid can come up short if
+# the catalog is running out of fresh images.
+def build_triage_grid(sampler, thumbnails, size, tile_size, columns, exclude_ids=()):
+    # imported here rather than at the top so PostingApp can import this module without pulling in PIL
+    from pycode.objects.contact_sheet import ContactSheet, ContactSheetTile
+
+    picked_ids = set(exclude_ids)
+    images = []
+    # the sampler picks independently each time, so allow some repeats before giving up
+    for _ in range(size * 3):
+        if len(images) >= size:
+            break
+        record = sampler.pick()
+        if record is None:
+            break
+        if record[0] in picked_ids:
+            continue
+        picked_ids.add(record[0])
+        try:
+            images.append(ClipartImage(*record))
+        except Exception as e:
+            # e.g. a saved .htm file, which the summary counts as fresh but can't be shown or posted
+            logging.error("Could not load image {0} for triage: {1}".format(record[0], e))
+
+    tiles = []
+    for image in images:
+        try:
+            thumbnail = thumbnails.get(image)
+        except Exception as e:
+            # most likely a file that didn't convert properly; it gets a blank tile so it can be marked corrupted
+            logging.warning(f"Could not load a thumbnail for image {image.id}: {e}")
+            thumbnail = None
+        tiles.append(ContactSheetTile(image.id, thumbnail, image.filename))
+    sheet = ContactSheet(tiles, tile_size, columns)
+    sheet.build()
+    return TriageGrid(images, sheet)
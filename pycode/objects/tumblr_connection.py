@@ -1,8 +1,16 @@
 import logging
+import random
+import time
 import keyring
+import requests
 
 from requests_oauthlib import OAuth2Session
-from pycode.objects.token import get_latest_token_query, Token
+from pycode.objects import metrics
+from pycode.objects.token_manager import TokenManager
+
+
+# status codes worth retrying a post for: rate limiting and the server having a bad moment
+retryable_status_codes = (429, 500, 502, 503, 504)
 
 
 class TumblrConnection:
@@ -14,25 +22,37 @@ class TumblrConnection:
         self.client_secret = keyring.get_password("tumblr", "client_secret")
         self.post_url = self.urls['post'].format(blogname=self.config.get_blogname())
         self.photo_dir = self.config.get_image_base_dir()
-        self.token_obj = None
         self.session = None
+        self.token_manager = TokenManager(self.db_conn, self.client_id, self.client_secret, self.urls['token'],
+                                          self.config.get_token_refresh_margin())
+        self.token_manager.add_listener(self.update_session_token)
+
+    @property
+    def token_obj(self):
+        return self.token_manager.token_obj
 
     def auth_if_token_present(self):
-        latest_token_record = self.db_conn.execute_sql_query(get_latest_token_query)
-        if latest_token_record is None or len(latest_token_record) == 0:
+        if not self.token_manager.load():
             logging.info("No token found; need to authenticate")
             return False
         else:
             logging.info("Token found; no need to authenticate")
-            self.token_obj = Token(db_record=latest_token_record[0])
-            self.session = OAuth2Session(client_id=self.client_id,
-                                         token=self.token_obj.token,
-                                         auto_refresh_url=self.urls['token'],
-                                         auto_refresh_kwargs={"client_id": self.client_id,
-                                                              "client_secret": self.client_secret},
-                                         token_updater=self.update_token)
+            self.create_session()
             return True
 
+    # the token manager refreshes the token ahead of time, so the session's own auto refresh is only a fallback
+    def create_session(self):
+        self.session = OAuth2Session(client_id=self.client_id,
+                                     token=self.token_manager.get_token(),
+                                     auto_refresh_url=self.urls['token'],
+                                     auto_refresh_kwargs={"client_id": self.client_id,
+                                                          "client_secret": self.client_secret},
+                                     token_updater=self.token_manager.store)
+
+    def update_session_token(self, token):
+        if self.session is not None:
+            self.session.token = token
+
     def get_auth_url(self):
         self.session = OAuth2Session(client_id=self.client_id,
                                      redirect_uri=self.urls['redirect'],
@@ -42,17 +62,86 @@ class TumblrConnection:
         return authorization_url[0]
 
     def token_from_redirect_response(self, redirect_response):
-        self.token_obj = Token(token=self.session.fetch_token(self.urls['token'],
-                                                              authorization_response=redirect_response,
-                                                              client_secret=self.client_secret))
-        self.db_conn.execute_sql_statement(*self.token_obj.get_insert_statement())
+        self.token_manager.store(self.session.fetch_token(self.urls['token'],
+                                                          authorization_response=redirect_response,
+                                                          client_secret=self.client_secret))
+        self.create_session()
 
-    def update_token(self, token):
-        self.token_obj = Token(token=token)
-        self.db_conn.execute_sql_statement(*self.token_obj.get_insert_statement())
-
-    def send_post(self, tumblr_post):
+    def send_post(self, tumblr_post, post_blob=None):
         if self.session is None or self.token_obj is None:
             logging.error("Session or token object is None; cannot post! Please authenticate first")
             return None
-        return self.session.post(self.post_url, files=tumblr_post.get_formatted())
+        self.session.token = self.token_manager.get_token()
+        body = tumblr_post.get_formatted(post_blob)
+        metrics.observe("tumblr_upload_bytes", len(body), buckets=metrics.size_buckets)
+        try:
+            with metrics.timer("tumblr_send_seconds"):
+                response = self.session.post(self.post_url, data=body, headers={'Content-Type': body.content_type})
+        except requests.exceptions.RequestException as e:
+            metrics.increment("tumblr_responses_total", status=type(e).__name__)
+            raise
+        metrics.increment("tumblr_responses_total", status=str(response.status_code))
+        return response
+
+    # sends a post, retrying rate limited or failed attempts with exponential backoff (plus some jitter), up to
+    # max_attempts times in total. on_progress, if given, is called with a short status message before every attempt
+    # and wait. Returns the last response, or None if no response was ever received.
+    # post_blob should come from tumblr_post.get_post_blob() when this runs off the Tk thread.
+    def send_post_with_retries(self, tumblr_post, post_blob=None, max_attempts=5, base_delay=2, max_delay=300,
+                               on_progress=None):
+        response = None
+        for attempt in range(max_attempts):
+            if on_progress is not None:
+                on_progress(f"Submitting post (attempt {attempt + 1} of {max_attempts})...")
+            try:
+                response = self.send_post(tumblr_post, post_blob)
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Post attempt {attempt + 1} failed: {e}")
+                response = None
+            else:
+                if response is None or response.status_code not in retryable_status_codes:
+                    return response
+                logging.warning(f"Post attempt {attempt + 1} failed with status {response.status_code}")
+
+            if attempt == max_attempts - 1:
+                break
+            delay = self.get_retry_delay(response, attempt, base_delay, max_delay)
+            if delay is None:
+                logging.error("Rate limit won't reset soon enough to retry; giving up")
+                break
+            if on_progress is not None:
+                on_progress(f"Post attempt {attempt + 1} failed; retrying in {int(delay)} seconds...")
+            time.sleep(delay)
+        return response
+
+    # seconds until the first exhausted Tumblr rate limit (daily, then hourly) resets, or None if there's still room
+    @staticmethod
+    def get_rate_limit_reset(response):
+        if response is None:
+            return None
+        for period in ('Perday', 'Perhour'):
+            if response.headers.get(f'X-Ratelimit-{period}-Remaining') == '0' and \
+                    response.headers.get(f'X-Ratelimit-{period}-Reset', '').isdigit():
+                return int(response.headers[f'X-Ratelimit-{period}-Reset'])
+        return None
+
+    # how long to wait before the next attempt. A Retry-After header or an exhausted Tumblr rate limit wins over the
+    # exponential backoff; returns None if that wait would be longer than max_delay.
+    @staticmethod
+    def get_retry_delay(response, attempt, base_delay, max_delay):
+        backoff = min(max_delay, base_delay * (2 ** attempt)) * random.uniform(0.8, 1.2)
+        if response is None:
+            return backoff
+
+        headers = response.headers
+        server_delay = None
+        if headers.get('Retry-After', '').isdigit():
+            server_delay = int(headers['Retry-After'])
+        elif response.status_code == 429:
+            server_delay = TumblrConnection.get_rate_limit_reset(response)
+
+        if server_delay is None:
+            return backoff
+        if server_delay > max_delay:
+            return None
+        return max(server_delay, backoff)
@@ -1,7 +1,9 @@
 import json
+import logging
 import tkinter as tk
 
 from pycode.objects.clipart_image import ClipartImage
+from pycode.objects.post_body import build_post_body
 
 
 class TumblrPost:
@@ -41,15 +43,12 @@ class TumblrPost:
                 if image.origin_cd != origin_cd or image.subdirectories != subdirectories:
                     raise Exception("Images must be from the same CD and directory")
 
-    def get_formatted(self):
-        post_data = {}
+    # builds the json part of the post from the current values of the tkinter variables. Has to be called on the Tk
+    # thread; the result is plain data that can be handed to a background thread and reused across retries.
+    def get_post_blob(self):
         content = []
         for image in self.images:
             image_identifier = f"image_{image.id}"
-            post_data[image_identifier] = (image_identifier,
-                                           open(image.get_converted_image_path(self.image_base_location), 'rb'),
-                                           image.mimetype,
-                                           {'Expires': '0'})
             content.append({
                 "type": "image",
                 "media": [{"type": image.mimetype, "identifier": image_identifier}],
@@ -87,7 +86,6 @@ class TumblrPost:
                 {"blocks": [len(self.images) + 1]}  # attribution
             ]
         }
-        print(layout)
 
         blob = {
             'state': self.publish_state,
@@ -95,10 +93,13 @@ class TumblrPost:
             "content": content,
             "layout": [layout]
         }
-        print(json.dumps(blob, separators=(',', ':'), indent=4))
-        post_data['json'] = (None, json.dumps(blob, separators=(',', ':')), 'application/json')
+        logging.debug("Post json: {0}".format(json.dumps(blob, separators=(',', ':'))))
+        return blob
 
-        return post_data
+    def get_formatted(self, post_blob=None):
+        if post_blob is None:
+            post_blob = self.get_post_blob()
+        return build_post_body(self.images, post_blob, self.image_base_location)
 
     def add_image_from_record(self, db_record):
         image_obj = ClipartImage(*db_record)
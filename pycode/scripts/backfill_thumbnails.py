@@ -0,0 +1,64 @@
+"""
+Generates the preview thumbnails for images that were converted before convert.py started writing them, or whose
+thumbnails went missing. Images that already have a thumbnail are left alone, so it's safe to rerun at any time.
+Pass CD numbers to only backfill those CDs; with no arguments every converted image in the database is checked.
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pycode.config.config import Config
+from pycode.objects.clipart_image import get_converted_images_query
+from pycode.objects.database_connection import get_database_connection
+from pycode.objects.thumbnail_store import ThumbnailStore
+
+
+# runs in a worker process. Returns the error message if the thumbnail couldn't be made, otherwise None.
+def create_thumbnail(thumbnail_store, image_path, thumbnail_path):
+    try:
+        thumbnail_store.create_thumbnail(image_path, thumbnail_path)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def get_missing_thumbnails(db_conn, thumbnail_store, image_base_dir, origin_cd=None):
+    for record in db_conn.stream_sql_query(*get_converted_images_query(origin_cd)):
+        filename, subdirectories = record[1], record[3]
+        # the .htm files saved off the CDs are catalogued too, but there's nothing to preview
+        if os.path.splitext(filename)[1].lower() == ".htm":
+            continue
+        if not thumbnail_store.has_thumbnail(subdirectories, filename):
+            yield (os.path.join(image_base_dir, subdirectories, filename),
+                   thumbnail_store.get_thumbnail_path(subdirectories, filename))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate missing preview thumbnails for converted images.")
+    parser.add_argument("cd_numbers", nargs="*", type=int, help="only backfill these CDs")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    db_conn = get_database_connection(config)
+    image_base_dir = config.get_image_base_dir()
+    thumbnail_store = ThumbnailStore(config.get_thumbnail_cache_dir(), config.get_thumbnail_size())
+
+    with ProcessPoolExecutor(max_workers=config.get_conversion_worker_count()) as executor:
+        for cd_number in args.cd_numbers or [None]:
+            logging.info("Backfilling thumbnails for {0}...".format(
+                "CD {0}".format(cd_number) if cd_number is not None else "all CDs"))
+            missing = list(get_missing_thumbnails(db_conn, thumbnail_store, image_base_dir, cd_number))
+            errors = []
+            for index, error in enumerate(executor.map(create_thumbnail, [thumbnail_store] * len(missing),
+                                                       [x[0] for x in missing], [x[1] for x in missing],
+                                                       chunksize=64)):
+                if index % 1000 == 0 and index > 0:
+                    logging.info("\tprocessed {0}...".format(index))
+                if error is not None:
+                    errors.append((missing[index][0], error))
+
+            logging.info("Created {0} thumbnails, {1} errors".format(len(missing) - len(errors), len(errors)))
+            for image_path, error in errors:
+                logging.info("{0}: {1}".format(image_path, error))
@@ -0,0 +1,65 @@
+"""
+Computes the perceptual hash used for related-image suggestions for every converted image that doesn't have one yet -
+mostly images converted before convert.py started computing them. The images are hashed in a pool of worker processes
+(see conversion.worker_count in the config json). Safe to rerun at any time.
+Pass CD numbers to only hash those CDs; with no arguments every converted image in the database is checked.
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pycode.config.config import Config
+from pycode.objects.clipart_image import get_images_missing_perceptual_hash_query, \
+    get_bulk_update_perceptual_hash_statement
+from pycode.objects.database_connection import get_database_connection
+from pycode.objects.perceptual_hash import compute_file_dhash
+
+
+# runs in a worker process. Returns (perceptual hash, None), or (None, error message) if the image couldn't be hashed.
+def hash_image(image_path):
+    try:
+        return compute_file_dhash(image_path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def get_images_to_hash(db_conn, image_base_dir, origin_cd=None):
+    for image_id, subdirectories, filename in db_conn.stream_sql_query(
+            *get_images_missing_perceptual_hash_query(origin_cd)):
+        # the .htm files saved off the CDs are catalogued too, but there's nothing to hash
+        if os.path.splitext(filename)[1].lower() == ".htm":
+            continue
+        yield image_id, os.path.join(image_base_dir, subdirectories, filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute missing perceptual hashes for converted images.")
+    parser.add_argument("cd_numbers", nargs="*", type=int, help="only hash these CDs")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    db_conn = get_database_connection(config)
+    image_base_dir = config.get_image_base_dir()
+
+    with ProcessPoolExecutor(max_workers=config.get_conversion_worker_count()) as executor:
+        for cd_number in args.cd_numbers or [None]:
+            logging.info("Computing perceptual hashes for {0}...".format(
+                "CD {0}".format(cd_number) if cd_number is not None else "all CDs"))
+            images = list(get_images_to_hash(db_conn, image_base_dir, cd_number))
+            errors = []
+            with db_conn.get_batch_writer(get_bulk_update_perceptual_hash_statement,
+                                          config.get_conversion_insert_batch_size()) as hash_writer:
+                for index, (perceptual_hash, error) in enumerate(executor.map(hash_image, [x[1] for x in images],
+                                                                              chunksize=64)):
+                    if index % 1000 == 0 and index > 0:
+                        logging.info("\tprocessed {0}...".format(index))
+                    if error is not None:
+                        errors.append((images[index][1], error))
+                    else:
+                        hash_writer.add((images[index][0], perceptual_hash))
+
+            logging.info("Hashed {0} images, {1} errors".format(len(images) - len(errors), len(errors)))
+            for image_path, error in errors:
+                logging.info("{0}: {1}".format(image_path, error))
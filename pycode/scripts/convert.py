@@ -2,15 +2,47 @@
 Saves files from the mounted cd images to the location of the user's choice, as specified by the image_base_dir param
 in the config json. Files that end in .wmf, .tif, or .tiff will be converted to .png files. Everything else will just
 be copied over. Records for everything will be inserted into the database.
+
+The decode/encode step runs in a pool of worker processes (see conversion.worker_count and conversion.max_queued_jobs
+in the config json) while this process walks the drives and writes all the database records, conversion.insert_batch_size
+rows at a time. Each file goes straight to whichever of Pillow and ImageMagick has been succeeding on its extension (or
+the order given for it in conversion.backend_order), and the success rate and speed of each backend are logged at the
+end of every CD.
+
+Progress is checkpointed per CD in a journal under conversion.journal_dir, so a rerun after a crash skips everything
+that was already finished. Run with --force to walk every CD again and redo only the files whose source changed or
+whose conversion failed.
+
+The drives themselves are only read once, by the inventory stage (see objects/file_inventory.py), which scans every CD
+in drive_to_cd_number_pairs at the same time and stores the listing in the database. Conversion then works from that
+listing. CDs that have never been scanned are scanned first; --rescan (or --force) scans them all again.
+
+Every source file is hashed before it's handed to the workers, and the hash is stored on each record. A file whose bytes match one that was
+already converted - on any CD - gets a hardlink (or copy) of that output instead of being converted again. See
+report_duplicates.py for the list of identical files in the catalog.
+
+Every converted image also gets a preview thumbnail in thumbnails.cache_dir. Images converted before that existed can
+be caught up with backfill_thumbnails.py.
+
+With metrics.enabled set in the config json, the time spent in each stage (scan, walk, read, decode, encode, thumbnail,
+perceptual_hash), the database batch writes and every statement are recorded, and written to convert.json and
+convert.prom in metrics.output_dir after each CD.
 """
+import argparse
 import logging
 import os
 
-from PIL import Image
-from wand.image import Image as wima
 from pycode.config.config import Config
-from pycode.objects.clipart_image import get_image_by_file_data_query, ClipartImage
-from pycode.objects.mysql_connection import MysqlConnection
+from pycode.objects import metrics
+from pycode.objects.clipart_image import get_image_keys_by_cd_query, get_bulk_insert_statement, \
+    get_renumber_positions_statement, ClipartImage
+from pycode.objects.backend_router import BackendRouter
+from pycode.objects.conversion_cache import ConversionCache, hash_file
+from pycode.objects.conversion_engine import ConversionEngine, ConversionJob, ConversionResult
+from pycode.objects.conversion_journal import ConversionJournal
+from pycode.objects.database_connection import get_database_connection
+from pycode.objects.file_inventory import FileInventory
+from pycode.objects.thumbnail_store import ThumbnailStore
 
 # TODO make sure you change this to the appropriate cd number - mounted drive pairs for each run
 drive_to_cd_number_pairs = [
@@ -26,83 +58,256 @@ drive_to_cd_number_pairs = [
 endings_for_conversion = ['.WMF', '.wmf', '.tif', '.TIF', '.tiff', '.TIFF']
 endings_for_save = ['.png', '.PNG', '.jpg', '.JPG', '.jpeg', '.JPEG', '.gif', '.GIF', '.htm']
 
+
+# loads the key of every record already in the database for this CD into memory, a chunk at a time, so the walk can
+# check for existing records without a query per file. Returns the set of all keys, the set of keys for records that
+# failed to save and the set of keys for records whose source hash is known.
+def load_existing_image_keys(db_conn, cd_number, chunk_size=10000):
+    existing_keys = set()
+    failed_keys = set()
+    hashed_keys = set()
+    last_id = 0
+    while True:
+        records = db_conn.execute_sql_query(*get_image_keys_by_cd_query(cd_number, last_id, chunk_size))
+        for record_id, subdirectories, filename, failed_to_save, has_hash in records:
+            key = os.path.join(subdirectories, filename)
+            existing_keys.add(key)
+            if failed_to_save:
+                failed_keys.add(key)
+            if has_hash:
+                hashed_keys.add(key)
+        if len(records) < chunk_size:
+            return existing_keys, failed_keys, hashed_keys
+        last_id = records[-1][0]
+
+
+def get_image_for_job(job, failed, perceptual_hash=None):
+    return ClipartImage(filename=job.output_filename, origin_cd=job.origin_cd, subdirectories=job.subdirectory,
+                        failed_to_save=failed, original_file_extension=job.file_extension.lstrip("."),
+                        source_hash=job.source_hash, perceptual_hash=perceptual_hash)
+
+
+# records a job whose output was linked from an identical, already converted source file
+def record_duplicate(job, existing_output, conversion_cache, image_writer, journal, counts):
+    logging.debug("{0} is identical to the source of {1}, linking...".format(job.input_location, existing_output[0]))
+    conversion_cache.link_output(job, existing_output)
+    conversion_cache.add_output(job, existing_output[2])
+    image_writer.add(get_image_for_job(job, False, existing_output[2]))
+    journal.file_finished(job.relative_path, failed=False)
+    counts['duplicates'] += 1
+    metrics.increment("conversion_files_total", outcome="duplicate")
+
+
+# walks the CD's inventory and yields a ConversionJob for every file that still needs converting. Files that were
+# already converted on a previous run are handled here directly, since all that's left to do for them is make sure
+# the database has a record.
+#
+# Without force, subtrees and files the journal says are finished are skipped outright. With force, everything is
+# walked again and any file whose source changed since it was journaled, or whose last conversion failed, is
+# converted again even if there's already something at its output location.
+#
+# Every file that's looked at gets its source hashed. Files whose bytes match a source that's already been converted
+# get a link to that output instead of a job, and ones matching a source that's still being converted wait for it in
+# the conversion cache. Files that can't be read to hash them are recorded as failed conversions, and added to
+# conversion_errors like the ones the workers fail on.
+def walk_conversion_jobs(existing_keys, failed_keys, hashed_keys, journal, image_writer, thumbnail_store,
+                         conversion_cache, inventory, cd_number, mounted_drive, output_base_dir, counts,
+                         conversion_errors, force=False):
+    if not force and journal.is_subtree_complete(os.curdir):
+        logging.info("Journal says CD {0} is already finished; use --force to check it again".format(cd_number))
+        return
+
+    for relative_root, dirs, files in inventory.walk(cd_number):
+        root = mounted_drive if relative_root == os.curdir else os.path.join(mounted_drive, relative_root)
+        if not force:
+            # pruning dirs in place stops the walk from ever listing the finished subtrees
+            dirs[:] = [x for x in dirs if not journal.is_subtree_complete(x)]
+        journal.start_directory(relative_root, dirs)
+
+        for inventory_file in files:
+            # only log every 1000 records to not overwhelm console with junk
+            if counts['viewed'] % 1000 == 0 and counts['viewed'] > 0:
+                logging.info("\tprocessed {0}...".format(counts['viewed']))
+            counts['viewed'] += 1
+            file = inventory_file.filename
+            file_name, file_extension = os.path.splitext(file)
+
+            if file_extension in endings_for_conversion + endings_for_save:
+                should_convert = True if file_extension in endings_for_conversion else False
+                logging.debug(f"Processing file {file} with extension {file_extension}. "
+                              f"Will convert? {should_convert}")
+
+                input_location = os.path.join(root, file)
+                relative_path = inventory_file.relative_path
+                source_size, source_mtime = inventory_file.size, inventory_file.mtime
+                unchanged = journal.is_file_unchanged(relative_path, source_size, source_mtime)
+                if not force and unchanged:
+                    logging.debug("Journal says {0} is already finished, skipping...".format(input_location))
+                    continue
+
+                output_filename = '{0}.png'.format(file_name) if should_convert else file
+                output_directory = root.replace(mounted_drive, output_base_dir)
+                if not os.path.exists(output_directory):
+                    os.makedirs(output_directory)
+                output_location = os.path.join(output_directory, output_filename)
+                subdirectory = output_directory.replace(output_base_dir, "").rstrip('\\')
+                key = os.path.join(subdirectory, output_filename)
+                journal.file_queued(relative_path, source_size, source_mtime)
+
+                needs_retry = force and (key in failed_keys or journal.is_file_failed(relative_path) or
+                                         (relative_path in journal.file_entries and not unchanged))
+                if os.path.exists(output_location) and not needs_retry:
+                    logging.debug("File {0} already exists, skipping...".format(output_location))
+                    # make sure the file was saved to the database with its source hash - if not, add or update the
+                    # record, keeping whatever failure flag it already had
+                    if key not in existing_keys or key not in hashed_keys:
+                        logging.debug("No existing hashed record found for {0}. Upserting one...".format(output_filename))
+                        try:
+                            source_hash = hash_file(input_location)
+                        except OSError as e:
+                            # the output is already there, so the record is still worth having without a hash
+                            logging.warning("Could not read {0} to hash it: {1}".format(input_location, e))
+                            source_hash = None
+                        new_image = ClipartImage(filename=output_filename, origin_cd=cd_number,
+                                                 subdirectories=subdirectory, failed_to_save=key in failed_keys,
+                                                 original_file_extension=file_extension.lstrip("."),
+                                                 source_hash=source_hash)
+                        image_writer.add(new_image)
+                    journal.file_finished(relative_path, failed=False)
+                    continue
+
+                try:
+                    source_hash = hash_file(input_location)
+                except OSError as e:
+                    # unreadable or truncated sources are common on scratched discs; the file can't be converted
+                    # either, so it's recorded as a failed conversion and the walk moves on
+                    logging.debug("Could not read {0}: {1}".format(input_location, e))
+                    error = "Could not read source file: {0}".format(e)
+                    conversion_errors.append((input_location, error, error))
+                    image_writer.add(ClipartImage(filename=output_filename, origin_cd=cd_number,
+                                                  subdirectories=subdirectory, failed_to_save=True,
+                                                  original_file_extension=file_extension.lstrip(".")))
+                    journal.file_finished(relative_path, failed=True)
+                    metrics.increment("conversion_files_total", outcome="failed", backend="none")
+                    continue
+                job = ConversionJob(input_location, output_location, output_filename, cd_number, subdirectory,
+                                    file_extension, should_convert, relative_path,
+                                    thumbnail_store.get_thumbnail_path(subdirectory, output_filename), source_hash)
+                existing_output = conversion_cache.get_output(job)
+                if existing_output is not None:
+                    record_duplicate(job, existing_output, conversion_cache, image_writer, journal, counts)
+                    continue
+                if conversion_cache.is_converting(job.source_hash):
+                    logging.debug("{0} is identical to a file being converted, waiting on it...".format(input_location))
+                    conversion_cache.park(job)
+                    continue
+
+                # if the output location does not exist yet, the image has not been converted; hand it to the workers.
+                logging.debug(f"Queueing {input_location} for conversion to {output_location}")
+                conversion_cache.start(job)
+                yield job
+
+            else:
+                logging.debug("Skipping file {0} with extension {1}".format(file, file_extension))
+
+        journal.finish_listing(relative_root)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the mounted Masterclips CDs and catalog them.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--resume", action="store_true",
+                      help="skip everything the checkpoint journal says is finished (the default)")
+    mode.add_argument("--force", action="store_true",
+                      help="walk every CD again, reconverting files that changed or failed last time")
+    parser.add_argument("--rescan", action="store_true",
+                        help="scan the drives for changes before converting, even if they've been scanned before")
+    args = parser.parse_args()
+
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
     config = Config()
-    db_conn = MysqlConnection(config)
+    metrics.start_reporting(config, "convert")
+    db_conn = get_database_connection(config)
     output_base_dir = config.get_image_base_dir()
     logging.info("Saving images to {0}".format(output_base_dir))
 
-    for (cd_number, mounted_drive) in drive_to_cd_number_pairs:
-        logging.info("Converting CD {0}...".format(cd_number))
-        conversion_errors = []
-        record_count = 0
-
-        for root, dirs, files in os.walk(mounted_drive):
-            for file in files:
-                # only log every 1000 records to not overwhelm console with junk
-                if record_count % 1000 == 0 and record_count > 0:
-                    logging.info("\tprocessed {0}...".format(record_count))
-                record_count += 1
-                file_name, file_extension = os.path.splitext(file)
-                failed = False
-
-                if file_extension in endings_for_conversion + endings_for_save:
-                    should_convert = True if file_extension in endings_for_conversion else False
-                    logging.debug(f"Processing file {file} with extension {file_extension}. "
-                                  f"Will convert? {should_convert}")
-
-                    input_location = os.path.join(root, file)
-                    output_filename = '{0}.png'.format(file_name) if should_convert else file
-                    output_directory = root.replace(mounted_drive, output_base_dir)
-                    if not os.path.exists(output_directory):
-                        os.makedirs(output_directory)
-                    output_location = os.path.join(output_directory, output_filename)
-                    subdirectory = output_directory.replace(output_base_dir, "").rstrip('\\')
-
-                    if os.path.exists(output_location):
-                        logging.debug("File {0} already exists, skipping...".format(output_location))
-                        # make sure the file was saved to the database - if not, add a record
-                        existing_records = db_conn.execute_sql_query(*get_image_by_file_data_query(output_filename, cd_number, subdirectory))
-                        if len(existing_records) == 0:
-                            logging.debug("No existing records found for {0}. Creating a new one and inserting...".format(output_filename))
-                            new_image = ClipartImage(filename=output_filename, origin_cd=cd_number,
-                                                     subdirectories=subdirectory, failed_to_save=failed,
-                                                     original_file_extension=file_extension.lstrip("."))
-                            db_conn.execute_sql_statement(*new_image.get_insert_statement())
-                        continue
-
-                    # if the output location does not exist yet, the image has not been converted; do so now.
-                    logging.debug(f"Converting {input_location} to {output_location}")
-
-                    try:
-                        with Image.open(input_location) as im:
-                            im.save(output_location, "png" if should_convert else file_extension.lstrip("."))
-                    except Exception as e:
-                        logging.debug("Errored with Pillow: {0}. Trying Wand...".format(e))
-                        try:
-                            with wima(filename=input_location) as im:
-                                im.save(filename=output_location)
-                            logging.debug("Conversion completed successfully!")
+    inventory = FileInventory(db_conn, config.get_conversion_insert_batch_size())
+    if args.rescan or args.force:
+        sources_to_scan = drive_to_cd_number_pairs
+    else:
+        scanned_cds = inventory.get_scanned_cds()
+        sources_to_scan = [x for x in drive_to_cd_number_pairs if x[0] not in scanned_cds]
+    failed_scans = inventory.refresh(sources_to_scan)
+
+    thumbnail_store = ThumbnailStore(config.get_thumbnail_cache_dir(), config.get_thumbnail_size())
+
+    # shared across CDs, since the same artwork often ships on more than one
+    conversion_cache = ConversionCache(thumbnail_store)
+    conversion_cache.load(db_conn, output_base_dir)
+
+    router = BackendRouter(config.get_conversion_backend_order(), config.get_conversion_router_min_samples())
+    with ConversionEngine(config.get_conversion_worker_count(), config.get_conversion_max_queued_jobs(),
+                          thumbnail_store.size, router, config.get_conversion_wand_batch_size()) as engine:
+        for (cd_number, mounted_drive) in drive_to_cd_number_pairs:
+            if cd_number in failed_scans:
+                logging.error("Skipping CD {0}, it couldn't be scanned".format(cd_number))
+                continue
+            logging.info("Converting CD {0}...".format(cd_number))
+            conversion_errors = []
+            counts = {'viewed': 0, 'duplicates': 0}
+            existing_keys, failed_keys, hashed_keys = load_existing_image_keys(db_conn, cd_number)
+            journal = ConversionJournal(config.get_conversion_journal_dir(), cd_number)
+            # freshly converted files overwrite the failure flag of any record left over from an earlier attempt and
+            # fill in its source and perceptual hashes. The journal is only written once the matching records are
+            # safely in the database.
+            image_writer = db_conn.get_batch_writer(
+                lambda images: get_bulk_insert_statement(images, update_columns=['failed_to_save'],
+                                                         fill_columns=['source_hash', 'perceptual_hash'],
+                                                         dialect=db_conn.dialect),
+                config.get_conversion_insert_batch_size(), on_flush=journal.commit, name="clipart")
+
+            # called in this process as each worker finishes, so the database only ever has a single writer
+            def record_result(result):
+                metrics.increment("conversion_files_total", outcome="failed" if result.failed else "converted",
+                                  backend=result.attempts[-1][0] if len(result.attempts) > 0 else "none")
+                if result.failed:
+                    logging.debug("Conversion of {0} failed with both methods.".format(result.job.input_location))
+                    conversion_errors.append(result.get_error_entry())
+                elif len(result.attempts) > 1:
+                    logging.debug("Errored with {0}: {1}. Converted with {2} instead.".format(
+                        result.attempts[0][0], result.attempts[0][2], result.attempts[-1][0]))
 
-                        except Exception as e2:
-                            logging.debug("Conversion failed with both methods.")
-                            conversion_errors.append((input_location, e, e2))
-                            failed = True
+                image_writer.add(get_image_for_job(result.job, result.failed, result.perceptual_hash))
+                journal.file_finished(result.job.relative_path, result.failed)
 
-                    new_image = ClipartImage(filename=output_filename, origin_cd=cd_number,
-                                             subdirectories=subdirectory, failed_to_save=failed,
-                                             original_file_extension=file_extension.lstrip("."))
-                    db_conn.execute_sql_statement(*new_image.get_insert_statement())
+                # identical files that turned up while this one was converting share its outcome
+                for parked_job in conversion_cache.finish(result):
+                    if result.failed:
+                        record_result(ConversionResult(parked_job, result.attempts))
+                    else:
+                        record_duplicate(parked_job, (result.job.output_location, result.job.thumbnail_path,
+                                                      result.perceptual_hash),
+                                         conversion_cache, image_writer, journal, counts)
 
-                else:
-                    logging.debug("Skipping file {0} with extension {1}".format(file, file_extension))
+            with image_writer:
+                # the walk stage covers everything this process does to turn a listed file into a job, including
+                # reading it for its hash
+                jobs = walk_conversion_jobs(existing_keys, failed_keys, hashed_keys, journal, image_writer,
+                                            thumbnail_store, conversion_cache, inventory, cd_number, mounted_drive,
+                                            output_base_dir, counts, conversion_errors, force=args.force)
+                engine.run(metrics.time_iteration(jobs, "conversion_stage_seconds", stage="walk"), record_result)
+            journal.commit()
 
-        logging.info("Total number of files viewed: {0}".format(record_count))
-        logging.info("{0} conversion errors:".format(len(conversion_errors)))
-        for error in conversion_errors:
-            logging.info("{0}\nPillow error:\n{1}\n\nWand Error:\n{2}\n-------------------------".format(
-                error[0], error[1], error[2]))
+            # number the files in every directory of the CD so related images can be found by position
+            db_conn.execute_sql_statement(*get_renumber_positions_statement(cd_number, db_conn.dialect))
 
-        logging.info("\n================================================\n")
+            logging.info("Total number of files viewed: {0}".format(counts['viewed']))
+            logging.info("Linked {0} files identical to ones already converted".format(counts['duplicates']))
+            router.log_report("CD {0}".format(cd_number))
+            metrics.write_reports()
+            logging.info("{0} conversion errors:".format(len(conversion_errors)))
+            for error in conversion_errors:
+                logging.info("{0}\nPillow error:\n{1}\n\nWand Error:\n{2}\n-------------------------".format(
+                    error[0], error[1], error[2]))
 
+            logging.info("\n================================================\n")
@@ -0,0 +1,40 @@
+"""
+Writes snapshots of the clipart and tokens tables to compressed files in a directory, for backups or for reading the
+catalog into analysis tools. Parquet (the default) and Arrow IPC need pyarrow installed; without it, the default is
+gzipped CSV. Rows are streamed out in chunks, so memory use doesn't grow with the catalog.
+
+With --incremental, each table's snapshot only holds the rows added or posted since its last snapshot in the
+directory, e.g. for nightly backups between weekly full ones. See objects/catalog_archive.py for what that misses.
+import_catalog.py loads a directory of snapshots back in.
+
+The tokens snapshot holds the blog's OAuth credentials; keep the directory private.
+"""
+import argparse
+import logging
+import os
+
+from pycode.config.config import Config
+from pycode.objects.catalog_archive import archived_columns, formats, get_default_format, export_table, \
+    is_pyarrow_available
+from pycode.objects.database_connection import backends, get_database_connection
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export catalog tables to Parquet, Arrow IPC or CSV snapshots.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--format", choices=formats, default=get_default_format())
+    parser.add_argument("--tables", nargs="+", choices=list(archived_columns.keys()),
+                        default=list(archived_columns.keys()))
+    parser.add_argument("--incremental", action="store_true",
+                        help="only export rows added or posted since each table's last snapshot in output_dir")
+    parser.add_argument("--backend", choices=backends, help="export from this backend instead of the configured one")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows read and written at a time")
+    args = parser.parse_args()
+    if args.format != "csv" and not is_pyarrow_available():
+        parser.error(f"--format {args.format} needs pyarrow; install it or use --format csv")
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    db_conn = get_database_connection(config, args.backend)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for table in args.tables:
+        export_table(db_conn, table, args.output_dir, args.format, args.incremental, args.chunk_size)
@@ -0,0 +1,30 @@
+"""
+Loads the clipart and tokens tables from a directory of snapshots written by export_catalog.py: each table's newest
+full snapshot, followed by every incremental snapshot taken after it. Rows keep their ids, so the thumbnail cache and
+anything else holding image ids still line up.
+
+Rows go in as multi-row inserts, all in one transaction per table, so an import that fails partway leaves the table as
+it was. The tables have to be empty unless --replace is given, in which case they're cleared first.
+"""
+import argparse
+import logging
+
+from pycode.config.config import Config
+from pycode.objects.catalog_archive import archived_columns, import_table
+from pycode.objects.database_connection import backends, get_database_connection
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import catalog tables from snapshots written by export_catalog.py.")
+    parser.add_argument("input_dir")
+    parser.add_argument("--tables", nargs="+", choices=list(archived_columns.keys()),
+                        default=list(archived_columns.keys()))
+    parser.add_argument("--replace", action="store_true", help="clear the tables before importing into them")
+    parser.add_argument("--backend", choices=backends, help="import into this backend instead of the configured one")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    db_conn = get_database_connection(config, args.backend)
+    db_conn.set_up_tables()
+    for table in args.tables:
+        import_table(db_conn, table, args.input_dir, config.get_conversion_insert_batch_size(), args.replace)
@@ -1,31 +1,33 @@
 """
-Iterates through all mounted cds listed in convert.py and prints out the file extensions found on each cd. This way,
-I can make sure there's some handler in the conversion script for each type of file on the disk.
+Scans all mounted cds listed in convert.py into the file inventory and prints out the file extensions found on them.
+This way, I can make sure there's some handler in the conversion script for each type of file on the disk. The cds are
+scanned concurrently, and convert.py then works from the same inventory instead of reading the drives again.
+
+Run with --cached to print the extensions from the last scan without reading the drives at all.
 """
+import argparse
 import logging
-import os
 
 from pycode.config.config import Config
-from pycode.objects.mysql_connection import MysqlConnection
+from pycode.objects.database_connection import get_database_connection
+from pycode.objects.file_inventory import FileInventory
 from pycode.scripts.convert import drive_to_cd_number_pairs
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inventory the mounted Masterclips CDs and list their file extensions.")
+    parser.add_argument("--cached", action="store_true", help="use the last scan instead of reading the drives again")
+    args = parser.parse_args()
+
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
     config = Config()
-    db_conn = MysqlConnection(config)
-    file_endings = {}
-    record_count = 0
-    for (cd_number, mounted_drive) in drive_to_cd_number_pairs:
-        logging.info("Checking file extensions on CD {0}...".format(cd_number))
-        for root, dirs, files in os.walk(mounted_drive):
-            for file in files:
-                record_count += 1
-                file_name, file_extension = os.path.splitext(file)
-                if file_extension not in file_endings:
-                    file_endings[file_extension] = 0
-                file_endings[file_extension] += 1
+    db_conn = get_database_connection(config)
+    inventory = FileInventory(db_conn, config.get_conversion_insert_batch_size())
+    if not args.cached:
+        inventory.refresh(drive_to_cd_number_pairs)
 
+    record_count = 0
     logging.info("File endings found:")
-    for key, value in sorted(file_endings.items(), key=lambda item: item[1], reverse=True):
-        logging.info("{0}: {1}".format(key, value))
+    for extension, count in inventory.get_extension_histogram([x[0] for x in drive_to_cd_number_pairs]):
+        logging.info("{0}: {1}".format(extension, count))
+        record_count += count
     logging.info("Total number of files: {0}".format(record_count))
@@ -0,0 +1,27 @@
+"""
+Lists every group of catalog records that were converted from byte-for-byte identical source files, going by the source
+hashes convert.py stores. Records converted before source hashes existed get one the next time convert.py is run on
+their CD with --force.
+"""
+import itertools
+import logging
+
+from pycode.config.config import Config
+from pycode.objects.clipart_image import duplicate_images_query
+from pycode.objects.database_connection import get_database_connection
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    db_conn = get_database_connection(config)
+
+    group_count = 0
+    duplicate_count = 0
+    # one row per record, with every set of identical records together, so only one set is held in memory at a time
+    records = db_conn.stream_sql_query(duplicate_images_query)
+    for (source_hash, record_count), group in itertools.groupby(records, key=lambda x: x[:2]):
+        locations = ["disc {0}: {1}\\{2}".format(x[2], x[3] or "", x[4]) for x in group]
+        logging.info("{0} copies of {1}: {2}".format(record_count, source_hash, ", ".join(locations)))
+        group_count += 1
+        duplicate_count += record_count - 1
+    logging.info("{0} files are duplicates of another, across {1} groups".format(duplicate_count, group_count))
@@ -0,0 +1,123 @@
+"""
+Benchmarks the conversion pipeline and the catalog queries, so changes to convert.py, the database layer or the random
+pick can be compared run to run. Results are written as json.
+
+The conversion stages (walk, decode, encode, and the whole per-file conversion) run against a synthetic corpus
+generated from --seed, so every run sees the same files. WMFs are written by hand, so whether they can be decoded
+depends on the toolchain - Pillow only renders them on Windows, and ImageMagick needs libwmf.
+
+The catalog benchmarks insert a synthetic catalog, growing it through each of --catalog-sizes, and time the random
+fresh-image pick, the directory-first pick and the related-images lookup by directory size at each size. They run
+against the SQLite backend by default, in a temporary file unless --sqlite-path is given, or with --database mysql
+against the MySQL server in the config json - in a separate <database>_benchmark database, never the real catalog.
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+
+from pycode.benchmark.catalog import SyntheticCatalog
+from pycode.benchmark.stages import benchmark_walk, benchmark_decode_encode, benchmark_convert
+from pycode.config.config import Config
+from pycode.objects.clipart_image import table_name as image_table_name
+from pycode.objects.database_connection import backends, get_database_connection
+
+
+class BenchmarkConfig(Config):
+    def __init__(self, sqlite_path):
+        super().__init__()
+        self.sqlite_path = sqlite_path
+
+    def get_mysql_database(self):
+        return "{0}_benchmark".format(super().get_mysql_database())
+
+    def get_sqlite_path(self):
+        return self.sqlite_path
+
+
+def get_benchmark_connection(database, sqlite_path):
+    db_conn = get_database_connection(BenchmarkConfig(sqlite_path), database)
+    # every run starts from an empty catalog
+    db_conn.execute_sql_statement("DROP TABLE IF EXISTS {0};".format(image_table_name))
+    db_conn.set_up_tables()
+    return db_conn
+
+
+def run_stage_benchmarks(corpus_dir, file_count, seed):
+    from pycode.benchmark.corpus import generate_corpus
+
+    logging.info("Generating a {0} file corpus in {1}...".format(file_count, corpus_dir))
+    sources, written = generate_corpus(corpus_dir, file_count, seed)
+    paths = sorted(os.path.join(root, x) for (cd_number, directory) in sources
+                   for root, dirs, files in os.walk(directory) for x in files)
+
+    logging.info("Timing the walk...")
+    results = {"corpus_files": written, "walk": benchmark_walk(sources)}
+    logging.info("Timing decode and encode...")
+    results["decode"], results["encode"] = benchmark_decode_encode(paths)
+    logging.info("Timing whole conversions...")
+    results["convert"] = benchmark_convert(paths)
+    if results["convert"] is None:
+        logging.warning("Could not import the conversion engine (is Wand installed?); skipped whole conversions")
+    return results
+
+
+def run_catalog_benchmarks(db_conn, catalog_sizes, samples, seed, insert_batch_size):
+    catalog = SyntheticCatalog(db_conn, seed, insert_batch_size=insert_batch_size)
+    results = []
+    for catalog_size in sorted(catalog_sizes):
+        logging.info("Growing the catalog to {0} images...".format(catalog_size))
+        insert = catalog.grow(catalog_size)
+        logging.info("Timing queries at {0} images...".format(catalog_size))
+        results.append({"catalog_size": catalog_size, "insert": insert,
+                        "random_pick": catalog.benchmark_random_pick(samples),
+                        "directory_pick": catalog.benchmark_directory_pick(samples),
+                        "nearby_by_directory_size": catalog.benchmark_nearby(samples)})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark conversion stages and catalog queries.")
+    parser.add_argument("--database", choices=backends, default="sqlite",
+                        help="run the catalog benchmarks against a SQLite file, or the configured MySQL server")
+    parser.add_argument("--sqlite-path", help="database file for --database sqlite; a temporary file by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus-files", type=int, default=1000, help="size of the synthetic corpus")
+    parser.add_argument("--corpus-dir", help="where to generate the corpus; a temporary directory by default")
+    parser.add_argument("--catalog-sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--samples", type=int, default=200, help="query timings taken per catalog size")
+    parser.add_argument("--skip-stages", action="store_true", help="only run the catalog benchmarks")
+    parser.add_argument("--skip-catalog", action="store_true", help="only run the conversion stage benchmarks")
+    parser.add_argument("--output", help="json file to write the results to; printed if not given")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    results = {"run": {"started_on": dt.datetime.now().isoformat(timespec="seconds"), "seed": args.seed,
+                       "database": args.database, "python": sys.version.split()[0], "platform": platform.platform()}}
+
+    if not args.skip_stages:
+        if args.corpus_dir is not None:
+            results["stages"] = run_stage_benchmarks(args.corpus_dir, args.corpus_files, args.seed)
+        else:
+            with tempfile.TemporaryDirectory() as corpus_dir:
+                results["stages"] = run_stage_benchmarks(corpus_dir, args.corpus_files, args.seed)
+
+    if not args.skip_catalog:
+        with tempfile.TemporaryDirectory() as sqlite_dir:
+            db_conn = get_benchmark_connection(args.database,
+                                               args.sqlite_path or os.path.join(sqlite_dir, "benchmark.sqlite3"))
+            results["catalog"] = run_catalog_benchmarks(db_conn, args.catalog_sizes, args.samples, args.seed,
+                                                        Config().get_conversion_insert_batch_size())
+            db_conn.close_connection()
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+        logging.info("Results written to {0}".format(args.output))
+    else:
+        print(output)
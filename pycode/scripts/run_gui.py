@@ -1,9 +1,27 @@
+import time
+
+# taken before anything else is imported so --profile-startup counts import time too
+launched_at = time.perf_counter()
+
+import argparse
+import tkinter as tk
+
 from pycode.config.config import Config
+from pycode.objects import metrics
 from pycode.objects.posting_app import PostingApp
-import tkinter as tk
+from pycode.objects.startup_profile import StartupProfile
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pick, label and post clipart images to Tumblr.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="log how long each startup step takes, up to the first image being shown")
+    args = parser.parse_args()
+
+    startup_profile = StartupProfile(launched_at) if args.profile_startup else None
+    if startup_profile is not None:
+        startup_profile.mark("light imports done")
     gui_root = tk.Tk()
     config = Config()
-    app_handle = PostingApp(gui_root, config)
+    metrics.start_reporting(config, "posting_app")
+    app_handle = PostingApp(gui_root, config, startup_profile)
     gui_root.mainloop()
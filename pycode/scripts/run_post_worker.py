@@ -0,0 +1,115 @@
+"""
+Headless worker that sends the posts queued from the posting GUI once they're due, oldest first. Posts are paced to at
+most post_worker.posts_per_hour, and the worker backs off whenever Tumblr reports a rate limit has run out. Posts that
+fail are requeued with a backoff until they've been tried post_worker.max_attempts times, then given up on and their
+images put back up for posting.
+
+The worker reuses the Tumblr token saved by the GUI, so authenticate there at least once first. Run with --once to send
+whatever is due right now and exit instead of polling forever.
+"""
+import argparse
+import datetime as dt
+import logging
+import time
+
+from pycode.config.config import Config
+from pycode.objects import metrics
+from pycode.objects.database_connection import get_database_connection
+from pycode.objects.queued_post import QueuedPost, get_next_due_post_query, requeue_interrupted_posts_statement, \
+    queued_post_count_query
+from pycode.objects.tumblr_connection import TumblrConnection
+
+
+def mark_images(db_conn, queued_post, build_statement):
+    with db_conn.transaction():
+        for image in queued_post.images:
+            db_conn.execute_sql_statement(*build_statement(image))
+
+
+# sends one claimed post and records the outcome. Returns the response so the caller can pace itself.
+def send_queued_post(db_conn, tumblr_conn, queued_post, image_base_dir, max_attempts):
+    try:
+        queued_post.load_images(db_conn, image_base_dir)
+    except ValueError as e:
+        logging.error(str(e))
+        db_conn.execute_sql_statement(*queued_post.get_mark_failed_statement(str(e)))
+        metrics.increment("queued_posts_total", outcome="missing_images")
+        return None
+
+    # retries inside a single attempt are kept short; longer waits happen by requeueing the post
+    response = tumblr_conn.send_post_with_retries(queued_post, max_attempts=3, max_delay=60)
+    if response is not None and response.status_code == 201:
+        logging.info(f"Sent queued post {queued_post.id}")
+        with db_conn.transaction():
+            db_conn.execute_sql_statement(*queued_post.get_mark_sent_statement())
+            mark_images(db_conn, queued_post, lambda x: x.get_update_image_mark_posted_statement())
+        metrics.increment("queued_posts_total", outcome="sent")
+        return response
+
+    error = "no HTTP response" if response is None else f"{response.status_code}: {response.text[:500]}"
+    rate_limit_pause = TumblrConnection.get_rate_limit_reset(response)
+    if rate_limit_pause is not None:
+        # running into the rate limit isn't the post's fault, so it doesn't count towards its attempts
+        logging.warning(f"Rate limited; requeueing post {queued_post.id} for when the limit resets")
+        retry_at = dt.datetime.now() + dt.timedelta(seconds=rate_limit_pause)
+        db_conn.execute_sql_statement(*queued_post.get_mark_failed_statement(error, retry_at, count_attempt=False))
+        metrics.increment("queued_posts_total", outcome="rate_limited")
+    elif queued_post.attempts + 1 < max_attempts:
+        delay = TumblrConnection.get_retry_delay(response, queued_post.attempts, 60, 6 * 60 * 60) or 6 * 60 * 60
+        logging.warning(f"Queued post {queued_post.id} failed ({error}); retrying in {int(delay)} seconds")
+        retry_at = dt.datetime.now() + dt.timedelta(seconds=delay)
+        db_conn.execute_sql_statement(*queued_post.get_mark_failed_statement(error, retry_at))
+        metrics.increment("queued_posts_total", outcome="requeued")
+    else:
+        logging.error(f"Queued post {queued_post.id} failed for good ({error}); putting its images back up for posting")
+        with db_conn.transaction():
+            db_conn.execute_sql_statement(*queued_post.get_mark_failed_statement(error))
+            mark_images(db_conn, queued_post, lambda x: x.get_update_image_mark_unposted_statement())
+        metrics.increment("queued_posts_total", outcome="failed")
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send queued Tumblr posts as they come due.")
+    parser.add_argument("--once", action="store_true", help="send whatever is due now, then exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    metrics.start_reporting(config, "post_worker")
+    worker_config = config.get_post_worker_config()
+    min_interval = 3600 / worker_config['posts_per_hour']
+    db_conn = get_database_connection(config)
+    tumblr_conn = TumblrConnection(config, db_conn)
+    if not tumblr_conn.auth_if_token_present():
+        logging.error("No Tumblr token found; authenticate through the posting GUI first")
+        exit(1)
+
+    db_conn.execute_sql_statement(requeue_interrupted_posts_statement)
+    logging.info("{0} posts in the queue".format(db_conn.execute_sql_query(queued_post_count_query)[0][0]))
+
+    next_post_allowed_at = time.monotonic()
+    while True:
+        due_records = db_conn.execute_sql_query(*get_next_due_post_query(dt.datetime.now()))
+        if len(due_records) == 0:
+            if args.once:
+                break
+            time.sleep(worker_config['poll_seconds'])
+            continue
+
+        pause = next_post_allowed_at - time.monotonic()
+        if pause > 0:
+            logging.info(f"Waiting {int(pause)} seconds before the next post")
+            time.sleep(pause)
+            continue
+
+        queued_post = QueuedPost(db_record=due_records[0])
+        if db_conn.execute_sql_statement(*queued_post.get_claim_statement()) != 1:
+            # another worker got to it first
+            continue
+
+        response = send_queued_post(db_conn, tumblr_conn, queued_post, config.get_image_base_dir(),
+                                    worker_config['max_attempts'])
+        metrics.write_reports()
+        rate_limit_pause = TumblrConnection.get_rate_limit_reset(response) or 0
+        next_post_allowed_at = time.monotonic() + max(min_interval, rate_limit_pause)
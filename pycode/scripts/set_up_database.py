@@ -1,11 +1,25 @@
+"""
+Creates the catalog's tables, and brings ones created by older versions of the project up to date.
+
+With --rebuild-summary, also recounts the per-directory summary the GUI picks images by from the clipart table. It's
+kept up to date by triggers, so this is only needed if rows were changed while the triggers were missing.
+"""
+import argparse
 import logging
 
 from pycode.config.config import Config
-from pycode.objects.mysql_connection import MysqlConnection
+from pycode.objects.database_connection import get_database_connection
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or update the catalog's tables.")
+    parser.add_argument("--rebuild-summary", action="store_true",
+                        help="recount the per-directory summary from the clipart table")
+    args = parser.parse_args()
+
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
     config = Config()
-    db_conn = MysqlConnection(config)
-    db_conn.create_database()
-    db_conn.set_up_tables()
\ No newline at end of file
+    db_conn = get_database_connection(config)
+    db_conn.set_up_tables()
+    if args.rebuild_summary:
+        logging.info("Rebuilding the directory summary...")
+        db_conn.rebuild_directory_summary()
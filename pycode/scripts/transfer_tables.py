@@ -0,0 +1,79 @@
+"""
+Copies the clipart and tokens tables from one storage backend to the other, e.g. to move an existing MySQL catalog into
+the SQLite file the config json points at before switching its database backend over. Rows keep their ids, so the
+thumbnail cache, the similarity index and anything else holding image ids still line up. Rows are streamed across in
+batches, so memory use doesn't grow with the catalog.
+
+The target tables have to be empty unless --replace is given, in which case they're cleared first. Each table is copied
+in a single transaction on the target, so a transfer that fails partway leaves the target as it was.
+
+The post queue isn't copied; let run_post_worker.py send whatever is queued before switching. The file inventory is
+rebuilt by running convert.py or preprocess.py with --rescan against the new backend.
+"""
+import argparse
+import logging
+
+from pycode.config.config import Config
+from pycode.objects.catalog_archive import get_bulk_copy_statement, get_row_count
+from pycode.objects.clipart_image import image_columns, table_name as image_table_name
+from pycode.objects.database_connection import backends, get_database_connection
+from pycode.objects.token import token_columns, table_name as token_table_name
+
+# the tables to copy, in order, with the columns to copy from each
+transferred_columns = {
+    image_table_name: ['id'] + image_columns,
+    token_table_name: token_columns,
+}
+
+
+def get_table_query(table, columns):
+    return f"SELECT {', '.join(columns)} FROM {table} ORDER BY id;"
+
+
+def transfer_table(source_conn, target_conn, table, columns, batch_size, replace=False):
+    existing_count = get_row_count(target_conn, table)
+    if existing_count > 0 and not replace:
+        raise ValueError(f"The target's {table} table already has {existing_count} rows; use --replace to overwrite")
+
+    logging.info("Copying {0}...".format(table))
+    copied_count = 0
+    with target_conn.transaction():
+        if existing_count > 0:
+            target_conn.execute_sql_statement(f"DELETE FROM {table};")
+        with target_conn.get_batch_writer(lambda rows: get_bulk_copy_statement(table, columns, rows),
+                                          batch_size) as writer:
+            for row in source_conn.stream_sql_query(get_table_query(table, columns)):
+                writer.add(row)
+                copied_count += 1
+                if copied_count % 100000 == 0:
+                    logging.info("{0} rows of {1} copied".format(copied_count, table))
+
+    target_count = get_row_count(target_conn, table)
+    if target_count != copied_count:
+        raise ValueError(f"Copied {copied_count} rows of {table}, but the target has {target_count}")
+    logging.info("Copied {0} rows of {1}".format(copied_count, table))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the catalog and tokens from one database backend to another.")
+    parser.add_argument("source", choices=backends)
+    parser.add_argument("target", choices=backends)
+    parser.add_argument("--tables", nargs="+", choices=list(transferred_columns.keys()),
+                        default=list(transferred_columns.keys()))
+    parser.add_argument("--replace", action="store_true", help="clear the target tables before copying into them")
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("the source and target backends must differ")
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    config = Config()
+    source_conn = get_database_connection(config, args.source)
+    target_conn = get_database_connection(config, args.target)
+    # brings an older source up to date with the columns being copied, and creates the target's tables
+    source_conn.set_up_tables()
+    target_conn.set_up_tables()
+
+    for table in args.tables:
+        transfer_table(source_conn, target_conn, table, transferred_columns[table],
+                       config.get_conversion_insert_batch_size(), args.replace)
+    logging.info("Done. Set the database backend in the config json to \"{0}\" to use it.".format(args.target))